@@ -0,0 +1,37 @@
+"""Index (date_message_ts, id) pour la pagination par curseur chronologique
+
+Revision ID: 3f6a0d9e8c14
+Revises: e5a8b3f61c27
+Create Date: 2026-10-18 13:00:00.000000
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '3f6a0d9e8c14'
+down_revision: Union[str, None] = 'e5a8b3f61c27'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+INDEXES = [
+    ('ix_wish_date_message_ts_id', 'hl7_message_wish', ['date_message_ts', 'id']),
+    ('ix_orline_date_message_ts_id', 'hl7_message_orline', ['date_message_ts', 'id']),
+]
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    with op.get_context().autocommit_block():
+        for name, table, columns in INDEXES:
+            op.create_index(name, table, columns, postgresql_concurrently=True, if_not_exists=True)
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    with op.get_context().autocommit_block():
+        for name, table, _ in reversed(INDEXES):
+            op.drop_index(name, table_name=table, postgresql_concurrently=True, if_exists=True)
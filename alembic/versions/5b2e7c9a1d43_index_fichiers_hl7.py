@@ -0,0 +1,37 @@
+"""Index message_id → fichier HL7 d'origine
+
+Revision ID: 5b2e7c9a1d43
+Revises: 3f6a0d9e8c14
+Create Date: 2026-10-18 14:00:00.000000
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '5b2e7c9a1d43'
+down_revision: Union[str, None] = '3f6a0d9e8c14'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    op.create_table(
+        'hl7_file_index',
+        sa.Column('id', sa.Integer(), primary_key=True),
+        sa.Column('source', sa.String(), nullable=False),
+        sa.Column('message_id', sa.String(), nullable=False),
+        sa.Column('path', sa.String(), nullable=False),
+        sa.Column('offset', sa.Integer(), nullable=False, server_default='0'),
+    )
+    op.create_index(op.f('ix_hl7_file_index_message_id'), 'hl7_file_index', ['message_id'])
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_index(op.f('ix_hl7_file_index_message_id'), table_name='hl7_file_index')
+    op.drop_table('hl7_file_index')
@@ -0,0 +1,63 @@
+"""Colonnes horodatage typées (TIMESTAMP / DATE) et reprise des données
+
+Revision ID: 7b3e91c4d2a0
+Revises: d2cd52439ba9
+Create Date: 2026-10-18 10:00:00.000000
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '7b3e91c4d2a0'
+down_revision: Union[str, None] = 'd2cd52439ba9'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+# Formats écrits par les parsers : 'YYYY-MM-DD HH:MM:SS' (WISH), 'YYYY/MM/DD HH:MM:SS' et 'YYYY/MM/DD' (ORLine)
+DATETIME_RE = r'^\d{4}[-/]\d{2}[-/]\d{2} \d{2}:\d{2}:\d{2}$'
+DATE_RE = r'^\d{4}[-/]\d{2}[-/]\d{2}'
+
+# (table, colonne texte, colonne typée, type)
+TYPED_COLUMNS = [
+    ('hl7_message_wish', 'date_message', 'date_message_ts', 'timestamp'),
+    ('hl7_message_wish', 'clfrom', 'clfrom_ts', 'timestamp'),
+    ('hl7_message_wish', 'cltima', 'cltima_ts', 'timestamp'),
+    ('hl7_message_orline', 'date_message', 'date_message_ts', 'timestamp'),
+    ('hl7_message_orline', 'date_ope', 'date_ope_date', 'date'),
+    ('hl7_message_orline', 'arr_sal_ope', 'arr_sal_ope_ts', 'timestamp'),
+    ('hl7_message_orline', 'naissance', 'naissance_date', 'date'),
+]
+
+
+def _backfill_expr(source: str, kind: str) -> str:
+    # Valeurs hors format laissées à NULL plutôt que de faire échouer la migration
+    if kind == 'timestamp':
+        return (f"CASE WHEN {source} ~ '{DATETIME_RE}' "
+                f"THEN to_timestamp({source}, 'YYYY-MM-DD HH24:MI:SS')::timestamp END")
+    return (f"CASE WHEN {source} ~ '{DATE_RE}' "
+            f"THEN to_date(substr({source}, 1, 10), 'YYYY-MM-DD') END")
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    for table, _, column, kind in TYPED_COLUMNS:
+        col_type = sa.DateTime() if kind == 'timestamp' else sa.Date()
+        op.add_column(table, sa.Column(column, col_type, nullable=True))
+
+    # Reprise des lignes existantes, une requête par table
+    for table in ('hl7_message_wish', 'hl7_message_orline'):
+        assignments = ",\n    ".join(
+            f"{column} = {_backfill_expr(source, kind)}"
+            for t, source, column, kind in TYPED_COLUMNS if t == table
+        )
+        op.execute(f"UPDATE {table} SET\n    {assignments}")
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    for table, _, column, _ in reversed(TYPED_COLUMNS):
+        op.drop_column(table, column)
@@ -0,0 +1,40 @@
+"""Messages HL7 bruts compressés, par message_id et patient
+
+Revision ID: 8d1f4a6b2e90
+Revises: 5b2e7c9a1d43
+Create Date: 2026-10-18 15:00:00.000000
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '8d1f4a6b2e90'
+down_revision: Union[str, None] = '5b2e7c9a1d43'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    op.create_table(
+        'hl7_raw_message',
+        sa.Column('id', sa.Integer(), primary_key=True),
+        sa.Column('source', sa.String(), nullable=False),
+        sa.Column('message_id', sa.String(), nullable=True),
+        sa.Column('patient_id', sa.String(), nullable=True),
+        sa.Column('received_at', sa.DateTime(), nullable=False),
+        sa.Column('payload', sa.LargeBinary(), nullable=False),
+    )
+    op.create_index(op.f('ix_hl7_raw_message_message_id'), 'hl7_raw_message', ['message_id'])
+    op.create_index(op.f('ix_hl7_raw_message_patient_id'), 'hl7_raw_message', ['patient_id'])
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_index(op.f('ix_hl7_raw_message_patient_id'), table_name='hl7_raw_message')
+    op.drop_index(op.f('ix_hl7_raw_message_message_id'), table_name='hl7_raw_message')
+    op.drop_table('hl7_raw_message')
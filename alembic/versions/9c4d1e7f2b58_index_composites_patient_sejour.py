@@ -0,0 +1,42 @@
+"""Index composites pour les recherches par patient / séjour et le recensement
+
+Revision ID: 9c4d1e7f2b58
+Revises: 7b3e91c4d2a0
+Create Date: 2026-10-18 11:00:00.000000
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '9c4d1e7f2b58'
+down_revision: Union[str, None] = '7b3e91c4d2a0'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+# (nom, table, colonnes) — mêmes définitions que __table_args__ dans app/models.py.
+# Les colonnes de temps sont les colonnes typées : ce sont elles que filtrent et trient les endpoints.
+INDEXES = [
+    ('ix_wish_cbmrn_nsej_cltima_ts', 'hl7_message_wish', ['cbmrn', 'nsej', 'cltima_ts']),
+    ('ix_wish_clrs_cd_cltima_ts', 'hl7_message_wish', ['clrs_cd', 'cltima_ts']),
+    ('ix_orline_id_pat_id_sejour_date_message_ts', 'hl7_message_orline', ['id_pat', 'id_sejour', 'date_message_ts']),
+    ('ix_orline_message_type_date_message_ts', 'hl7_message_orline', ['message_type', 'date_message_ts']),
+]
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    # CONCURRENTLY : pas de verrou en écriture pendant la construction, l'ingestion continue
+    with op.get_context().autocommit_block():
+        for name, table, columns in INDEXES:
+            op.create_index(name, table, columns, postgresql_concurrently=True, if_not_exists=True)
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    with op.get_context().autocommit_block():
+        for name, table, _ in reversed(INDEXES):
+            op.drop_index(name, table_name=table, postgresql_concurrently=True, if_exists=True)
@@ -0,0 +1,37 @@
+"""Index inversé des identifiants PID-3 vers les messages bruts
+
+Revision ID: a4c7e2d9f315
+Revises: 8d1f4a6b2e90
+Create Date: 2026-10-18 16:00:00.000000
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'a4c7e2d9f315'
+down_revision: Union[str, None] = '8d1f4a6b2e90'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    op.create_table(
+        'hl7_patient_identifier',
+        sa.Column('id', sa.Integer(), primary_key=True),
+        sa.Column('identifier', sa.String(), nullable=False),
+        sa.Column('raw_id', sa.Integer(),
+                  sa.ForeignKey('hl7_raw_message.id', ondelete='CASCADE'), nullable=False),
+    )
+    op.create_index('ix_patient_identifier_identifier_raw_id', 'hl7_patient_identifier', ['identifier', 'raw_id'])
+    # Messages déjà conservés : python -m app.raw_store reindex
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_index('ix_patient_identifier_identifier_raw_id', table_name='hl7_patient_identifier')
+    op.drop_table('hl7_patient_identifier')
@@ -0,0 +1,48 @@
+"""Dimension patient : identifiant, premier / dernier message, sources
+
+Revision ID: b6e1d8c4a7f2
+Revises: a4c7e2d9f315
+Create Date: 2026-10-18 17:00:00.000000
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'b6e1d8c4a7f2'
+down_revision: Union[str, None] = 'a4c7e2d9f315'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    op.create_table(
+        'patient',
+        sa.Column('patient_id', sa.String(collation='C'), primary_key=True),
+        sa.Column('first_seen', sa.DateTime(), nullable=True),
+        sa.Column('last_seen', sa.DateTime(), nullable=True),
+        sa.Column('in_wish', sa.Boolean(), nullable=False, server_default=sa.false()),
+        sa.Column('in_orline', sa.Boolean(), nullable=False, server_default=sa.false()),
+    )
+    # Reprise de l'existant : union des deux tables de messages, agrégée par patient
+    op.execute("""
+        INSERT INTO patient (patient_id, first_seen, last_seen, in_wish, in_orline)
+        SELECT patient_id, min(ts), max(ts), bool_or(src = 'W'), bool_or(src = 'O')
+        FROM (
+            SELECT cbmrn AS patient_id, date_message_ts AS ts, 'W' AS src
+            FROM hl7_message_wish WHERE cbmrn IS NOT NULL AND cbmrn <> ''
+            UNION ALL
+            SELECT id_pat, date_message_ts, 'O'
+            FROM hl7_message_orline WHERE id_pat IS NOT NULL AND id_pat <> ''
+        ) AS messages
+        GROUP BY patient_id
+    """)
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_table('patient')
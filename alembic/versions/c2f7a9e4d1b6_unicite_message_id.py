@@ -0,0 +1,53 @@
+"""Unicité (source, message_id) : suppression des doublons existants
+
+Revision ID: c2f7a9e4d1b6
+Revises: b6e1d8c4a7f2
+Create Date: 2026-10-18 19:00:00.000000
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'c2f7a9e4d1b6'
+down_revision: Union[str, None] = 'b6e1d8c4a7f2'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    # Doublons laissés par les événements multiples : la première ligne reçue est gardée
+    op.execute("""
+        DELETE FROM hl7_message_wish a USING hl7_message_wish b
+        WHERE a.message_id = b.message_id AND a.id > b.id
+    """)
+    op.execute("""
+        DELETE FROM hl7_message_orline a USING hl7_message_orline b
+        WHERE a.message_id = b.message_id AND a.id > b.id
+    """)
+    # Les entrées d'index PID-3 des messages supprimés partent en cascade
+    op.execute("""
+        DELETE FROM hl7_raw_message a USING hl7_raw_message b
+        WHERE a.message_id = b.message_id AND a.source = b.source AND a.id > b.id
+    """)
+    op.create_index('uq_wish_message_id', 'hl7_message_wish', ['message_id'], unique=True)
+    op.create_index('uq_orline_message_id', 'hl7_message_orline', ['message_id'], unique=True)
+    op.create_index('uq_raw_message_message_id_source', 'hl7_raw_message', ['message_id', 'source'], unique=True)
+    op.drop_index('ix_hl7_raw_message_message_id', table_name='hl7_raw_message')
+
+    # Le recensement matérialisé comptait les doublons : recalcul complet à la prochaine lecture
+    op.execute("DELETE FROM census_hour")
+    op.execute("DELETE FROM census_snapshot")
+    op.execute("UPDATE census_state SET dirty_from = NULL, generation = generation + 1")
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.create_index('ix_hl7_raw_message_message_id', 'hl7_raw_message', ['message_id'])
+    op.drop_index('uq_raw_message_message_id_source', table_name='hl7_raw_message')
+    op.drop_index('uq_orline_message_id', table_name='hl7_message_orline')
+    op.drop_index('uq_wish_message_id', table_name='hl7_message_wish')
@@ -0,0 +1,36 @@
+"""Unicité de l'index message_id → fichier : suppression des doublons existants
+
+Revision ID: d8a3f1b5c7e2
+Revises: c2f7a9e4d1b6
+Create Date: 2026-10-18 21:00:00.000000
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'd8a3f1b5c7e2'
+down_revision: Union[str, None] = 'c2f7a9e4d1b6'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    # Copies ajoutées par chaque réimport des fichiers conservés : la première entrée est gardée
+    op.execute("""
+        DELETE FROM hl7_file_index a USING hl7_file_index b
+        WHERE a.message_id = b.message_id AND a.source = b.source AND a.path = b.path AND a.id > b.id
+    """)
+    op.create_index('uq_file_index_message_id_source_path', 'hl7_file_index',
+                    ['message_id', 'source', 'path'], unique=True)
+    op.drop_index('ix_hl7_file_index_message_id', table_name='hl7_file_index')
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.create_index('ix_hl7_file_index_message_id', 'hl7_file_index', ['message_id'])
+    op.drop_index('uq_file_index_message_id_source_path', table_name='hl7_file_index')
@@ -0,0 +1,33 @@
+"""Taille et mtime des fichiers indexés, pour sauter les fichiers déjà importés
+
+Revision ID: e4b9c2d7a1f3
+Revises: d8a3f1b5c7e2
+Create Date: 2026-10-18 23:30:00.000000
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'e4b9c2d7a1f3'
+down_revision: Union[str, None] = 'd8a3f1b5c7e2'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    # Entrées existantes sans signature : leurs fichiers seront relus une fois au prochain démarrage
+    op.add_column('hl7_file_index', sa.Column('size', sa.BigInteger(), nullable=True))
+    op.add_column('hl7_file_index', sa.Column('mtime_ns', sa.BigInteger(), nullable=True))
+    op.create_index('ix_hl7_file_index_path', 'hl7_file_index', ['path'])
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_index('ix_hl7_file_index_path', table_name='hl7_file_index')
+    op.drop_column('hl7_file_index', 'mtime_ns')
+    op.drop_column('hl7_file_index', 'size')
@@ -0,0 +1,50 @@
+"""Recensement horaire matérialisé : heures, snapshots et borne d'invalidation
+
+Revision ID: e5a8b3f61c27
+Revises: 9c4d1e7f2b58
+Create Date: 2026-10-18 12:00:00.000000
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'e5a8b3f61c27'
+down_revision: Union[str, None] = '9c4d1e7f2b58'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    op.create_table(
+        'census_hour',
+        sa.Column('hour', sa.DateTime(), primary_key=True),
+        sa.Column('total', sa.Integer(), nullable=False),
+        sa.Column('by_unit', sa.JSON(), nullable=False),
+    )
+    op.create_table(
+        'census_snapshot',
+        sa.Column('taken_at', sa.DateTime(), primary_key=True),
+        sa.Column('total', sa.Integer(), nullable=False),
+        sa.Column('by_unit', sa.JSON(), nullable=False),
+        sa.Column('stays', sa.JSON(), nullable=False),
+    )
+    census_state = op.create_table(
+        'census_state',
+        sa.Column('id', sa.Integer(), primary_key=True),
+        sa.Column('dirty_from', sa.DateTime(), nullable=True),
+        sa.Column('generation', sa.Integer(), nullable=False, server_default='0'),
+    )
+    # Ligne unique mise à jour par l'ingestion ; rien n'est calculé avant la première lecture
+    op.bulk_insert(census_state, [{'id': 1, 'dirty_from': None, 'generation': 0}])
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_table('census_state')
+    op.drop_table('census_snapshot')
+    op.drop_table('census_hour')
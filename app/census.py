@@ -0,0 +1,279 @@
+# app/census.py
+"""
+Recensement horaire des patients présents (total et par unité), matérialisé
+en base et tenu à jour de façon incrémentale :
+
+- census_hour : état à la fin de chaque heure déjà calculée ;
+- census_snapshot : état complet (séjours en cours compris) à chaque minuit,
+  point de reprise du rejeu ;
+- census_state : borne d'invalidation. L'ingestion y note l'horodatage du
+  plus ancien A01/A02/A03 qu'elle écrit ; au calcul suivant, les heures et
+  snapshots postérieurs sont jetés puis rejoués depuis le snapshot le plus
+  proche, au lieu de tout l'historique.
+"""
+
+import heapq
+from collections import defaultdict
+from datetime import datetime, timedelta
+from operator import itemgetter
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
+
+from sqlalchemy import case, func, update
+from sqlalchemy.orm import Session
+
+from app.models import HL7MessageWish, HL7MessageOrline, CensusHour, CensusSnapshot, CensusState
+
+ADT_CODES = ("A01", "A02", "A03")
+UNKNOWN_UNIT = "Inconnu"
+STATE_ID = 1
+# Lignes lues par aller-retour lors du rejeu
+REPLAY_FETCH_SIZE = 5000
+
+HOUR = timedelta(hours=1)
+DAY = timedelta(days=1)
+
+Event = Tuple[datetime, str, Tuple[str, str], str]
+
+
+def floor_hour(dt: datetime) -> datetime:
+    return dt.replace(minute=0, second=0, microsecond=0)
+
+
+def floor_day(dt: datetime) -> datetime:
+    return dt.replace(hour=0, minute=0, second=0, microsecond=0)
+
+
+class CensusReplay:
+    """État courant du recensement, modifié événement par événement."""
+
+    def __init__(self, total: int = 0, by_unit: Optional[Dict[str, int]] = None,
+                 stays: Optional[Dict[Tuple[str, str], str]] = None):
+        self.total = total
+        self.by_unit = defaultdict(int, by_unit or {})
+        self.stays = stays if stays is not None else {}
+
+    @classmethod
+    def from_snapshot(cls, snap: CensusSnapshot) -> "CensusReplay":
+        return cls(snap.total, snap.by_unit, {(pat, sej): unit for pat, sej, unit in snap.stays})
+
+    def to_snapshot(self, taken_at: datetime) -> CensusSnapshot:
+        return CensusSnapshot(
+            taken_at=taken_at,
+            total=self.total,
+            by_unit=self.units(),
+            stays=[[pat, sej, unit] for (pat, sej), unit in self.stays.items()],
+        )
+
+    def apply(self, code: str, key: Tuple[str, str], unit: str):
+        if code == "A01":
+            self.total += 1
+            self.by_unit[unit] += 1
+            self.stays[key] = unit
+        elif code == "A02" and key in self.stays:
+            self.by_unit[self.stays[key]] -= 1
+            self.by_unit[unit] += 1
+            self.stays[key] = unit
+        elif code == "A03" and key in self.stays:
+            self.total -= 1
+            self.by_unit[self.stays.pop(key)] -= 1
+
+    def units(self) -> Dict[str, int]:
+        return {u: cnt for u, cnt in self.by_unit.items() if cnt > 0}
+
+
+# --- Côté ingestion -------------------------------------------------------
+
+def earliest_event(wish_rows: Iterable[dict], orline_rows: Iterable[dict]) -> Optional[datetime]:
+    """Horodatage du plus ancien A01/A02/A03 d'un lot de lignes parsées."""
+    times = [r.get("cltima_ts") for r in wish_rows if r.get("clrs_cd") in ADT_CODES]
+    times += [r.get("date_message_ts") for r in orline_rows if r.get("message_type") in ADT_CODES]
+    times = [t for t in times if t is not None]
+    return min(times) if times else None
+
+
+def mark_dirty(db: Session, since: Optional[datetime]):
+    """
+    Invalide le recensement à partir de `since`, dans la transaction d'écriture
+    des messages. La génération incrémentée fait échouer l'enregistrement d'un
+    calcul concurrent qui n'aurait pas vu ces messages.
+    """
+    if since is None:
+        return
+    db.execute(
+        update(CensusState)
+        .where(CensusState.id == STATE_ID)
+        .values(
+            dirty_from=case(
+                (CensusState.dirty_from.is_(None), since),
+                (CensusState.dirty_from > since, since),
+                else_=CensusState.dirty_from,
+            ),
+            generation=CensusState.generation + 1,
+        )
+    )
+
+
+def init_state(db: Session):
+    """Crée la ligne census_state si besoin (base créée sans passer par Alembic)."""
+    if db.get(CensusState, STATE_ID) is None:
+        db.add(CensusState(id=STATE_ID, dirty_from=None, generation=0))
+        db.commit()
+
+
+def reset(db: Session):
+    """Vide le recensement matérialisé (tables de messages vidées)."""
+    db.query(CensusHour).delete(synchronize_session=False)
+    db.query(CensusSnapshot).delete(synchronize_session=False)
+    db.execute(
+        update(CensusState).where(CensusState.id == STATE_ID)
+        .values(dirty_from=None, generation=CensusState.generation + 1)
+    )
+
+
+# --- Côté lecture ---------------------------------------------------------
+
+def _events(db: Session, since: Optional[datetime], until: datetime) -> Iterator[Event]:
+    """A01/A02/A03 des deux sources dans [since, until[, triés en SQL puis fusionnés."""
+    W, O = HL7MessageWish, HL7MessageOrline
+    wish = (
+        db.query(W.cltima_ts, W.clrs_cd, W.cbmrn, W.nsej, W.clnsid)
+        .filter(W.clrs_cd.in_(ADT_CODES), W.cltima_ts < until)
+        .order_by(W.cltima_ts, W.id)
+    )
+    orline = (
+        db.query(O.date_message_ts, O.message_type, O.id_pat, O.id_sejour)
+        .filter(O.message_type.in_(ADT_CODES), O.date_message_ts < until)
+        .order_by(O.date_message_ts, O.id)
+    )
+    if since is not None:
+        wish = wish.filter(W.cltima_ts >= since)
+        orline = orline.filter(O.date_message_ts >= since)
+    return heapq.merge(
+        ((dt, code, (pat, sej), unit or UNKNOWN_UNIT)
+         for dt, code, pat, sej, unit in wish.yield_per(REPLAY_FETCH_SIZE)),
+        ((dt, code, (pat, sej), UNKNOWN_UNIT)
+         for dt, code, pat, sej in orline.yield_per(REPLAY_FETCH_SIZE)),
+        key=itemgetter(0),
+    )
+
+
+def _first_event_time(db: Session) -> Optional[datetime]:
+    times = [
+        db.query(func.min(HL7MessageWish.cltima_ts)).filter(HL7MessageWish.clrs_cd.in_(ADT_CODES)).scalar(),
+        db.query(func.min(HL7MessageOrline.date_message_ts)).filter(HL7MessageOrline.message_type.in_(ADT_CODES)).scalar(),
+    ]
+    times = [t for t in times if t is not None]
+    return min(times) if times else None
+
+
+def _replay(db: Session, first: datetime, last: datetime, dirty_from: Optional[datetime]):
+    """
+    Rejoue les événements depuis le snapshot valide le plus proche de `first`.
+    Retourne ({heure: (total, by_unit)} pour [first, last], snapshots de minuit
+    rencontrés en chemin).
+    """
+    snap_q = db.query(CensusSnapshot).filter(CensusSnapshot.taken_at <= first)
+    if dirty_from is not None:
+        snap_q = snap_q.filter(CensusSnapshot.taken_at <= dirty_from)
+    snap = snap_q.order_by(CensusSnapshot.taken_at.desc()).first()
+
+    if snap is not None:
+        state, since = CensusReplay.from_snapshot(snap), snap.taken_at
+        origin = since
+    else:
+        state, since = CensusReplay(), None
+        origin = _first_event_time(db) or first
+
+    until = last + HOUR
+    # Bornes où l'état est relevé : fin de chaque heure demandée et chaque minuit traversé
+    hour_ends = [first + i * HOUR for i in range(1, int((until - first) / HOUR) + 1)]
+    midnight = since + DAY if since is not None else floor_day(origin)
+    now = datetime.now()
+    midnights = []
+    while midnight <= min(until, now):
+        midnights.append(midnight)
+        midnight += DAY
+    marks = sorted(set(hour_ends) | set(midnights))
+    midnight_set = set(midnights)
+    hour_end_set = set(hour_ends)
+
+    hours: Dict[datetime, Tuple[int, Dict[str, int]]] = {}
+    snapshots: List[CensusSnapshot] = []
+    i = 0
+
+    def record(mark: datetime):
+        if mark in hour_end_set:
+            hours[mark - HOUR] = (state.total, state.units())
+        if mark in midnight_set:
+            snapshots.append(state.to_snapshot(mark))
+
+    for dt, code, key, unit in _events(db, since, until):
+        while i < len(marks) and dt >= marks[i]:
+            record(marks[i])
+            i += 1
+        state.apply(code, key, unit)
+    while i < len(marks):
+        record(marks[i])
+        i += 1
+    return hours, snapshots
+
+
+def _save(db: Session, generation: int, dirty_from: Optional[datetime],
+          hours: Dict[datetime, Tuple[int, Dict[str, int]]], snapshots: List[CensusSnapshot]) -> bool:
+    """
+    Enregistre un calcul si aucune ingestion n'a eu lieu entre-temps.
+    La mise à jour conditionnelle de census_state verrouille la ligne : deux
+    calculs concurrents s'enregistrent l'un après l'autre, sans conflit de clé.
+    """
+    claimed = db.execute(
+        update(CensusState)
+        .where(CensusState.id == STATE_ID, CensusState.generation == generation)
+        .values(dirty_from=None)
+    ).rowcount
+    if not claimed:
+        db.rollback()
+        return False
+
+    if dirty_from is not None:
+        db.query(CensusHour).filter(CensusHour.hour >= floor_hour(dirty_from)).delete(synchronize_session=False)
+        db.query(CensusSnapshot).filter(CensusSnapshot.taken_at > dirty_from).delete(synchronize_session=False)
+    if hours:
+        db.query(CensusHour).filter(
+            CensusHour.hour >= min(hours), CensusHour.hour <= max(hours)
+        ).delete(synchronize_session=False)
+    if snapshots:
+        db.query(CensusSnapshot).filter(
+            CensusSnapshot.taken_at.in_([s.taken_at for s in snapshots])
+        ).delete(synchronize_session=False)
+
+    db.add_all(CensusHour(hour=h, total=total, by_unit=units) for h, (total, units) in hours.items())
+    db.add_all(snapshots)
+    db.commit()
+    return True
+
+
+def hourly_counts(db: Session, first: datetime, last: datetime) -> Dict[datetime, Tuple[int, Dict[str, int]]]:
+    """
+    État du recensement à la fin de chaque heure de [first, last] (heures pleines).
+    Les heures déjà matérialisées et valides sont lues telles quelles ; les autres
+    sont rejouées depuis le snapshot le plus proche puis enregistrées.
+    """
+    init_state(db)
+    state = db.get(CensusState, STATE_ID)
+    generation, dirty_from = state.generation, state.dirty_from
+
+    stored_q = db.query(CensusHour).filter(CensusHour.hour >= first, CensusHour.hour <= last)
+    if dirty_from is not None:
+        stored_q = stored_q.filter(CensusHour.hour < floor_hour(dirty_from))
+    result = {row.hour: (row.total, row.by_unit) for row in stored_q}
+
+    n_hours = int((last - first) / HOUR) + 1
+    missing = [first + i * HOUR for i in range(n_hours) if first + i * HOUR not in result]
+    if not missing and dirty_from is None:
+        db.rollback()
+        return result
+
+    hours, snapshots = _replay(db, missing[0], last, dirty_from) if missing else ({}, [])
+    result.update(hours)
+    _save(db, generation, dirty_from, hours, snapshots)
+    return result
@@ -1,51 +1,133 @@
 # app/crud.py
 
+from collections import Counter
+from typing import Iterable, List, NamedTuple, Optional, Tuple
+
 from sqlalchemy.orm import Session
 from app.models import HL7MessageWish, HL7MessageOrline
+from app.raw_store import RawPayload, pack, raw_row, insert_raw
+from app.file_index import new_file_entries
 from app.parsing_details_orline import parse_details_hl7_orline_specific
-from app.parsing_details_wish import parse_details_hl7_wish_specific
-from sqlalchemy import inspect
-from sqlalchemy.exc import InvalidRequestError
+from app.parsing_details_wish import parse_details_hl7_wish_specific, parse_wish_message
+from app.hl7_splitter import split_messages
+from sqlalchemy import inspect, insert
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from app.census import earliest_event, mark_dirty
+from app.patients import record_patients
+from app.timeline_cache import patient_ids, timeline_cache
 
 
-def create_wish_message(db: Session, hl7_raw_message: str) -> HL7MessageWish:
-    parsed_data_list = parse_details_hl7_wish_specific(hl7_raw_message)
-    last_msg = None
-    for parsed_data in parsed_data_list:
-        db_message = HL7MessageWish(
-            **parsed_data  
-        )
-        db.add(db_message)
-        db.flush()
-        try:
-            db.refresh(db_message)
-        except InvalidRequestError:
-            db_message = db.query(HL7MessageWish).get(db_message.id)
-        last_msg = db_message
-    db.commit()
-    return last_msg
+# Nombre max de lignes par INSERT (PostgreSQL limite à 65535 paramètres)
+INSERT_CHUNK_SIZE = 1000
+ORLINE_COLUMNS = frozenset(col.key for col in inspect(HL7MessageOrline).columns)
 
-def create_orline_message(db: Session, hl7_raw_message: str)-> HL7MessageOrline:
-    parsed = parse_details_hl7_orline_specific(hl7_raw_message)
+class ParsedMessage(NamedTuple):
+    """Un message d'un fichier : ses lignes, son offset dans le fichier, son brut préparé."""
+    rows: list
+    offset: int
+    payload: Optional[RawPayload]
+
+def parse_wish_rows(hl7_raw_message: str) -> list:
+    """Parse un message (ou un lot de messages) WISH en lignes prêtes pour l'insertion."""
+    return parse_details_hl7_wish_specific(hl7_raw_message)
+
+def _orline_row(hl7_message: str) -> dict:
+    parsed = parse_details_hl7_orline_specific(hl7_message)
+    return {k: v for k, v in parsed.items() if k in ORLINE_COLUMNS}
+
+def parse_orline_rows(hl7_raw_message: str) -> list:
+    """Parse un message (ou un lot de messages) ORLine en lignes limitées aux colonnes de la table."""
+    return [_orline_row(message) for _, message in split_messages(hl7_raw_message)]
 
-    mapper = inspect(HL7MessageOrline)
-    valid_cols = {col.key for col in mapper.columns}
+def parse_rows(source: str, hl7_raw_message: str) -> list:
+    if source == "WISH":
+        return parse_wish_rows(hl7_raw_message)
+    return parse_orline_rows(hl7_raw_message)
 
-    # Keep only those keys that map to actual DB columns
-    filtered_data = {k: v for k, v in parsed.items() if k in valid_cols}
+def parse_messages(source: str, messages: Iterable[Tuple[int, str]], with_payload: bool = True) -> List[ParsedMessage]:
+    """
+    Parse les messages (offset, texte) d'un découpage (app/hl7_splitter.py) ;
+    `with_payload` prépare aussi le brut compressé de chacun (raw_store.pack).
+    """
+    parse = parse_wish_message if source == "WISH" else _orline_row
+    return [
+        ParsedMessage([parse(text)], offset, pack(text) if with_payload else None)
+        for offset, text in messages
+    ]
 
-    db_message = HL7MessageOrline(**filtered_data)
-    db.add(db_message)
+def _insert_new(model):
+    """INSERT qui ignore les message_id déjà présents (index unique du modèle)."""
+    return pg_insert(model).on_conflict_do_nothing(index_elements=["message_id"])
 
-    # Flush to assign PK
-    db.flush()
+def _inserted(rows: list, message_ids: Iterable[Optional[str]]) -> list:
+    """Lignes de `rows` réellement insérées, d'après les message_id rendus par RETURNING."""
+    remaining = Counter(message_ids)
+    kept = []
+    for row in rows:
+        mid = row.get("message_id")
+        if remaining[mid]:
+            remaining[mid] -= 1
+            kept.append(row)
+    return kept
 
-    # Refresh or re-query if detached
-    try:
-        db.refresh(db_message)
-    except InvalidRequestError:
-        db_message = db.query(HL7MessageOrline).get(db_message.id)
+def bulk_create_messages(db: Session, wish_rows: list, orline_rows: list, file_rows: list = (),
+                         raw_rows: list = ()) -> Tuple[list, list]:
+    """
+    Insère un lot de lignes WISH/ORLine avec un INSERT multi-lignes par table,
+    les entrées d'index message_id → fichier des fichiers conservés et les
+    messages bruts compressés. Les message_id déjà présents sont ignorés
+    (ON CONFLICT DO NOTHING) : rejouer un lot ne crée pas de doublon.
+    Retourne les lignes (WISH, ORLine) réellement insérées : seules elles
+    mettent à jour les patients et invalident le recensement ; à l'appelant
+    d'en invalider le cache des parcours. Le commit reste à la charge de
+    l'appelant (un seul commit par lot).
+    """
+    inserted = []
+    for model, rows in ((HL7MessageWish, wish_rows), (HL7MessageOrline, orline_rows)):
+        new_rows = []
+        for i in range(0, len(rows), INSERT_CHUNK_SIZE):
+            chunk = rows[i:i + INSERT_CHUNK_SIZE]
+            message_ids = db.execute(_insert_new(model).values(chunk).returning(model.message_id)).scalars()
+            new_rows.extend(_inserted(chunk, message_ids))
+        inserted.append(new_rows)
+    wish_new, orline_new = inserted
+    # Un même fichier peut figurer deux fois dans le lot : ON CONFLICT DO UPDATE
+    # refuse de mettre à jour deux fois la même entrée, la dernière l'emporte
+    file_rows = list({(row["message_id"], row["source"], row["path"]): row for row in file_rows}.values())
+    for i in range(0, len(file_rows), INSERT_CHUNK_SIZE):
+        db.execute(new_file_entries().values(file_rows[i:i + INSERT_CHUNK_SIZE]))
+    insert_raw(db, list(raw_rows))
+    record_patients(db, wish_new, orline_new)
+    # Invalide le recensement matérialisé dans la même transaction
+    mark_dirty(db, earliest_event(wish_new, orline_new))
+    return wish_new, orline_new
 
-    # Commit the transaction
+
+def _create_messages(db: Session, source: str, hl7_raw_message: str) -> list:
+    """
+    Insère tous les messages du texte (un fichier peut en porter un lot) :
+    un seul INSERT ... RETURNING pour les lignes, puis les messages bruts.
+    Retourne les lignes créées (sans les message_id déjà présents).
+    """
+    model = HL7MessageWish if source == "WISH" else HL7MessageOrline
+    messages = parse_messages(source, split_messages(hl7_raw_message))
+    rows = [row for message in messages for row in message.rows]
+    created = db.scalars(_insert_new(model).returning(model), rows).all() if rows else []
+    insert_raw(db, [raw_row(source, message.rows, message.payload) for message in messages])
+    # Doublons ignorés par la base : ni patients, ni recensement, ni cache à mettre à jour
+    new_rows = _inserted(rows, (row.message_id for row in created))
+    wish_rows, orline_rows = (new_rows, []) if source == "WISH" else ([], new_rows)
+    record_patients(db, wish_rows, orline_rows)
+    mark_dirty(db, earliest_event(wish_rows, orline_rows))
     db.commit()
-    return db_message
\ No newline at end of file
+    timeline_cache.invalidate(patient_ids(wish_rows, orline_rows))
+    return created
+
+
+def create_wish_message(db: Session, hl7_raw_message: str) -> HL7MessageWish:
+    created = _create_messages(db, "WISH", hl7_raw_message)
+    return created[-1] if created else None
+
+def create_orline_message(db: Session, hl7_raw_message: str)-> HL7MessageOrline:
+    created = _create_messages(db, "ORLine", hl7_raw_message)
+    return created[-1] if created else None
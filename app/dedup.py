@@ -0,0 +1,57 @@
+# app/dedup.py
+"""
+Filtres en mémoire des doublons récents, avant tout travail en base.
+
+Un même fichier peut être signalé plusieurs fois (création, modification,
+déplacement) et un même message renvoyé par le moteur d'interface.
+L'unicité (source, message_id) en base reste la garantie (INSERT ... ON
+CONFLICT DO NOTHING) ; ces filtres évitent seulement de relire, parser et
+réinsérer ce qui vient d'être traité.
+"""
+
+import os
+import threading
+from collections import OrderedDict
+from typing import Hashable, Iterable
+
+# Fichiers (chemin, taille, mtime) déjà pris en charge / messages (source, message_id) déjà commités
+RECENT_FILES = int(os.getenv("HL7_RECENT_FILES", "10000"))
+RECENT_MESSAGE_IDS = int(os.getenv("HL7_RECENT_MESSAGE_IDS", "100000"))
+
+
+class RecentKeys:
+    """Ensemble borné des dernières clés vues (les plus anciennes sont oubliées)."""
+
+    def __init__(self, maxsize: int):
+        self.maxsize = maxsize
+        self._keys: "OrderedDict[Hashable, None]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __contains__(self, key: Hashable) -> bool:
+        with self._lock:
+            return key in self._keys
+
+    def add(self, key: Hashable) -> bool:
+        """Ajoute `key` ; False si elle était déjà présente."""
+        with self._lock:
+            if key in self._keys:
+                self._keys.move_to_end(key)
+                return False
+            self._keys[key] = None
+            self._trim()
+            return True
+
+    def update(self, keys: Iterable[Hashable]):
+        with self._lock:
+            for key in keys:
+                self._keys[key] = None
+                self._keys.move_to_end(key)
+            self._trim()
+
+    def __len__(self) -> int:
+        with self._lock:
+            return len(self._keys)
+
+    def _trim(self):
+        while len(self._keys) > self.maxsize:
+            self._keys.popitem(last=False)
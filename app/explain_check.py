@@ -0,0 +1,139 @@
+# app/explain_check.py
+"""
+Vérifie avec EXPLAIN que les requêtes des endpoints patient / séjour et du
+recensement passent par les index composites déclarés dans app/models.py.
+
+    python -m app.explain_check [--patient ID] [--sejour ID] [--natural]
+
+Par défaut les parcours séquentiels sont désactivés (enable_seqscan = off)
+pour vérifier que l'index est utilisable même sur une base de test presque
+vide ; --natural laisse le planificateur choisir, comme en production.
+Code de sortie 1 si une requête n'utilise aucun des index attendus.
+"""
+
+import sys
+import argparse
+from datetime import datetime, timedelta
+from typing import Iterator, List, Set, Tuple
+
+from sqlalchemy.orm import Session, Query
+
+from app.database import SessionLocal
+from app.models import HL7MessageWish, HL7MessageOrline
+
+WISH_PATIENT_IX = "ix_wish_cbmrn_nsej_cltima_ts"
+WISH_EVENT_IX = "ix_wish_clrs_cd_cltima_ts"
+ORLINE_PATIENT_IX = "ix_orline_id_pat_id_sejour_date_message_ts"
+ORLINE_EVENT_IX = "ix_orline_message_type_date_message_ts"
+
+ADT_CODES = ["A01", "A02", "A03"]
+
+
+def endpoint_queries(db: Session, id_pat: str, id_sejour: str) -> List[Tuple[str, Query, Set[str]]]:
+    """(libellé, requête telle qu'émise par l'endpoint, index acceptés)."""
+    W, O = HL7MessageWish, HL7MessageOrline
+    window_end = datetime.now() + timedelta(days=1)
+    return [
+        ("/patient/{id_pat}/sejours [WISH]",
+         db.query(W.nsej).filter(W.cbmrn == id_pat, W.nsej.isnot(None)).distinct(),
+         {WISH_PATIENT_IX}),
+        ("/patient/{id_pat}/sejours [ORLine]",
+         db.query(O.id_sejour).filter(O.id_pat == id_pat, O.id_sejour.isnot(None)).distinct(),
+         {ORLINE_PATIENT_IX}),
+        ("/messages-by-patient/{patient_id} [WISH]",
+         db.query(W).filter(W.cbmrn == id_pat),
+         {WISH_PATIENT_IX}),
+        ("/messages-by-patient/{patient_id} [ORLine]",
+         db.query(O).filter(O.id_pat == id_pat),
+         {ORLINE_PATIENT_IX}),
+        ("/messages-by-patient-sejour [WISH]",
+         db.query(W).filter(W.cbmrn == id_pat, W.nsej == id_sejour),
+         {WISH_PATIENT_IX}),
+        ("/messages-by-patient-sejour [ORLine]",
+         db.query(O).filter(O.id_pat == id_pat, O.id_sejour == id_sejour),
+         {ORLINE_PATIENT_IX}),
+        ("/journey/full/{id_pat}/{id_sejour} [WISH]",
+         db.query(W).filter(W.cbmrn == id_pat, W.nsej == id_sejour)
+         .order_by(W.clfrom_ts, W.date_message_ts),
+         {WISH_PATIENT_IX}),
+        ("/journey/full/{id_pat}/{id_sejour} [ORLine]",
+         db.query(O).filter(O.id_pat == id_pat, O.id_sejour == id_sejour)
+         .order_by(O.date_message_ts),
+         {ORLINE_PATIENT_IX}),
+        ("/patient-journey-gantt/{id_pat} [WISH]",
+         db.query(W).filter(W.cbmrn == id_pat, W.clrs_cd.in_(ADT_CODES), W.cltima_ts.isnot(None))
+         .order_by(W.cltima_ts, W.id),
+         {WISH_PATIENT_IX, WISH_EVENT_IX}),
+        ("/tableaudebord/patient-counts-advanced-v2 [WISH]",
+         db.query(W.cltima_ts, W.clrs_cd, W.cbmrn, W.nsej, W.clnsid)
+         .filter(W.clrs_cd.in_(ADT_CODES), W.cltima_ts < window_end)
+         .order_by(W.cltima_ts, W.id),
+         {WISH_EVENT_IX}),
+        ("/tableaudebord/patient-counts-advanced-v2 [ORLine]",
+         db.query(O.date_message_ts, O.message_type, O.id_pat, O.id_sejour)
+         .filter(O.message_type.in_(ADT_CODES), O.date_message_ts < window_end)
+         .order_by(O.date_message_ts, O.id),
+         {ORLINE_EVENT_IX}),
+    ]
+
+
+def explain(db: Session, query: Query) -> dict:
+    # Listes de IN (...) développées en paramètres individuels : le SQL envoyé tel quel
+    # au driver ne doit plus contenir de marqueurs POSTCOMPILE
+    compiled = query.statement.compile(dialect=db.bind.dialect, compile_kwargs={"render_postcompile": True})
+    result = db.connection().exec_driver_sql(f"EXPLAIN (FORMAT JSON) {compiled}", compiled.params)
+    return result.scalar()[0]["Plan"]
+
+
+def plan_nodes(plan: dict) -> Iterator[dict]:
+    yield plan
+    for child in plan.get("Plans", []):
+        yield from plan_nodes(child)
+
+
+def sample_ids(db: Session) -> Tuple[str, str]:
+    """Un couple (patient, séjour) réel, pour que le planificateur estime des sélectivités réalistes."""
+    row = (
+        db.query(HL7MessageWish.cbmrn, HL7MessageWish.nsej)
+        .filter(HL7MessageWish.cbmrn.isnot(None), HL7MessageWish.nsej.isnot(None))
+        .first()
+    )
+    return (row[0], row[1]) if row else ("0", "0")
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="Vérifie l'usage des index composites via EXPLAIN.")
+    parser.add_argument("--patient", help="ID patient utilisé dans les requêtes (défaut : un patient en base)")
+    parser.add_argument("--sejour", help="ID séjour utilisé dans les requêtes (défaut : un séjour en base)")
+    parser.add_argument("--natural", action="store_true",
+                        help="ne pas désactiver les parcours séquentiels (plans de production)")
+    args = parser.parse_args(argv)
+
+    db = SessionLocal()
+    try:
+        id_pat, id_sejour = sample_ids(db)
+        id_pat, id_sejour = args.patient or id_pat, args.sejour or id_sejour
+        if not args.natural:
+            db.connection().exec_driver_sql("SET LOCAL enable_seqscan = off")
+
+        failures = 0
+        for label, query, expected in endpoint_queries(db, id_pat, id_sejour):
+            nodes = list(plan_nodes(explain(db, query)))
+            used = {n["Index Name"] for n in nodes if "Index Name" in n}
+            seq = sorted({n["Relation Name"] for n in nodes if n["Node Type"] == "Seq Scan"})
+            ok = bool(used & expected)
+            failures += not ok
+            detail = ", ".join(sorted(used)) or "aucun index"
+            if seq:
+                detail += f" ; Seq Scan sur {', '.join(seq)}"
+            print(f"{'OK  ' if ok else 'FAIL'} {label}: {detail}")
+
+        print(f"{failures} requête(s) sans index attendu" if failures else "Tous les endpoints utilisent leurs index")
+        return 1 if failures else 0
+    finally:
+        db.rollback()
+        db.close()
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,299 @@
+# app/export.py
+"""
+Moteur d'export des messages WISH / ORLine à mémoire bornée.
+
+Les lignes sont lues par curseur serveur, déjà triées par la base, et écrites
+au fil de l'eau :
+- xlsx : xlsxwriter en mode constant_memory vers un fichier temporaire,
+  renvoyé ensuite par blocs ; la feuille des pré-admissions (A05) relit le
+  message brut conservé en base (app/raw_store.py), ou à défaut le fichier
+  d'origine via l'index message_id → fichier (app/file_index.py) ;
+- csv : une table, envoyée pendant la lecture (premier octet immédiat) ;
+- parquet : une table, par groupes de lignes (pyarrow, optionnel).
+"""
+
+import io
+import os
+import csv
+import tempfile
+import itertools
+from datetime import date, datetime, timedelta
+from typing import Callable, Dict, Iterator, List, Optional
+
+import xlsxwriter
+from fastapi import HTTPException
+from fastapi.responses import StreamingResponse
+from sqlalchemy import select
+from sqlalchemy.orm import Session
+
+from app.database import SessionLocal
+from app.models import HL7MessageWish, HL7MessageOrline
+from app.transfers import collapse_unit_transfers
+from app import file_index, raw_store
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:  # export parquet indisponible
+    pa = pq = None
+
+EXPORT_FORMATS = ("xlsx", "csv", "parquet")
+EXPORT_TABLES = ("wish", "orline")
+# Lignes lues par aller-retour / écrites par bloc csv ou groupe parquet
+EXPORT_FETCH_SIZE = 2000
+# Taille des blocs envoyés au client pour un fichier déjà écrit
+FILE_CHUNK_SIZE = 1024 * 1024
+
+XLSX_MEDIA_TYPE = "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
+MEDIA_TYPES = {"xlsx": XLSX_MEDIA_TYPE, "csv": "text/csv; charset=utf-8", "parquet": "application/vnd.apache.parquet"}
+
+WISH_CODES = {"A01": "A", "A02": "T", "A03": "D"}
+WISH_COLUMNS = [
+    "clrs_cd", "nsej", "cbmrn", "cbtype", "cbadty", "tsv", "clfrom",
+    "clnsid", "nsdscr", "clroom", "clbed", "clsvtc", "tectxtfr",
+    "cldept", "nrpr", "nomm", "cltima"
+]
+ORLINE_COLUMNS = [
+    "date_message", "message_type", "message_id", "id_pat", "id_sejour",
+    "id_ope", "heu_deb_ope_prev", "heu_fin_ope_prev", "tps_ope_prev",
+    "type_ope", "date_ope", "id_sal_ope", "arr_sal_ope", "anesth",
+    "discip", "chir", "planning", "naissance", "sexe"
+]
+DATETIME_COLUMNS = {"clfrom", "date_message"}
+PREADMISSION_SHEET = "Pré-admissions"
+PREADMISSION_COLUMNS = [
+    "MRN", "Date admission", "Unité Ch. Lit", "N° admission", "Service",
+    "Méd.", "T. adm.", "Sour.", "Adm_Ent", "Adm_Sor"
+]
+
+def _window(start: Optional[date], end: Optional[date]):
+    lo = datetime.combine(start, datetime.min.time()) if start else None
+    hi = datetime.combine(end + timedelta(days=1), datetime.min.time()) if end else None
+    return lo, hi
+
+
+def wish_rows(db: Session, units: Dict[str, str], start: Optional[date] = None,
+              end: Optional[date] = None) -> Iterator[dict]:
+    """
+    Mouvements A01/A02/A03 des unités connues, triés par (patient, séjour,
+    unité, clfrom) en SQL ; les transferts en double sont fusionnés par lots
+    de groupes complets d'environ EXPORT_FETCH_SIZE lignes.
+    """
+    W = HL7MessageWish
+    query = (
+        db.query(W.id, W.clrs_cd, W.nsej, W.cbmrn, W.cbtype, W.cbadty, W.tsv, W.clfrom_ts,
+                 W.clnsid, W.clroom, W.clbed, W.clsvtc, W.tectxtfr, W.cldept, W.nrpr, W.nomm, W.cltima)
+        .filter(W.clrs_cd.in_(list(WISH_CODES)), W.clnsid.in_(list(units)))
+        # NULL en dernier, comme le tri pandas de l'ancien export (et le défaut PostgreSQL)
+        .order_by(W.cbmrn.nulls_last(), W.nsej.nulls_last(), W.clnsid, W.clfrom_ts.nulls_last(), W.id)
+    )
+    lo, hi = _window(start, end)
+    if lo is not None:
+        query = query.filter(W.clfrom_ts >= lo)
+    if hi is not None:
+        query = query.filter(W.clfrom_ts < hi)
+
+    rows = (
+        {
+            "id": r.id, "clrs_cd": WISH_CODES[r.clrs_cd], "nsej": r.nsej, "cbmrn": r.cbmrn,
+            "cbtype": r.cbtype, "cbadty": r.cbadty, "tsv": r.tsv, "clfrom": r.clfrom_ts,
+            "clnsid": r.clnsid, "nsdscr": units.get(r.clnsid, ""), "clroom": r.clroom,
+            "clbed": r.clbed, "clsvtc": r.clsvtc, "tectxtfr": r.tectxtfr, "cldept": r.cldept,
+            "nrpr": r.nrpr, "nomm": r.nomm, "cltima": r.cltima,
+        }
+        for r in query.yield_per(EXPORT_FETCH_SIZE)
+    )
+    batch: List[dict] = []
+    for _, group in itertools.groupby(rows, key=lambda r: (r["cbmrn"], r["nsej"], r["clnsid"])):
+        batch.extend(group)
+        if len(batch) >= EXPORT_FETCH_SIZE:
+            yield from collapse_unit_transfers(batch)
+            batch = []
+    yield from collapse_unit_transfers(batch)
+
+
+def orline_rows(db: Session, units: Dict[str, str] = None, start: Optional[date] = None,
+                end: Optional[date] = None) -> Iterator[dict]:
+    """Messages ORLine triés par (patient, date du message) en SQL."""
+    O = HL7MessageOrline
+    columns = [getattr(O, c) for c in ORLINE_COLUMNS if c != "date_message"]
+    query = db.query(O.date_message_ts, *columns).order_by(
+        O.id_pat.nulls_last(), O.date_message_ts.nulls_last(), O.id
+    )
+    lo, hi = _window(start, end)
+    if lo is not None:
+        query = query.filter(O.date_message_ts >= lo)
+    if hi is not None:
+        query = query.filter(O.date_message_ts < hi)
+    for r in query.yield_per(EXPORT_FETCH_SIZE):
+        row = dict(zip(ORLINE_COLUMNS[1:], r[1:]))
+        row["date_message"] = r[0]
+        yield row
+
+
+def _strip_prefix(nsej: str) -> str:
+    return nsej[1:] if nsej.startswith("1") else nsej
+
+
+def preadmission_rows(db: Session) -> Iterator[list]:
+    """
+    Pré-admissions (A05). Le N° d'admission manquant (PV1-6) et la source
+    d'admission (PV1-14) sont lus dans le message brut : en base, ou dans le
+    fichier d'origine pour les messages ingérés avant leur conservation.
+    Une recherche indexée par lot de EXPORT_FETCH_SIZE messages.
+    """
+    W = HL7MessageWish
+    stmt = (
+        select(W.message_id, W.cbmrn, W.clfrom, W.clnsid, W.nsej, W.cldept, W.nomm, W.cbadty)
+        .where(W.clrs_cd == "A05")
+        .order_by(W.id)
+        .execution_options(yield_per=EXPORT_FETCH_SIZE)
+    )
+    for batch in db.execute(stmt).partitions():
+        raws = raw_store.lookup(db, (r.message_id for r in batch))
+        files = file_index.lookup(db, (r.message_id for r in batch if r.message_id not in raws))
+        for r in batch:
+            nsej, sour = r.nsej, None
+            raw = raws.get(r.message_id)
+            if raw is None and r.message_id in files:
+                raw = file_index.read_message(*files[r.message_id])
+            if raw:
+                pv1 = file_index.pv1_fields(raw)
+                if not nsej and len(pv1) > 6 and pv1[6]:
+                    nsej = _strip_prefix(pv1[6].strip())
+                if len(pv1) > 14:
+                    sour = pv1[14].strip() or None
+            adm_ent = "UAPO" if sour == "O" else "HOSP"
+            adm_sor = {"A": "HOSP", "Z": "HDJ"}.get(r.cbadty, "")
+            yield [r.cbmrn, r.clfrom, r.clnsid, nsej, r.cldept, r.nomm, r.cbadty, sour, adm_ent, adm_sor]
+
+
+SOURCES: Dict[str, tuple] = {
+    # table: (feuille xlsx, colonnes, générateur de lignes)
+    "wish": ("Wish Messages", WISH_COLUMNS, wish_rows),
+    "orline": ("Orline Messages", ORLINE_COLUMNS, orline_rows),
+}
+
+
+def write_xlsx(db: Session, path: str, units: Dict[str, str], start: Optional[date] = None,
+               end: Optional[date] = None):
+    """
+    Classeur WISH / ORLine (+ pré-admissions s'il y en a), écrit ligne à ligne
+    (constant_memory : une ligne en mémoire).
+    """
+    workbook = xlsxwriter.Workbook(path, {"constant_memory": True})
+    try:
+        header_fmt = workbook.add_format({"bold": True, "border": 1, "align": "center", "valign": "top"})
+        datetime_fmt = workbook.add_format({"num_format": "yyyy-mm-dd hh:mm:ss"})
+        for table in EXPORT_TABLES:
+            sheet_name, columns, rows = SOURCES[table]
+            sheet = workbook.add_worksheet(sheet_name)
+            sheet.write_row(0, 0, columns, header_fmt)
+            dt_cols = [i for i, c in enumerate(columns) if c in DATETIME_COLUMNS]
+            for r, row in enumerate(rows(db, units, start, end), start=1):
+                values = [row[c] for c in columns]
+                for i in dt_cols:
+                    dt, values[i] = values[i], None
+                    if dt is not None:
+                        sheet.write_datetime(r, i, dt, datetime_fmt)
+                sheet.write_row(r, 0, values)
+
+        preadmissions = preadmission_rows(db)
+        first = next(preadmissions, None)
+        if first is not None:
+            sheet = workbook.add_worksheet(PREADMISSION_SHEET)
+            sheet.write_row(0, 0, PREADMISSION_COLUMNS, header_fmt)
+            for r, row in enumerate(itertools.chain([first], preadmissions), start=1):
+                sheet.write_row(r, 0, row)
+    finally:
+        workbook.close()
+
+
+def write_parquet(db: Session, path: str, table: str, units: Dict[str, str],
+                  start: Optional[date] = None, end: Optional[date] = None):
+    """Une table en parquet, un groupe de lignes par EXPORT_FETCH_SIZE lignes."""
+    _, columns, rows = SOURCES[table]
+    schema = pa.schema([
+        (c, pa.timestamp("s") if c in DATETIME_COLUMNS else pa.string()) for c in columns
+    ])
+    with pq.ParquetWriter(path, schema) as writer:
+        it = rows(db, units, start, end)
+        while True:
+            batch = list(itertools.islice(it, EXPORT_FETCH_SIZE))
+            if not batch:
+                break
+            writer.write_table(pa.Table.from_pylist([{c: row[c] for c in columns} for row in batch], schema=schema))
+
+
+def _csv_value(value):
+    if isinstance(value, datetime):
+        return value.strftime("%Y-%m-%d %H:%M:%S")
+    return value
+
+
+def csv_chunks(table: str, units: Dict[str, str], start: Optional[date] = None,
+               end: Optional[date] = None) -> Iterator[bytes]:
+    """CSV envoyé pendant la lecture, par blocs de EXPORT_FETCH_SIZE lignes."""
+    _, columns, rows = SOURCES[table]
+    buf = io.StringIO()
+    writer = csv.writer(buf)
+    writer.writerow(columns)
+    # Session propre au flux : celle de la requête est fermée avant la fin de l'envoi
+    db = SessionLocal()
+    try:
+        for n, row in enumerate(rows(db, units, start, end), start=1):
+            writer.writerow([_csv_value(row[c]) for c in columns])
+            if n % EXPORT_FETCH_SIZE == 0:
+                yield buf.getvalue().encode("utf-8")
+                buf.seek(0)
+                buf.truncate()
+        yield buf.getvalue().encode("utf-8")
+    finally:
+        db.close()
+
+
+def file_chunks(path: str) -> Iterator[bytes]:
+    """Envoie un fichier temporaire par blocs puis le supprime."""
+    try:
+        with open(path, "rb") as f:
+            while chunk := f.read(FILE_CHUNK_SIZE):
+                yield chunk
+    finally:
+        os.remove(path)
+
+
+def _to_temp_file(suffix: str, write: Callable[[str], None]) -> str:
+    fd, path = tempfile.mkstemp(prefix="hl7_export_", suffix=suffix)
+    os.close(fd)
+    try:
+        write(path)
+    except Exception:
+        os.remove(path)
+        raise
+    return path
+
+
+def export_messages(db: Session, fmt: str, table: str, units: Dict[str, str],
+                    start: Optional[date] = None, end: Optional[date] = None,
+                    filename: str = "hl7_messages_export") -> StreamingResponse:
+    """Réponse d'export au format `fmt` ; `table` ne sert qu'aux formats mono-table (csv, parquet)."""
+    if fmt not in EXPORT_FORMATS:
+        raise HTTPException(status_code=400, detail=f"Format d'export inconnu : {fmt}")
+    if table not in EXPORT_TABLES:
+        raise HTTPException(status_code=400, detail=f"Table inconnue : {table}")
+
+    if fmt == "xlsx":
+        path = _to_temp_file(".xlsx", lambda p: write_xlsx(db, p, units, start, end))
+        body = file_chunks(path)
+    elif fmt == "parquet":
+        if pq is None:
+            raise HTTPException(status_code=501, detail="Export parquet indisponible : pyarrow n'est pas installé.")
+        path = _to_temp_file(".parquet", lambda p: write_parquet(db, p, table, units, start, end))
+        body = file_chunks(path)
+        filename = f"{filename}_{table}"
+    else:
+        body = csv_chunks(table, units, start, end)
+        filename = f"{filename}_{table}"
+
+    headers = {"Content-Disposition": f'attachment; filename="{filename}.{fmt}"'}
+    return StreamingResponse(body, media_type=MEDIA_TYPES[fmt], headers=headers)
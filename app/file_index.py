@@ -0,0 +1,185 @@
+# app/file_index.py
+"""
+Index message_id → fichier HL7 d'origine (table hl7_file_index).
+
+L'ingestion y inscrit, dans la transaction des messages, les fichiers qu'elle
+conserve (import sans suppression) ; l'export retrouve ainsi le texte brut
+d'un message par une recherche sur clé au lieu de parcourir les dossiers
+surveillés. Les fichiers supprimés après ingestion ne sont pas indexés.
+
+Chaque entrée garde la taille et le mtime du fichier à son import : au
+démarrage, l'import du backlog sans suppression saute les fichiers dont une
+entrée correspond encore (`unchanged_files`).
+
+    python -m app.file_index DOSSIER SOURCE [DOSSIER SOURCE ...]
+
+reconstruit l'index des fichiers déjà présents dans ces dossiers.
+"""
+
+import os
+import sys
+import logging
+import argparse
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.orm import Session
+
+from app.database import IngestSessionLocal
+from app.models import HL7FileIndex
+from app.hl7_tokenizer import separators, tokenize
+from app.hl7_splitter import iter_file_messages
+
+# message_id (ou chemins) par requête IN
+LOOKUP_CHUNK_SIZE = 1000
+
+
+def file_signature(path: str) -> Tuple[Optional[int], Optional[int]]:
+    """(taille, mtime_ns) du fichier ; (None, None) s'il a disparu."""
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None, None
+    return st.st_size, st.st_mtime_ns
+
+
+def file_index_rows(source: str, path: str, messages: Iterable) -> List[dict]:
+    """
+    Entrées d'index d'un fichier conservé, une par message_id distinct, avec
+    l'offset de son message dans le fichier (crud.ParsedMessage) et la
+    signature du fichier. Un fichier réécrit après sa lecture est signalé à
+    nouveau par le watcher et réimporté avec sa nouvelle signature.
+    """
+    offsets: Dict[str, int] = {}
+    for message in messages:
+        for row in message.rows:
+            mid = row.get("message_id")
+            if mid and mid not in offsets:
+                offsets[mid] = message.offset
+    size, mtime_ns = file_signature(path) if offsets else (None, None)
+    return [
+        {"source": source, "message_id": mid, "path": path, "offset": offsets[mid], "size": size, "mtime_ns": mtime_ns}
+        for mid in sorted(offsets)
+    ]
+
+
+def new_file_entries():
+    """
+    INSERT qui n'ajoute pas d'entrée (message_id, source, fichier) déjà
+    présente : l'entrée existante prend l'offset et la signature du fichier
+    réimporté.
+    """
+    stmt = pg_insert(HL7FileIndex)
+    return stmt.on_conflict_do_update(
+        index_elements=["message_id", "source", "path"],
+        set_={"offset": stmt.excluded.offset, "size": stmt.excluded.size, "mtime_ns": stmt.excluded.mtime_ns},
+    )
+
+
+def unchanged_files(db: Session, paths: Iterable[str]) -> Set[str]:
+    """
+    Fichiers de `paths` déjà importés et conservés, inchangés depuis : une de
+    leurs entrées a encore leur taille et leur mtime. Les fichiers sans
+    message_id n'ont pas d'entrée et ne sont jamais sautés.
+    """
+    current = {path: file_signature(path) for path in paths}
+    current = {path: signature for path, signature in current.items() if signature[0] is not None}
+    found: Set[str] = set()
+    paths = sorted(current)
+    for i in range(0, len(paths), LOOKUP_CHUNK_SIZE):
+        rows = (
+            db.query(HL7FileIndex.path, HL7FileIndex.size, HL7FileIndex.mtime_ns)
+            .filter(HL7FileIndex.path.in_(paths[i:i + LOOKUP_CHUNK_SIZE]), HL7FileIndex.size.isnot(None))
+            .distinct()
+            .all()
+        )
+        found.update(path for path, size, mtime_ns in rows if current[path] == (size, mtime_ns))
+    return found
+
+
+def lookup(db: Session, message_ids: Iterable[str]) -> Dict[str, Tuple[str, int]]:
+    """{message_id: (chemin, offset)} ; en cas de doublon, l'entrée la plus récente l'emporte."""
+    ids = sorted(set(message_ids) - {None, ""})
+    found: Dict[str, Tuple[str, int]] = {}
+    for i in range(0, len(ids), LOOKUP_CHUNK_SIZE):
+        query = (
+            db.query(HL7FileIndex.message_id, HL7FileIndex.path, HL7FileIndex.offset)
+            .filter(HL7FileIndex.message_id.in_(ids[i:i + LOOKUP_CHUNK_SIZE]))
+            .order_by(HL7FileIndex.id)
+        )
+        for message_id, path, offset in query:
+            found[message_id] = (path, offset)
+    return found
+
+
+def read_message(path: str, offset: int = 0) -> Optional[str]:
+    """Texte brut du message commençant à `offset` dans `path` (None si le fichier a disparu)."""
+    try:
+        for message_offset, text in iter_file_messages(path):
+            if message_offset >= offset:
+                return text
+    except OSError:
+        return None
+    return None
+
+
+def pv1_fields(message: str) -> List[str]:
+    """Champs du premier segment PV1 du message ([] s'il n'y en a pas)."""
+    field_sep, _ = separators(message)
+    for _, line in tokenize(message, ("PV1",), field_sep):
+        return line.split(field_sep)
+    return []
+
+
+def rebuild(db: Session, folders: Dict[str, str], extensions: Iterable[str]) -> int:
+    """
+    Réindexe les fichiers de `folders` ({dossier: source}) : les entrées
+    existantes de ces dossiers sont remplacées, y compris celles des fichiers
+    disparus depuis. Retourne le nombre d'entrées.
+    """
+    from app.crud import parse_messages
+    from app.ingestion import list_hl7_files
+
+    total = 0
+    for folder, source in folders.items():
+        paths = list_hl7_files(folder, extensions)
+        # Fichiers du dossier (non récursif, comme list_hl7_files), présents ou non
+        db.query(HL7FileIndex).filter(
+            HL7FileIndex.path.startswith(os.path.join(folder, ""), autoescape=True)
+        ).delete(synchronize_session=False)
+        entries = []
+        for path in paths:
+            try:
+                messages = parse_messages(source, iter_file_messages(path), with_payload=False)
+                entries.extend(file_index_rows(source, path, messages))
+            except Exception as e:
+                logging.error(f"Error indexing {path}: {e}")
+        for i in range(0, len(entries), LOOKUP_CHUNK_SIZE):
+            db.execute(new_file_entries().values(entries[i:i + LOOKUP_CHUNK_SIZE]))
+        total += len(entries)
+    db.commit()
+    return total
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="Reconstruit l'index message_id → fichier HL7.")
+    parser.add_argument("pairs", nargs="+", metavar="DOSSIER SOURCE",
+                        help="dossier suivi de sa source (WISH ou ORLine)")
+    parser.add_argument("--ext", action="append", default=None,
+                        help="extension prise en compte (défaut : .hl7 .txt .dat .xml)")
+    args = parser.parse_args(argv)
+    if len(args.pairs) % 2:
+        parser.error("chaque dossier doit être suivi de sa source")
+    folders = dict(zip(args.pairs[::2], args.pairs[1::2]))
+    extensions = args.ext or [".hl7", ".txt", ".dat", ".xml"]
+
+    db = IngestSessionLocal()
+    try:
+        print(f"{rebuild(db, folders, extensions)} message(s) indexé(s)")
+        return 0
+    finally:
+        db.close()
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,92 @@
+# app/hl7_datetime.py
+
+import re
+from datetime import datetime, date
+from functools import lru_cache
+from typing import Optional
+
+# Nombre de valeurs gardées en cache (MSH-7 / EVN-2 se répètent beaucoup dans un lot)
+TS_CACHE_SIZE = 16384
+
+# HL7 TS, précision au jour minimum : YYYYMMDD[HH[MM[SS[.S[S[S[S]]]]]]][+/-ZZZZ]
+_HL7_TS_RE = re.compile(r"(\d{8}(?:\d{2}){0,3})(?:\.(\d{1,4}))?(?:[+-]\d{4})?")
+
+
+@lru_cache(maxsize=TS_CACHE_SIZE)
+def parse_hl7_ts(value: Optional[str]) -> Optional[datetime]:
+    """
+    Convertit un horodatage HL7 (8, 10, 12 ou 14 chiffres, fraction de seconde
+    et fuseau optionnels) en datetime naïf. Le fuseau est ignoré : l'heure
+    est gardée telle qu'écrite, comme les colonnes texte existantes.
+    Retourne None si la valeur n'est pas un horodatage HL7 valide.
+    """
+    if not value:
+        return None
+    m = _HL7_TS_RE.fullmatch(value.strip())
+    if m is None:
+        return None
+    d, fraction = m.group(1), m.group(2)
+    try:
+        return datetime(
+            int(d[0:4]),
+            int(d[4:6]),
+            int(d[6:8]),
+            int(d[8:10] or 0),
+            int(d[10:12] or 0),
+            int(d[12:14] or 0),
+            int(fraction.ljust(6, "0")) if fraction else 0,
+        )
+    except ValueError:
+        return None
+
+
+@lru_cache(maxsize=TS_CACHE_SIZE)
+def hl7_to_iso(value: Optional[str]) -> Optional[str]:
+    """'YYYYMMDDHHMMSS' → 'YYYY-MM-DD HH:MM:SS' (format des colonnes WISH)."""
+    dt = parse_hl7_ts(value)
+    return f"{dt:%Y-%m-%d %H:%M:%S}" if dt else None
+
+
+@lru_cache(maxsize=TS_CACHE_SIZE)
+def hl7_to_slashed(value: Optional[str]) -> Optional[str]:
+    """'YYYYMMDDHHMMSS' → 'YYYY/MM/DD HH:MM:SS' (format des colonnes ORLine)."""
+    dt = parse_hl7_ts(value)
+    return f"{dt:%Y/%m/%d %H:%M:%S}" if dt else None
+
+
+@lru_cache(maxsize=TS_CACHE_SIZE)
+def hl7_to_slashed_date(value: Optional[str]) -> Optional[str]:
+    """'YYYYMMDD...' → 'YYYY/MM/DD'."""
+    if not value:
+        return None
+    dt = parse_hl7_ts(value.strip()[:8])
+    return f"{dt:%Y/%m/%d}" if dt else None
+
+
+@lru_cache(maxsize=TS_CACHE_SIZE)
+def parse_db_datetime(value: Optional[str]) -> Optional[datetime]:
+    """
+    Relit une date stockée en base, 'YYYY-MM-DD HH:MM:SS' (WISH) ou
+    'YYYY/MM/DD HH:MM:SS' (ORLine), par découpage à position fixe.
+    """
+    if not value or len(value) != 19:
+        return None
+    sep = value[4]
+    if sep not in "-/" or value[7] != sep or value[10] != " " or value[13] != ":" or value[16] != ":":
+        return None
+    try:
+        return datetime(int(value[0:4]), int(value[5:7]), int(value[8:10]),
+                         int(value[11:13]), int(value[14:16]), int(value[17:19]))
+    except ValueError:
+        return None
+
+
+@lru_cache(maxsize=TS_CACHE_SIZE)
+def parse_db_date(value: Optional[str]) -> Optional[date]:
+    """Jour d'une date stockée en base ('YYYY/MM/DD' ou 'YYYY-MM-DD[ HH:MM:SS]')."""
+    if not value or len(value) < 10 or value[4] not in "-/" or value[7] != value[4]:
+        return None
+    try:
+        return date(int(value[0:4]), int(value[5:7]), int(value[8:10]))
+    except ValueError:
+        return None
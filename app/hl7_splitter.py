@@ -0,0 +1,82 @@
+# app/hl7_splitter.py
+"""
+Découpage en messages d'un flux HL7 contenant un lot : enveloppes FHS/BHS
+(BTS/FTS en fin de lot) ou simples blocs MSH à la suite, comme en émet le
+moteur d'interface pendant un rattrapage.
+
+Le découpage est paresseux : `iter_messages` consomme n'importe quel
+itérable de lignes (fichier ouvert, socket via makefile) et rend chaque
+message dès que le MSH suivant arrive. Chaque message est rendu avec son
+offset (en caractères) dans le texte décodé et le texte exact de ses lignes
+(l'offset est la clé de l'index message_id → fichier, app/file_index.py).
+
+Un texte sans MSH reste un seul message, comme avant le découpage.
+"""
+
+from typing import Iterable, Iterator, List, Tuple
+
+# Segments d'enveloppe de lot : ils ne font partie d'aucun message
+BATCH_SEGMENTS = frozenset(("FHS", "BHS", "BTS", "FTS"))
+# Caractères de début / fin de trame MLLP et indentation tolérés avant le nom du segment
+_FRAMING = " \t\x0b\x1c"
+
+ENCODINGS = ("utf-8", "iso-8859-1")
+
+
+def iter_messages(lines: Iterable[str]) -> Iterator[Tuple[int, str]]:
+    """(offset, texte) de chaque message ; les lignes doivent garder leur fin de ligne."""
+    current: List[str] = []
+    has_msh = False
+    start = offset = 0
+    for line in lines:
+        name = line.lstrip(_FRAMING)[:3].upper()
+        if name in BATCH_SEGMENTS or (name == "MSH" and has_msh):
+            if has_msh:
+                yield start, "".join(current)
+                current, has_msh = [], False
+            if name in BATCH_SEGMENTS:
+                offset += len(line)
+                continue
+        if not current:
+            if not line.strip(_FRAMING + "\r\n"):
+                # Lignes vides entre deux messages
+                offset += len(line)
+                continue
+            start = offset
+        has_msh = has_msh or name == "MSH"
+        current.append(line)
+        offset += len(line)
+    if current:
+        yield start, "".join(current)
+
+
+def split_messages(content: str) -> Iterator[Tuple[int, str]]:
+    """Messages d'un texte déjà lu."""
+    # Cas courant d'un fichier à un seul message, repéré sans découpage en lignes
+    # (recherche de sous-chaînes : un faux positif ne fait que passer au découpage)
+    upper = content.upper()
+    if upper.count("MSH") <= 1 and not any(name in upper for name in BATCH_SEGMENTS):
+        return iter(((0, content),) if content.strip(_FRAMING + "\r\n") else ())
+    return iter_messages(content.splitlines(keepends=True))
+
+
+def iter_file_messages(path: str) -> Iterator[Tuple[int, str]]:
+    """
+    Messages d'un fichier lus ligne à ligne, sans charger le fichier entier.
+    Décodage UTF-8, ou ISO-8859-1 si le fichier n'est pas de l'UTF-8 valide
+    (comme app/ingestion.read_hl7_file) : la relecture en ISO-8859-1 reprend
+    après les messages déjà rendus. Les offsets ne valent que pour cette
+    fonction, déterministe : app/file_index.read_message relit par elle.
+    """
+    done = 0
+    for encoding in ENCODINGS:
+        try:
+            with open(path, "r", encoding=encoding) as f:
+                for i, message in enumerate(iter_messages(f)):
+                    if i >= done:
+                        done += 1
+                        yield message
+            return
+        except UnicodeDecodeError:
+            if encoding == ENCODINGS[-1]:
+                raise
@@ -0,0 +1,47 @@
+# app/hl7_tokenizer.py
+
+import re
+from typing import Iterable, List, Tuple
+
+DEFAULT_FIELD_SEP = "|"
+DEFAULT_COMPONENT_SEP = "^"
+
+_MSH_RE = re.compile(r"(?:\A|(?<=[\r\n]))[ \t]*MSH(.)(.)?", re.IGNORECASE)
+_INDENT = frozenset(" \t")
+
+
+def separators(message: str) -> Tuple[str, str]:
+    """Séparateurs de champ et de composant déclarés par le segment MSH."""
+    m = _MSH_RE.search(message)
+    if m is None or m.group(1) in "\r\n":
+        return DEFAULT_FIELD_SEP, DEFAULT_COMPONENT_SEP
+    field_sep, component_sep = m.group(1), m.group(2)
+    if not component_sep or component_sep in "\r\n" or component_sep == field_sep:
+        component_sep = DEFAULT_COMPONENT_SEP
+    return field_sep, component_sep
+
+
+def tokenize(message: str, names: Iterable[str], field_sep: str = DEFAULT_FIELD_SEP,
+             ignore_case: bool = False) -> List[Tuple[str, str]]:
+    """
+    Repère en une seule passe les segments `names` du message et renvoie
+    [(nom, ligne nettoyée), ...] dans l'ordre du message. Les lignes des autres
+    segments ne sont ni nettoyées ni découpées ; le découpage en champs est
+    laissé au parser, pour les seuls segments qu'il lit.
+    """
+    wanted = frozenset(names)
+    lines = message.splitlines()
+    # Filtre en compréhension : le test par ligne reste au niveau C autant que possible
+    if ignore_case:
+        candidates = [line for line in lines if line[:3].upper() in wanted or line[:1] in _INDENT]
+    else:
+        candidates = [line for line in lines if line[:3] in wanted or line[:1] in _INDENT]
+
+    segments = []
+    for line in candidates:
+        line = line.strip()
+        name = line[:3].upper() if ignore_case else line[:3]
+        # Le nom doit être suivi du séparateur (ou être seul sur la ligne)
+        if name in wanted and (len(line) == 3 or line[3] == field_sep):
+            segments.append((name, line))
+    return segments
@@ -0,0 +1,509 @@
+# app/ingestion.py
+
+import os
+import queue
+import random
+import logging
+import threading
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from typing import Callable, Deque, Dict, Iterable, List, NamedTuple, Optional, Tuple
+
+from sqlalchemy.exc import DBAPIError, OperationalError, TimeoutError as PoolTimeoutError
+
+from app.database import IngestSessionLocal
+from app.crud import ParsedMessage, parse_messages, bulk_create_messages
+from app.file_index import file_index_rows, unchanged_files
+from app import raw_store
+from app.dedup import RECENT_MESSAGE_IDS, RecentKeys
+from app.hl7_splitter import iter_file_messages
+from app.timeline_cache import patient_ids, timeline_cache
+
+# Taille max d'un lot (en messages) et délai max d'attente avant écriture (s)
+BATCH_SIZE = int(os.getenv("HL7_BATCH_SIZE", "500"))
+BATCH_MAX_WAIT = float(os.getenv("HL7_BATCH_MAX_WAIT", "0.5"))
+# Nombre de processus de lecture/parsing pour l'import du backlog (1 = séquentiel)
+PARSE_WORKERS = int(os.getenv("HL7_PARSE_WORKERS", str(os.cpu_count() or 1)))
+# Fichiers envoyés à un worker à la fois
+PARSE_CHUNKSIZE = int(os.getenv("HL7_PARSE_CHUNKSIZE", "64"))
+# Soumissions (fichiers, messages MLLP) en attente d'écriture avant de bloquer
+# les producteurs (0 = file non bornée)
+WRITE_QUEUE_SIZE = int(os.getenv("HL7_WRITE_QUEUE_SIZE", "1000"))
+# Threads d'écriture, chacun sur sa connexion du pool d'ingestion. Au-delà de 1,
+# deux lots peuvent être commités dans le désordre (l'ordre de réception des
+# messages bruts n'est plus garanti)
+WRITER_WORKERS = int(os.getenv("HL7_WRITER_WORKERS", "1"))
+# Nouvelles tentatives d'un lot sur erreur transitoire, délai doublé à chaque fois (s)
+WRITE_RETRIES = int(os.getenv("HL7_WRITE_RETRIES", "5"))
+WRITE_RETRY_BACKOFF = float(os.getenv("HL7_WRITE_RETRY_BACKOFF", "0.5"))
+WRITE_RETRY_MAX_BACKOFF = float(os.getenv("HL7_WRITE_RETRY_MAX_BACKOFF", "30"))
+
+_STOP = object()
+
+
+class Submission(NamedTuple):
+    source: str
+    messages: List[ParsedMessage]
+    path: Optional[str]
+    on_commit: Optional[Callable[[bool], None]]
+    delete: bool
+    queued_at: float
+
+    @property
+    def rows(self) -> List[dict]:
+        return [row for message in self.messages for row in message.rows]
+
+
+def message_key(source: str, message: ParsedMessage) -> Optional[Tuple[str, str]]:
+    """(source, message_id) du message ; None s'il n'a pas de message_id."""
+    message_id = message.rows[0].get("message_id") if message.rows else None
+    return (source, message_id) if message_id else None
+
+
+def is_transient(error: Exception) -> bool:
+    """Erreur qui peut disparaître en réessayant : connexion perdue, deadlock, pool saturé."""
+    if isinstance(error, (OperationalError, PoolTimeoutError)):
+        return True
+    return isinstance(error, DBAPIError) and error.connection_invalidated
+
+
+class LatencyStats:
+    """Durées par étape (parsing, attente en file, écriture...), lues par /metrics/ingestion."""
+
+    # Mesures récentes gardées par étape pour le p95
+    WINDOW = 1000
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._count: Dict[str, int] = {}
+        self._total: Dict[str, float] = {}
+        self._max: Dict[str, float] = {}
+        self._recent: Dict[str, Deque[float]] = {}
+
+    def record(self, stage: str, seconds: float):
+        with self._lock:
+            if stage not in self._count:
+                self._count[stage], self._total[stage], self._max[stage] = 0, 0.0, 0.0
+                self._recent[stage] = deque(maxlen=self.WINDOW)
+            self._count[stage] += 1
+            self._total[stage] += seconds
+            self._max[stage] = max(self._max[stage], seconds)
+            self._recent[stage].append(seconds)
+
+    def snapshot(self) -> Dict[str, Dict[str, float]]:
+        with self._lock:
+            stages = {}
+            for stage, count in self._count.items():
+                recent = sorted(self._recent[stage])
+                stages[stage] = {
+                    "count": count,
+                    "avg_ms": round(1000 * self._total[stage] / count, 3),
+                    "p95_ms": round(1000 * recent[int(0.95 * (len(recent) - 1))], 3),
+                    "max_ms": round(1000 * self._max[stage], 3),
+                }
+            return stages
+
+
+def read_hl7_file(path: str) -> str:
+    """Lit un fichier HL7 en UTF-8, ou en ISO-8859-1 si le décodage échoue."""
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            return f.read()
+    except UnicodeDecodeError:
+        with open(path, "r", encoding="iso-8859-1") as f:
+            return f.read()
+
+
+class BatchWriter:
+    """
+    Regroupe les messages parsés en micro-lots (taille ou délai max atteint)
+    et écrit chaque lot avec un INSERT multi-lignes et un seul commit.
+    Les fichiers sources ne sont supprimés qu'après le commit de leur lot ;
+    ceux que l'on garde sont indexés par message_id (app/file_index.py).
+    Le message brut compressé est écrit dans la même transaction (app/raw_store.py).
+
+    Idempotence : les message_id déjà en base sont ignorés à l'insertion
+    (ON CONFLICT DO NOTHING) ; ceux commités récemment par ce writer sont
+    écartés dès la soumission, sans aller-retour en base.
+
+    La file est bornée (HL7_WRITE_QUEUE_SIZE) : quand la base ne suit pas,
+    `submit` bloque et ralentit les producteurs (vérification des fichiers,
+    import du backlog) au lieu d'accumuler les messages parsés en mémoire.
+    Les lots sont écrits par HL7_WRITER_WORKERS threads ; une erreur
+    transitoire est réessayée avec un délai croissant.
+    """
+
+    def __init__(self, batch_size: int = BATCH_SIZE, max_wait: float = BATCH_MAX_WAIT,
+                 workers: int = WRITER_WORKERS, queue_size: int = WRITE_QUEUE_SIZE,
+                 retries: int = WRITE_RETRIES, retry_backoff: float = WRITE_RETRY_BACKOFF):
+        self.batch_size = batch_size
+        self.max_wait = max_wait
+        self.workers = max(workers, 1)
+        self.retries = retries
+        self.retry_backoff = retry_backoff
+        self._queue: queue.Queue = queue.Queue(maxsize=queue_size)
+        self._threads: List[threading.Thread] = []
+        self._lock = threading.Lock()
+        self.recent = RecentKeys(RECENT_MESSAGE_IDS)
+        self.latency = LatencyStats()
+        self.duplicates = 0
+        self.committed = 0
+        self.failed = 0
+        self.retried = 0
+
+    def start(self):
+        for i in range(self.workers):
+            thread = threading.Thread(target=self._run, name=f"hl7-batch-writer-{i}", daemon=True)
+            thread.start()
+            self._threads.append(thread)
+        logging.info(
+            f"Batch writer started (workers={self.workers}, batch_size={self.batch_size}, "
+            f"max_wait={self.max_wait}s, queue_size={self._queue.maxsize})"
+        )
+
+    def stop(self):
+        """Écrit les messages en attente puis arrête les threads d'écriture."""
+        if not self._threads:
+            return
+        for _ in self._threads:
+            self._queue.put(_STOP)
+        for thread in self._threads:
+            thread.join()
+        self._threads = []
+        logging.info("Batch writer stopped cleanly")
+
+    def submit(self, source: str, messages: List[ParsedMessage], path: Optional[str] = None,
+               on_commit: Optional[Callable[[bool], None]] = None, delete: bool = True):
+        """
+        Ajoute au prochain lot les messages parsés d'un fichier (crud.parse_messages),
+        écrits ensemble : un fichier de lot n'est jamais commité à moitié.
+        `path` (fichier d'origine) est supprimé une fois le lot commité si
+        `delete`, sinon ses messages sont indexés par message_id et offset
+        dans la même transaction. Le brut préparé de chaque message
+        (raw_store.pack) est conservé en base.
+        `on_commit(ok)` est appelé après l'écriture du lot.
+        Les messages déjà commités récemment sont retirés ; la soumission
+        suit quand même son cours (suppression du fichier, on_commit).
+        Bloque tant que la file est pleine.
+        """
+        kept = [message for message in messages if message_key(source, message) not in self.recent]
+        with self._lock:
+            self.duplicates += len(messages) - len(kept)
+        start = time.monotonic()
+        self._queue.put(Submission(source, kept, path, on_commit, delete, start))
+        self.latency.record("enqueue", time.monotonic() - start)
+
+    def stats(self) -> dict:
+        with self._lock:
+            counters = {
+                "committed": self.committed, "failed": self.failed,
+                "retried": self.retried, "duplicates": self.duplicates,
+            }
+        return {
+            "workers": len(self._threads),
+            "queue_depth": self._queue.qsize(),
+            "queue_size": self._queue.maxsize,
+            **counters,
+            "latency": self.latency.snapshot(),
+        }
+
+    def flush(self):
+        """Bloque jusqu'à ce que tout ce qui a été soumis soit écrit."""
+        self._queue.join()
+
+    def _run(self):
+        stopping = False
+        while not stopping:
+            item = self._queue.get()
+            if item is _STOP:
+                self._queue.task_done()
+                break
+            batch = [item]
+            n_messages = len(item.messages)
+            deadline = time.monotonic() + self.max_wait
+            while n_messages < self.batch_size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    nxt = self._queue.get(timeout=remaining)
+                except queue.Empty:
+                    break
+                if nxt is _STOP:
+                    self._queue.task_done()
+                    stopping = True
+                    break
+                batch.append(nxt)
+                n_messages += len(nxt.messages)
+            now = time.monotonic()
+            for queued in batch:
+                self.latency.record("queue_wait", now - queued.queued_at)
+            try:
+                self._write(batch)
+            finally:
+                for _ in batch:
+                    self._queue.task_done()
+
+    def _write(self, batch: List[Submission]):
+        start = time.monotonic()
+        ok = self._commit(batch)
+        if ok:
+            committed = batch
+        elif ok is None or len(batch) == 1:
+            # Base toujours indisponible : réessayer message par message ne ferait que rallonger l'attente
+            committed = []
+        else:
+            # Le lot a échoué : on réessaie message par message pour isoler le fautif
+            committed = [item for item in batch if self._commit([item])]
+
+        for item in committed:
+            if not item.path or not item.delete:
+                continue
+            try:
+                os.remove(item.path)
+                logging.info(f"✓ Handled and removed {item.path}")
+            except OSError as e:
+                logging.error(f"Error removing {item.path}: {e}")
+        self.latency.record("write", time.monotonic() - start)
+
+        n_committed = sum(len(item.messages) for item in committed)
+        with self._lock:
+            self.committed += n_committed
+            self.failed += sum(len(item.messages) for item in batch) - n_committed
+
+        # Marqués après le commit seulement : un lot en échec pourra être resoumis
+        keys = (message_key(item.source, message) for item in committed for message in item.messages)
+        self.recent.update(key for key in keys if key is not None)
+
+        committed_ids = {id(item) for item in committed}
+        for item in batch:
+            if item.on_commit is not None:
+                item.on_commit(id(item) in committed_ids)
+
+    def _commit(self, batch: List[Submission]) -> Optional[bool]:
+        """
+        Écrit le lot en une transaction. True si commité, False si le lot est
+        refusé (donnée invalide), None si la base est restée indisponible
+        malgré les nouvelles tentatives (erreurs transitoires uniquement).
+        """
+        wish_rows, orline_rows, file_rows, raw_rows = [], [], [], []
+        for item in batch:
+            (wish_rows if item.source == "WISH" else orline_rows).extend(item.rows)
+            if item.path and not item.delete:
+                file_rows.extend(file_index_rows(item.source, item.path, item.messages))
+            raw_rows.extend(
+                raw_store.raw_row(item.source, message.rows, message.payload)
+                for message in item.messages if message.payload is not None
+            )
+
+        attempt = 0
+        while True:
+            db = IngestSessionLocal()
+            try:
+                wish_new, orline_new = bulk_create_messages(db, wish_rows, orline_rows, file_rows, raw_rows)
+                db.commit()
+                # Seuls les patients des lignes insérées (hors doublons ignorés) ont changé
+                timeline_cache.invalidate(patient_ids(wish_new, orline_new))
+                logging.info(
+                    f"Batch committed: {len(wish_new)} WISH, {len(orline_new)} ORLine"
+                    f" ({len(wish_rows) + len(orline_rows) - len(wish_new) - len(orline_new)} duplicates ignored)"
+                )
+                return True
+            except Exception as e:
+                db.rollback()
+                paths = [item.path for item in batch if item.path]
+                if not is_transient(e):
+                    logging.error(f"Error writing batch of {len(batch)} messages {paths[:3]}: {e}")
+                    return False
+                if attempt >= self.retries:
+                    logging.error(f"Giving up batch of {len(batch)} messages {paths[:3]} after {attempt + 1} attempts: {e}")
+                    return None
+                error = e
+            finally:
+                db.close()
+            # Délai doublé à chaque tentative, avec une part aléatoire pour désynchroniser les writers
+            delay = min(self.retry_backoff * 2 ** attempt, WRITE_RETRY_MAX_BACKOFF) * random.uniform(0.5, 1.0)
+            attempt += 1
+            with self._lock:
+                self.retried += 1
+            logging.warning(f"Transient error writing batch (attempt {attempt}/{self.retries + 1}), retrying in {delay:.1f}s: {error}")
+            time.sleep(delay)
+
+
+def ingest_file(writer: BatchWriter, source: str, path: str, delete: bool = True):
+    """Lit, découpe et parse un fichier HL7 (un message ou un lot) puis le confie au writer."""
+    start = time.monotonic()
+    messages = parse_messages(source, iter_file_messages(path))
+    writer.latency.record("parse", time.monotonic() - start)
+    writer.submit(source, messages, path, delete=delete)
+
+
+class BacklogProgress:
+    """Compteurs de l'import du backlog, lus par l'API pendant qu'il tourne."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.delete: Optional[bool] = None
+        self.queued = 0
+        self.skipped = 0
+        self.done = 0
+        self.failed = 0
+        self.started_at: Optional[float] = None
+        self.finished_at: Optional[float] = None
+
+    def start(self, delete: Optional[bool] = None):
+        with self._lock:
+            self.delete = delete
+            self.started_at = time.time()
+            self.finished_at = None
+
+    def finish(self):
+        with self._lock:
+            self.finished_at = time.time()
+
+    def add_queued(self, n: int):
+        with self._lock:
+            self.queued += n
+
+    def add_skipped(self, n: int):
+        with self._lock:
+            self.skipped += n
+
+    def record(self, ok: bool):
+        with self._lock:
+            if ok:
+                self.done += 1
+            else:
+                self.failed += 1
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            if self.started_at is None:
+                status, elapsed = "pending", 0.0
+            else:
+                status = "running" if self.finished_at is None else "finished"
+                elapsed = (self.finished_at or time.time()) - self.started_at
+            return {
+                "status": status,
+                "delete_after_import": self.delete,
+                "skipped": self.skipped,
+                "queued": self.queued,
+                "done": self.done,
+                "failed": self.failed,
+                "remaining": self.queued - self.done - self.failed,
+                "elapsed_s": round(elapsed, 1),
+                "files_per_s": round(self.done / elapsed, 1) if elapsed > 0 else 0.0,
+            }
+
+
+def list_hl7_files(folder: str, extensions: Iterable[str]) -> List[str]:
+    """
+    Fichiers HL7 d'un dossier, du plus ancien au plus récent (mtime puis nom),
+    pour rejouer les messages d'un même patient dans leur ordre d'arrivée.
+    """
+    files = []
+    with os.scandir(folder) as it:
+        for entry in it:
+            if entry.is_file() and os.path.splitext(entry.name)[1].lower() in extensions:
+                files.append((entry.stat().st_mtime, entry.name, entry.path))
+    files.sort()
+    return [path for _, _, path in files]
+
+
+def _read_and_parse(task: Tuple[str, str]):
+    # Exécuté dans un processus worker : doit rester une fonction de module (picklable).
+    # La compression du message brut et l'extraction PID-3 sont faites ici, hors du thread d'écriture.
+    source, path = task
+    start = time.monotonic()
+    try:
+        return source, path, parse_messages(source, iter_file_messages(path)), None, time.monotonic() - start
+    except Exception as e:
+        return source, path, None, str(e), time.monotonic() - start
+
+
+def import_backlog(files: List[Tuple[str, str]], writer: BatchWriter,
+                   workers: int = PARSE_WORKERS, delete: bool = True,
+                   progress: Optional[BacklogProgress] = None,
+                   stop_event: Optional[threading.Event] = None) -> int:
+    """
+    Lit et parse `files` ([(source, chemin), ...]) dans un pool de processus
+    puis confie les lignes à `writer` (bloqué tant que sa file est pleine). Les résultats sont remis dans
+    l'ordre de `files`, ce qui conserve l'ordre des messages de chaque patient.
+    Retourne le nombre de fichiers en erreur de lecture/parsing.
+    """
+    failed = 0
+    if not files:
+        return failed
+    on_commit = progress.record if progress is not None else None
+
+    def consume(results):
+        nonlocal failed
+        for source, path, messages, error, elapsed in results:
+            writer.latency.record("parse", elapsed)
+            if error is not None:
+                failed += 1
+                logging.error(f"Error processing {path}: {error}")
+                if progress is not None:
+                    progress.record(False)
+                continue
+            writer.submit(source, messages, path, on_commit, delete=delete)
+
+    def stopped():
+        return stop_event is not None and stop_event.is_set()
+
+    if workers <= 1 or len(files) < PARSE_CHUNKSIZE:
+        for i in range(0, len(files), PARSE_CHUNKSIZE):
+            if stopped():
+                break
+            consume(map(_read_and_parse, files[i:i + PARSE_CHUNKSIZE]))
+        return failed
+
+    # Fenêtres successives pour ne pas garder tout le backlog parsé en mémoire
+    window = workers * PARSE_CHUNKSIZE * 4
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        for i in range(0, len(files), window):
+            if stopped():
+                break
+            consume(pool.map(_read_and_parse, files[i:i + window], chunksize=PARSE_CHUNKSIZE))
+    return failed
+
+
+def start_backlog_import(folders: Dict[str, str], extensions: Iterable[str], writer: BatchWriter,
+                         progress: BacklogProgress, stop_event: threading.Event,
+                         delete: bool = True) -> threading.Thread:
+    """
+    Lance l'import des fichiers déjà présents dans `folders` ({dossier: source})
+    dans un thread de fond, pour que l'API réponde pendant l'import.
+    Sans suppression (`delete=False`), les fichiers restent dans les dossiers :
+    ceux déjà importés et inchangés depuis (même taille, même mtime dans
+    hl7_file_index) sont sautés au lieu d'être relus à chaque démarrage.
+    """
+    def run():
+        progress.start(delete)
+        try:
+            backlog = []
+            for path, source in folders.items():
+                if os.path.isdir(path):
+                    backlog.extend((source, full) for full in list_hl7_files(path, extensions))
+            if not delete:
+                db = IngestSessionLocal()
+                try:
+                    imported = unchanged_files(db, [full for _, full in backlog])
+                finally:
+                    db.close()
+                backlog = [(source, full) for source, full in backlog if full not in imported]
+                progress.add_skipped(len(imported))
+            progress.add_queued(len(backlog))
+            logging.info(f"Backlog import started: {len(backlog)} files ({progress.skipped} unchanged skipped)")
+            import_backlog(backlog, writer, delete=delete, progress=progress, stop_event=stop_event)
+            writer.flush()
+            logging.info(f"Backlog import finished: {progress.snapshot()}")
+        except Exception as e:
+            logging.error(f"Backlog import failed: {e}")
+        finally:
+            progress.finish()
+
+    thread = threading.Thread(target=run, name="hl7-backlog-import", daemon=True)
+    thread.start()
+    return thread
@@ -0,0 +1,174 @@
+# app/journey.py
+"""
+Mise en forme des parcours patient (gantt, parcours d'un séjour).
+
+Fonctions pures sur des dicts déjà lus en base : les endpoints async les
+exécutent dans le pool de processus (app/offload.py), hors de la boucle
+d'événements. Elles doivent rester des fonctions de module (picklables).
+"""
+
+from datetime import datetime
+from typing import Dict, List, Optional
+
+from app.hl7_datetime import hl7_to_iso, parse_db_datetime
+from app.transfers import collapse_journey_transfers
+
+CODE_LABELS = {"A01": "ADMISSION", "A02": "TRANSFER", "A03": "DISCHARGE"}
+# Clés lues par _sejour_event (WISH, ORLine et anciens noms de colonnes)
+SEJOUR_FIELDS = (
+    "clfrom", "date_message", "date_evt", "clto", "date_fin", "cltime", "cleent",
+    "Service_Name", "nomm", "medecin", "typ_evt", "Event_Description",
+)
+
+
+def parse_hl7_datetime(dt_str: str) -> str:
+    if not dt_str:
+        return None
+    # Horodatage HL7 brut → ISO ; les dates déjà formatées sont renvoyées telles quelles
+    return hl7_to_iso(dt_str) or dt_str
+
+
+def fmt_str(dt: datetime) -> str:
+    return dt.strftime("%d/%m/%Y à %H:%M")
+
+
+def diff_str(start: datetime, end: Optional[datetime]) -> str:
+    if not end:
+        return "en cours"
+    delta = end - start
+    h, rem = divmod(delta.total_seconds(), 3600)
+    m = rem // 60
+    return f"{int(h)} h {int(m)} min"
+
+
+def gantt_rows(raw: List[Dict], unit_names: Dict[str, str], service_names: Dict[str, str]) -> List[Dict]:
+    """
+    Lignes du gantt à partir des A01/A02/A03 du patient triés par date
+    (`raw` contient au moins un A01) : dernière admission, transferts
+    fusionnés, puis sortie.
+    """
+    a01_indices = [i for i, e in enumerate(raw) if e["code"] == "A01"]
+    last_a01_index = max(a01_indices, key=lambda i: raw[i]["dt"])
+    last_admission = raw[last_a01_index]
+    raw = [e for i, e in enumerate(raw) if e["code"] != "A01" or i == last_a01_index]
+
+    # Transferts à moins de 5 min fusionnés (priorité 8BLO/8REV), voir app/transfers.py
+    filtered = collapse_journey_transfers(raw)
+
+    admission_dt = last_admission["dt"]
+    filtered.insert(0, last_admission)
+
+    result: List[Dict] = []
+    for idx, ev in enumerate(filtered):
+        is_last = (idx == len(filtered) - 1)
+        dt_evt = fmt_str(ev["dt"])
+        unit = unit_names.get(ev["clnsid"], ev["clnsid"])
+        service = service_names.get(ev["clsvtc"], ev["clsvtc"])
+        code_lbl = CODE_LABELS[ev["code"]]
+        next_dt = filtered[idx + 1]["dt"] if idx + 1 < len(filtered) else None
+
+        if ev["code"] == "A01":
+            result.append({
+                "NSEJ": ev["nsej"],
+                "CBMRN": ev["cbmrn"],
+                "Resource": f"{ev['code']} - {code_lbl}",
+                "Unité de soins": unit,
+                "Service technique": service,
+                "Date/heure d'événement": dt_evt,
+                "Temps passé": diff_str(ev["dt"], next_dt)
+            })
+            continue
+
+        if ev["code"] == "A02":
+            result.append({
+                "NSEJ": ev["nsej"],
+                "CBMRN": ev["cbmrn"],
+                "Resource": f"{ev['code']} - {code_lbl}",
+                "Unité de soins": unit,
+                "Service technique": service,
+                "Date/heure d'événement": dt_evt,
+                "Temps passé" if not is_last else "Temps passé en cours": diff_str(ev["dt"], next_dt if not is_last else None)
+            })
+            continue
+
+        if ev["code"] == "A03":
+            total = diff_str(admission_dt, ev["dt"])
+            result.append({
+                "NSEJ": ev["nsej"],
+                "CBMRN": ev["cbmrn"],
+                "Resource": f"{ev['code']} - {code_lbl}",
+                "Unité de soins": unit,
+                "Service technique": service,
+                "Date/heure de sortie": dt_evt,
+                "Durée totale de séjour": total
+            })
+            break
+
+    return result
+
+
+def _sejour_event(msg: dict, unit_names: Dict[str, str]) -> Optional[Dict]:
+    to_dt = parse_db_datetime
+
+    date_debut_str = parse_hl7_datetime(msg.get("clfrom") or msg.get("date_message") or msg.get("date_evt") or "")
+    date_fin_str = parse_hl7_datetime(msg.get("clto") or msg.get("date_fin") or msg.get("cltime") or "")
+
+    date_debut = to_dt(date_debut_str)
+    date_fin = to_dt(date_fin_str)
+
+    raw_unite = msg.get("cleent") or msg.get("Service_Name") or ""
+    unite = unit_names.get(raw_unite, raw_unite)
+    service = raw_unite
+    medecin = msg.get("nomm") or msg.get("medecin") or ""
+
+    desc = (msg.get("typ_evt") or msg.get("Event_Description") or "").lower()
+    if "admission" in desc or "entrée" in desc:
+        type_evt = "ADMISSION"
+    elif "sortie" in desc:
+        type_evt = "DISCHARGE"
+    elif "transfert" in desc:
+        type_evt = "TRANSFER"
+    else:
+        return None
+
+    duration = ""
+    if date_debut and date_fin:
+        delta = date_fin - date_debut
+        duration = str(delta)
+
+    return {
+        "debut": date_debut_str,
+        "fin": date_fin_str,
+        "unite": unite,
+        "service": service,
+        "type_evenement": type_evt,
+        "medecin": medecin,
+        "duration": duration
+    }
+
+
+def sejour_columns(table) -> list:
+    """Colonnes de `table` utiles au parcours d'un séjour (projection de la requête)."""
+    return [col for col in table.c if col.key in SEJOUR_FIELDS]
+
+
+def sejour_journey(messages: List[dict], unit_names: Dict[str, str]) -> Optional[Dict]:
+    """Parcours d'un séjour (messages WISH puis ORLine) ; None si aucun événement daté."""
+    parcours = [_sejour_event(msg, unit_names) for msg in messages]
+    parcours = [p for p in parcours if p and p["debut"]]
+    parcours.sort(key=lambda x: x["debut"])
+
+    if not parcours:
+        return None
+
+    return {
+        "timeline": [
+            {
+                "Unité de soins": p["unite"],
+                "Start": p["debut"].replace("-", "").replace(":", "").replace(" ", ""),
+                "Finish": p["fin"].replace("-", "").replace(":", "").replace(" ", ""),
+                "Resource": p["service"]
+            } for p in parcours
+        ],
+        "events": parcours
+    }
@@ -1,25 +1,39 @@
 import os
 import io
 import logging
-import time
 from datetime import datetime, date, timedelta
 from typing import List, Optional, Dict, Tuple
 
-from fastapi import FastAPI, Depends, HTTPException, Query
+from fastapi import FastAPI, Depends, HTTPException, Query, Response
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.responses import StreamingResponse
+from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.orm import Session
-from sqlalchemy import text
+from sqlalchemy import select, text
 from pydantic import BaseModel
 from collections import defaultdict
-from watchdog.observers.polling import PollingObserver as Observer
 from watchdog.events import FileSystemEventHandler
 import pandas as pd
 from contextlib import asynccontextmanager
-from app.database import SessionLocal, create_tables
+from app.database import IngestSessionLocal, async_engine, create_tables, get_db, get_async_db, pool_metrics
 from app.models import HL7MessageWish, HL7MessageOrline
 from app.schemas import HL7MessageWishSchema, HL7MessageOrlineSchema
-from app.crud import create_wish_message, create_orline_message
+import threading
+from app import census, offload, raw_store
+from app.ingestion import (
+    BatchWriter, BacklogProgress, ingest_file, list_hl7_files, import_backlog, start_backlog_import
+)
+from app.watchers import create_observer
+from app.mllp import MLLP_PORT, MLLPServer
+from app.readiness import StabilityScheduler
+from app.pagination import ORDERS, NEXT_CURSOR_HEADER, keyset_page_async, stream_ndjson
+from app.export import EXPORT_FORMATS, EXPORT_TABLES, export_messages
+from app.journey import gantt_rows, sejour_columns, sejour_journey
+from app.responses import FastJSONResponse
+from app.patients import SOURCES as PATIENT_SOURCES, patients_page
+from app.offload import run_cpu
+from app.timeline_cache import timeline_cache
+from app.hl7_datetime import parse_db_datetime
 
 
 create_tables()
@@ -76,6 +90,10 @@ WATCHED_FOLDERS = {
     r"C:\Users\sbenayed\Desktop\PFE\hl7_archive\ORL ADT 7 avril 2025": "ORLine",
 }
 
+# Backend de surveillance par dossier : "auto" (défaut), "native" ou "polling".
+# Garder "polling" pour les partages réseau où les notifications noyau ne remontent pas.
+FOLDER_WATCHER_BACKENDS: Dict[str, str] = {}
+
 SUPPORTED_EXTENSIONS = [".hl7", ".txt", ".dat", ".xml"]
 
 
@@ -93,130 +111,97 @@ class PatientCountsResponse(BaseModel):
     daily_counts: List[DailyCount]
 
 
-
-def parse_hl7_datetime(dt_str: str) -> str:
-    if not dt_str:
-        return None
-    try:
-        if len(dt_str) == 12:
-            dt = datetime.strptime(dt_str, "%Y%m%d%H%M")
-        elif len(dt_str) == 14:
-            dt = datetime.strptime(dt_str, "%Y%m%d%H%M%S")
-        else:
-            return dt_str
-        return dt.strftime("%Y-%m-%d %H:%M:%S")
-    except Exception:
-        return dt_str
-
 class HL7Handler(FileSystemEventHandler):
-    def __init__(self, source: str):
+    def __init__(self, source: str, writer: BatchWriter, readiness: StabilityScheduler):
         super().__init__()
         self.source = source
+        self.writer = writer
+        self.readiness = readiness
 
     def on_created(self, event):
         if not event.is_directory:
-            self._process(event.src_path)
+            self._schedule(event.src_path)
 
     def on_moved(self, event):
-        # Fichiers copiés depuis l’explorateur arrivent souvent via un move
+        # Fichiers copiés depuis l’explorateur arrivent souvent via un move : complets dès le renommage
         if not event.is_directory:
-            self._process(event.dest_path)
+            self._schedule(event.dest_path, renamed=True)
 
     def on_modified(self, event):
         # Couvrir d’éventuelles modifications in-place
         if not event.is_directory:
-            self._process(event.src_path)
+            self._schedule(event.src_path)
 
-    def _process(self, path: str):
-        # Laisser Windows finir la copie
-        time.sleep(0.1)
+    def _schedule(self, path: str, renamed: bool = False):
+        # Pas d'attente dans le thread de l'observer : le fichier est lu une fois stable (app/readiness.py)
+        if os.path.splitext(path)[1].lower() in SUPPORTED_EXTENSIONS:
+            self.readiness.notify(path, self._process, renamed)
 
-        ext = os.path.splitext(path)[1].lower()
-        if ext not in SUPPORTED_EXTENSIONS:
-            return
-
-        logging.info(f"→ Processing HL7 file {path} as {ext}")
-        db = SessionLocal()
+    def _process(self, path: str):
+        logging.info(f"→ Processing HL7 file {path}")
         try:
-            # Lecture en UTF-8 ou ISO-8859-1
-            try:
-                with open(path, "r", encoding="utf-8") as f:
-                    content = f.read()
-            except UnicodeDecodeError:
-                with open(path, "r", encoding="iso-8859-1") as f:
-                    content = f.read()
-
-            # Insertion en base
-            if self.source == "WISH":
-                create_wish_message(db, content)
-            else:
-                create_orline_message(db, content)
-
-            # Suppression
-            os.remove(path)
-            logging.info(f"✓ Handled and removed {path}")
+            # Lecture en UTF-8 ou ISO-8859-1, découpée en messages (fichier de lot FHS/BHS ou MSH à la suite).
+            # Insertion par lot ; le fichier est supprimé après le commit du lot. Si la file
+            # d'écriture est pleine, on attend ici : les fichiers suivants restent sur le disque
+            ingest_file(self.writer, self.source, path)
         except Exception as e:
             logging.error(f"Error processing {path}: {e}")
-        finally:
-            db.close()
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     logging.info("▶️ Lifespan startup begin") 
     app.state.observers = []
+    app.state.batch_writer = BatchWriter()
+    app.state.batch_writer.start()
+    app.state.file_readiness = StabilityScheduler()
+    app.state.file_readiness.start()
 
-    # 1) Backlog : traiter les fichiers déjà présents
+    # Ligne d'invalidation du recensement, avant la première écriture
+    db = IngestSessionLocal()
+    try:
+        census.init_state(db)
+    finally:
+        db.close()
+
+    # 1) Observers temps réel (un seul par dossier : chaque événement n'est reçu qu'une fois),
+    # démarrés avant le backlog pour ne manquer aucun fichier déposé pendant l'import
     for path, source in WATCHED_FOLDERS.items():
         os.makedirs(path, exist_ok=True)
-        handler = HL7Handler(source)
-        # Timeout plus court pour quasi-temps réel
-        obs = Observer(timeout=0.5)
-        obs.schedule(handler, path, recursive=False)
-        obs.start()
-        logging.info(f"Watcher (real-time) started on {path}")
-        app.state.observers.append(obs)
-        for fname in os.listdir(path):
-            full = os.path.join(path, fname)
-            ext = os.path.splitext(full)[1].lower()
-            if os.path.isfile(full) and ext in SUPPORTED_EXTENSIONS:
-                logging.info(f"Backlog processing existing file {full}")
-                db = SessionLocal()
-                try:
-                    # Lecture robuste du contenu
-                    try:
-                        with open(full, "r", encoding="utf-8") as f:
-                            content = f.read()
-                    except UnicodeDecodeError:
-                        with open(full, "r", encoding="iso-8859-1") as f:
-                            content = f.read()
-
-                    # Insertion en base
-                    if source == "WISH":
-                        create_wish_message(db, content)
-                    else:
-                        create_orline_message(db, content)
-
-                    # Suppression du fichier
-                    os.remove(full)
-                    logging.info(f"Backlog removed {full}")
-                finally:
-                    db.close()
-
-    # 2) Démarrage des observers pour les nouveaux fichiers
-    for path, source in WATCHED_FOLDERS.items():
-        handler = HL7Handler(source)
-        obs = Observer()
+        handler = HL7Handler(source, app.state.batch_writer, app.state.file_readiness)
+        obs = create_observer(path, FOLDER_WATCHER_BACKENDS.get(path))
         obs.schedule(handler, path, recursive=False)
         obs.start()
-        logging.info(f"Watcher started on {path} (source={source})")
+        logging.info(f"Watcher (real-time) started on {path} (source={source})")
         app.state.observers.append(obs)
+
+    # Backlog : fichiers déjà présents, traités en tâche de fond (l'API répond pendant l'import)
+    app.state.backlog_progress = BacklogProgress()
+    app.state.backlog_stop = threading.Event()
+    app.state.backlog_thread = start_backlog_import(
+        WATCHED_FOLDERS, SUPPORTED_EXTENSIONS, app.state.batch_writer,
+        app.state.backlog_progress, app.state.backlog_stop
+    )
+
+    # Réception MLLP directe du moteur d'interface (app/mllp.py), si HL7_MLLP_PORT est défini
+    app.state.mllp = None
+    if MLLP_PORT:
+        app.state.mllp = MLLPServer(port=MLLP_PORT)
+        await app.state.mllp.start()
     logging.info("▶️ Lifespan startup end") 
     yield  # l’app démarre ici
     logging.info("⏹ Lifespan shutdown")
     # 3) Arrêt propre
+    if app.state.mllp is not None:
+        await app.state.mllp.stop()
+    app.state.backlog_stop.set()
+    app.state.backlog_thread.join()
     for obs in app.state.observers:
         obs.stop()
         obs.join()
         logging.info("Watcher stopped cleanly")
+    app.state.file_readiness.stop()
+    app.state.batch_writer.stop()
+    offload.shutdown()
+    await async_engine.dispose()
 
 # --- Instanciation de l’app ---
 app = FastAPI(lifespan=lifespan)
@@ -226,39 +211,49 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=[NEXT_CURSOR_HEADER],
 )
-def get_db():
-    db = SessionLocal()
-    try:
-        yield db
-    finally:
-        db.close()
-
-def process_file(filepath: str, source: str, db: Session):
-    try:
-        with open(filepath, 'r', encoding='utf-8') as file:
-            content = file.read()
-    except UnicodeDecodeError:
-        with open(filepath, 'r', encoding='iso-8859-1') as file:
-            content = file.read()
-
-    if source == "WISH":
-        create_wish_message(db=db, hl7_raw_message=content)
-    elif source == "ORLine":
-        create_orline_message(db=db, hl7_raw_message=content)
-
 def process_all_folders():
-    db = SessionLocal()
+    writer = BatchWriter()
+    writer.start()
     try:
         for folder_path, source in WATCHED_FOLDERS.items():
             if not os.path.isdir(folder_path):
                 continue
-            for filename in os.listdir(folder_path):
-                full_path = os.path.join(folder_path, filename)
-                if os.path.isfile(full_path) and os.path.splitext(filename)[1].lower() in SUPPORTED_EXTENSIONS:
-                    process_file(full_path, source, db)
+            files = [(source, full_path) for full_path in list_hl7_files(folder_path, SUPPORTED_EXTENSIONS)]
+            import_backlog(files, writer, delete=False)
     finally:
-        db.close()
+        writer.stop()
+
+@app.get("/metrics/db-pools")
+def get_db_pool_metrics():
+    # Pools API / ingestion : occupation, débordement et attente au checkout
+    return pool_metrics()
+
+@app.get("/metrics/mllp")
+def get_mllp_metrics():
+    return app.state.mllp.stats() if getattr(app.state, "mllp", None) else {"enabled": False}
+
+@app.get("/metrics/ingestion")
+def get_ingestion_metrics():
+    # File d'écriture (profondeur, attente, latence par étape) et fichiers en attente de stabilité
+    return {
+        "writer": app.state.batch_writer.stats(),
+        "file_readiness": app.state.file_readiness.stats(),
+    }
+
+@app.get("/metrics/timeline-cache")
+def get_timeline_cache_metrics():
+    return timeline_cache.stats()
+
+@app.get("/ingestion/backlog-status")
+def get_backlog_status():
+    # Fichiers conservés après import (delete_after_import false) : ceux déjà importés et
+    # inchangés depuis (taille, mtime) sont comptés dans skipped au lieu d'être relus
+    progress = getattr(app.state, "backlog_progress", None)
+    if progress is None:
+        raise HTTPException(status_code=404, detail="Aucun import de backlog en cours.")
+    return progress.snapshot()
 
 @app.post("/process-all/")
 def run_full_importation(db: Session = Depends(get_db)):
@@ -270,49 +265,72 @@ def clear_all_tables(db: Session = Depends(get_db)):
     try:
         db.execute(text("TRUNCATE TABLE hl7_message_wish RESTART IDENTITY CASCADE"))
         db.execute(text("TRUNCATE TABLE hl7_message_orline RESTART IDENTITY CASCADE"))
+        db.execute(text("TRUNCATE TABLE hl7_raw_message, hl7_patient_identifier RESTART IDENTITY"))
+        db.execute(text("TRUNCATE TABLE patient"))
+        db.execute(text("TRUNCATE TABLE hl7_file_index RESTART IDENTITY"))
+        census.reset(db)
         db.commit()
+        timeline_cache.clear()
         return {"message": "Toutes les tables ont été vidées avec succès."}
     except Exception as e:
         db.rollback()
         return {"error": str(e)}
 @app.get("/wish/", response_model=List[HL7MessageWishSchema])
-def get_all_wish_messages(skip: int = 0, limit: int = 1000, db: Session = Depends(get_db)):
-    return db.query(HL7MessageWish).offset(skip).limit(limit).all()
+async def get_all_wish_messages(
+    response: Response,
+    skip: int = 0,
+    limit: int = 1000,
+    cursor: Optional[str] = Query(None, description="Jeton X-Next-Cursor de la page précédente"),
+    order: str = Query("id", enum=list(ORDERS)),
+    db: AsyncSession = Depends(get_async_db)
+):
+    return await keyset_page_async(db, HL7MessageWish, response, limit, cursor, order, skip)
+
+@app.get("/wish/stream")
+def stream_wish_messages(cursor: Optional[str] = None, order: str = Query("id", enum=list(ORDERS))):
+    return stream_ndjson(HL7MessageWish, HL7MessageWishSchema, cursor, order)
 
 @app.get("/orline/", response_model=List[HL7MessageOrlineSchema])
-def get_all_orline_messages(skip: int = 0, limit: int = 1000, db: Session = Depends(get_db)):
-    return db.query(HL7MessageOrline).offset(skip).limit(limit).all()
+async def get_all_orline_messages(
+    response: Response,
+    skip: int = 0,
+    limit: int = 1000,
+    cursor: Optional[str] = Query(None, description="Jeton X-Next-Cursor de la page précédente"),
+    order: str = Query("id", enum=list(ORDERS)),
+    db: AsyncSession = Depends(get_async_db)
+):
+    return await keyset_page_async(db, HL7MessageOrline, response, limit, cursor, order, skip)
+
+@app.get("/orline/stream")
+def stream_orline_messages(cursor: Optional[str] = None, order: str = Query("id", enum=list(ORDERS))):
+    return stream_ndjson(HL7MessageOrline, HL7MessageOrlineSchema, cursor, order)
 
 class PatientsResponse(BaseModel):
     patients: List[str]
     total: int
 
 @app.get("/patients", response_model=PatientsResponse)
-def get_all_patients(source: str = Query("both", enum=["wish", "orline", "both", "intersection"]), db: Session = Depends(get_db)):
-    wish_ids = set([row[0] for row in db.query(HL7MessageWish.cbmrn).filter(HL7MessageWish.cbmrn.isnot(None)).distinct()])
-    orline_ids = set([row[0] for row in db.query(HL7MessageOrline.id_pat).filter(HL7MessageOrline.id_pat.isnot(None)).distinct()])
-
-    if source == "wish":
-        ids = wish_ids
-    elif source == "orline":
-        ids = orline_ids
-    elif source == "intersection":
-        ids = wish_ids & orline_ids
-    else:
-        ids = wish_ids | orline_ids
-
+async def get_all_patients(
+    source: str = Query("both", enum=list(PATIENT_SOURCES)),
+    q: Optional[str] = Query(None, description="Préfixe de l'ID patient"),
+    after: Optional[str] = Query(None, description="Dernier ID de la page précédente"),
+    limit: Optional[int] = Query(None, ge=1, description="Taille de page (défaut : tous)"),
+    db: AsyncSession = Depends(get_async_db)
+):
+    # Dimension patient tenue par l'ingestion (app/patients.py) : filtre, tri et page en SQL
+    total_q, page_q = patients_page(source, q, after, limit)
     return PatientsResponse(
-        total=len(ids),
-        patients=sorted(ids)
+        total=await db.scalar(total_q),
+        patients=(await db.scalars(page_q)).all()
     )
 @app.get("/patient/{id_pat}/sejours", response_model=List[str])
-def get_sejours_by_patient(id_pat: str, db: Session = Depends(get_db)):
-    wish_sejours = db.query(HL7MessageWish.nsej).filter(HL7MessageWish.cbmrn == id_pat, HL7MessageWish.nsej.isnot(None)).distinct().all()
-    orline_sejours = db.query(HL7MessageOrline.id_sejour).filter(HL7MessageOrline.id_pat == id_pat, HL7MessageOrline.id_sejour.isnot(None)).distinct().all()
+async def get_sejours_by_patient(id_pat: str, db: AsyncSession = Depends(get_async_db)):
+    wish_sejours = await db.scalars(select(HL7MessageWish.nsej).where(HL7MessageWish.cbmrn == id_pat, HL7MessageWish.nsej.isnot(None)).distinct())
+    orline_sejours = await db.scalars(select(HL7MessageOrline.id_sejour).where(HL7MessageOrline.id_pat == id_pat, HL7MessageOrline.id_sejour.isnot(None)).distinct())
 
     sejours = set()
-    sejours.update([s[0] for s in wish_sejours if s[0]])
-    sejours.update([s[0] for s in orline_sejours if s[0]])
+    sejours.update([s for s in wish_sejours if s])
+    sejours.update([s for s in orline_sejours if s])
 
     if not sejours:
         raise HTTPException(status_code=404, detail="Aucun séjour trouvé pour ce patient.")
@@ -320,294 +338,81 @@ def get_sejours_by_patient(id_pat: str, db: Session = Depends(get_db)):
     return sorted(sejours)
 
 @app.get("/messages-by-patient/{patient_id}")
-def get_messages_by_patient(patient_id: str, source: str = Query("both", enum=["wish", "orline", "both"]), db: Session = Depends(get_db)):
+async def get_messages_by_patient(patient_id: str, source: str = Query("both", enum=["wish", "orline", "both"]), db: AsyncSession = Depends(get_async_db)):
+    key, cached = timeline_cache.lookup(f"messages:{source}", patient_id)
+    if cached is not None:
+        return FastJSONResponse(cached)
+    # Lignes de colonnes (pas d'objets ORM) encodées par orjson (app/responses.py)
     result = {}
     if source in ["wish", "both"]:
-        wish_messages = db.query(HL7MessageWish).filter(HL7MessageWish.cbmrn == patient_id).all()
-        result["wish_messages"] = [message.__dict__ for message in wish_messages]
+        wish_messages = await db.execute(select(*HL7MessageWish.__table__.c).where(HL7MessageWish.cbmrn == patient_id))
+        result["wish_messages"] = [dict(r._mapping) for r in wish_messages]
     if source in ["orline", "both"]:
-        orline_messages = db.query(HL7MessageOrline).filter(HL7MessageOrline.id_pat == patient_id).all()
-        result["orline_messages"] = [message.__dict__ for message in orline_messages]
+        orline_messages = await db.execute(select(*HL7MessageOrline.__table__.c).where(HL7MessageOrline.id_pat == patient_id))
+        result["orline_messages"] = [dict(r._mapping) for r in orline_messages]
     if not result.get("wish_messages") and not result.get("orline_messages"):
         raise HTTPException(status_code=404, detail="Aucun message trouvé pour cet ID patient.")
-    return result
+    timeline_cache.store(key, result)
+    return FastJSONResponse(result)
 
 @app.get("/messages-by-patient-sejour")
-def get_messages_by_patient_sejour(id_pat: str, id_sejour: str, db: Session = Depends(get_db)):
-    wish_msgs = db.query(HL7MessageWish).filter(
+async def get_messages_by_patient_sejour(id_pat: str, id_sejour: str, db: AsyncSession = Depends(get_async_db)):
+    wish_msgs = await db.execute(select(*HL7MessageWish.__table__.c).where(
         HL7MessageWish.cbmrn == id_pat,
         HL7MessageWish.nsej == id_sejour
-    ).all()
+    ))
 
-    orline_msgs = db.query(HL7MessageOrline).filter(
+    orline_msgs = await db.execute(select(*HL7MessageOrline.__table__.c).where(
         HL7MessageOrline.id_pat == id_pat,
         HL7MessageOrline.id_sejour == id_sejour
-    ).all()
+    ))
 
-    results = [msg.__dict__ for msg in wish_msgs + orline_msgs]
+    results = [dict(r._mapping) for r in wish_msgs] + [dict(r._mapping) for r in orline_msgs]
 
     if not results:
         raise HTTPException(status_code=404, detail="Aucun message trouvé pour ce patient et ce séjour.")
 
-    return results
+    return FastJSONResponse(results)
 
 @app.get("/journey/full/{id_pat}/{id_sejour}")
-def get_patient_journey_one_sejour(id_pat: str, id_sejour: str, db: Session = Depends(get_db)):
-    wish_msgs = db.query(HL7MessageWish).filter(
-        HL7MessageWish.cbmrn == id_pat,
-        HL7MessageWish.nsej == id_sejour
-    ).all()
-
-    orline_msgs = db.query(HL7MessageOrline).filter(
-        HL7MessageOrline.id_pat == id_pat,
-        HL7MessageOrline.id_sejour == id_sejour
-    ).all()
-
-   
-
-    def parse_event(msg: dict, source: str):
-        from datetime import datetime
-
-        def to_dt(s):
-            try:
-                if s is None:
-                    return None
-                return datetime.strptime(s, "%Y-%m-%d %H:%M:%S")
-            except:
-                return None
-
-        date_debut_str = parse_hl7_datetime(msg.get("clfrom") or msg.get("date_message") or msg.get("date_evt") or "")
-        date_fin_str = parse_hl7_datetime(msg.get("clto") or msg.get("date_fin") or msg.get("cltime") or "")
-
-        date_debut = to_dt(date_debut_str)
-        date_fin = to_dt(date_fin_str)
-
-        raw_unite = msg.get("cleent") or msg.get("Service_Name") or ""
-        unite = unit_names.get(raw_unite, raw_unite)
-        service = raw_unite
-        medecin = msg.get("nomm") or msg.get("medecin") or ""
-
-        desc = (msg.get("typ_evt") or msg.get("Event_Description") or "").lower()
-        if "admission" in desc or "entrée" in desc:
-            type_evt = "ADMISSION"
-        elif "sortie" in desc:
-            type_evt = "DISCHARGE"
-        elif "transfert" in desc:
-            type_evt = "TRANSFER"
-        else:
-            return None
-
-        duration = ""
-        if date_debut and date_fin:
-            delta = date_fin - date_debut
-            duration = str(delta)
-
-        return {
-            "debut": date_debut_str,
-            "fin": date_fin_str,
-            "unite": unite,
-            "service": service,
-            "type_evenement": type_evt,
-            "medecin": medecin,
-            "duration": duration
-        }
-
-    parcours = [
-        *[parse_event(msg.__dict__, "WISH") for msg in wish_msgs],
-        *[parse_event(msg.__dict__, "ORLINE") for msg in orline_msgs]
-    ]
-
-    parcours = [p for p in parcours if p and p["debut"]]
-    parcours.sort(key=lambda x: x["debut"])
-
-    if not parcours:
+async def get_patient_journey_one_sejour(id_pat: str, id_sejour: str, db: AsyncSession = Depends(get_async_db)):
+    # Invalidé par l'ingestion d'un message du patient (app/timeline_cache.py)
+    key, cached = timeline_cache.lookup("journey", id_pat, id_sejour)
+    if cached is not None:
+        return FastJSONResponse(cached)
+    # Seules les colonnes lues par sejour_journey sont chargées
+    W, O = HL7MessageWish, HL7MessageOrline
+    wish_msgs = await db.execute(select(*sejour_columns(W.__table__)).where(
+        W.cbmrn == id_pat,
+        W.nsej == id_sejour
+    ).order_by(W.clfrom_ts, W.date_message_ts))
+
+    orline_msgs = await db.execute(select(*sejour_columns(O.__table__)).where(
+        O.id_pat == id_pat,
+        O.id_sejour == id_sejour
+    ).order_by(O.date_message_ts))
+
+    messages = [dict(r._mapping) for r in wish_msgs] + [dict(r._mapping) for r in orline_msgs]
+
+    # Mise en forme hors de la boucle d'événements pour les gros séjours (app/journey.py)
+    journey = await run_cpu(sejour_journey, messages, unit_names, size=len(messages))
+    if journey is None:
         raise HTTPException(status_code=404, detail="Aucun message trouvé pour ce patient et ce séjour.")
-
-    return {
-        "timeline": [
-            {
-                "Unité de soins": p["unite"],
-                "Start": p["debut"].replace("-", "").replace(":", "").replace(" ", ""),
-                "Finish": p["fin"].replace("-", "").replace(":", "").replace(" ", ""),
-                "Resource": p["service"]
-            } for p in parcours
-        ],
-        "events": parcours
-    }
+    timeline_cache.store(key, journey)
+    return FastJSONResponse(journey)
 
 
 @app.get("/hl7/export-all")
-def export_all_messages_to_excel(db: Session = Depends(get_db)):
-    # 1) Charger Wish et construire le DataFrame
-    wish_messages = db.query(HL7MessageWish).yield_per(500)
-    extracted_data = []
-    for msg in wish_messages:
-        nsej = msg.nsej
-        if msg.clrs_cd == "A05":
-         try:
-                if msg.hl7_raw:
-                    for line in msg.hl7_raw.splitlines():
-                        if line.startswith("PV1|"):
-                            parts = line.strip().split("|")
-                            if len(parts) > 6:
-                                raw_nsej = parts[6].strip()
-                                nsej = raw_nsej[1:] if raw_nsej.startswith("1") else raw_nsej
-                            break
-            except Exception:
-                pass
-        else:
-         try:
-                if msg.hl7_raw:
-                    for line in msg.hl7_raw.splitlines():
-                        if line.startswith("PV1|"):
-                            parts = line.strip().split("|")
-                            if len(parts) > 19:
-                                raw_nsej = parts[19].strip()
-                                nsej = raw_nsej[1:] if raw_nsej.startswith("1") else raw_nsej
-                            break
-            except Exception:
-                pass
-           
-        msg_dict = msg.__dict__.copy()
-        msg_dict["nsej"] = msg.nsej
-        extracted_data.append(msg_dict)
-    wish_df = pd.DataFrame(extracted_data)
-    for col in ["_sa_instance_state", "id"]:
-        if col in wish_df.columns:
-            wish_df = wish_df.drop(columns=[col])
-    if "clrs_cd" in wish_df.columns:
-        wish_df = wish_df[wish_df["clrs_cd"].isin(["A01", "A02", "A03"])]
-        wish_df["clrs_cd"] = wish_df["clrs_cd"].map({
-            "A01": "A",
-            "A02": "T",
-            "A03": "D"
-        })
-    if "clfrom" in wish_df.columns:
-        wish_df["clfrom"] = pd.to_datetime(wish_df["clfrom"], errors="coerce")
-        wish_df = wish_df.sort_values(by=["cbmrn", "clfrom"])
-    if "clnsid" in wish_df.columns:
-        wish_df["nsdscr"] = wish_df["clnsid"].map(unit_names).fillna("")
-        wish_df = wish_df[wish_df["clnsid"].isin(unit_names.keys())]
-    wish_df["clfrom"] = pd.to_datetime(wish_df["clfrom"], errors="coerce")
-    wish_df = wish_df.sort_values(["cbmrn", "nsej", "clnsid", "clfrom"])
-    wish_df["prev_clfrom"] = wish_df.groupby(
-        ["cbmrn", "nsej", "clnsid"]
-    )["clfrom"].shift(1)
-    wish_df["delta_min"] = (
-        (wish_df["clfrom"] - wish_df["prev_clfrom"])
-        .dt.total_seconds() / 60.0
-    )
-    to_drop = []
-    for (pat, sej, unit), grp in wish_df.groupby(["cbmrn", "nsej", "clnsid"]):
-        short = grp[grp["delta_min"] < 5.0]
-        if short.empty:
-            continue
-        for idx in short.index:
-            prev = grp.loc[idx, "prev_clfrom"]
-            cur = grp.loc[idx, "clfrom"]
-            two = grp[(grp["clfrom"] == prev) | (grp["clfrom"] == cur)]
-            if "8BLO" in two["clsvtc"].values:
-                drop_idx = two[two["clsvtc"] != "8BLO"].index
-            else:
-                drop_idx = [two.index.min()]
-            to_drop.extend(drop_idx)
-    wish_df = wish_df.drop(index=set(to_drop))
-    wish_df = wish_df.drop(columns=["prev_clfrom", "delta_min"])
-    wish_order = [
-        "clrs_cd", "nsej", "cbmrn", "cbtype", "cbadty", "tsv", "clfrom",
-        "clnsid", "nsdscr", "clroom", "clbed", "clsvtc", "tectxtfr",
-        "cldept", "svnomf", "nrpr", "nomm", "cltima"
-    ]
-    wish_df = wish_df[[c for c in wish_order if c in wish_df.columns]]
-
-    # 2) Charger Orline et construire le DataFrame
-    orline_data = [msg.__dict__ for msg in db.query(HL7MessageOrline).yield_per(500)]
-    orline_df = pd.DataFrame(orline_data)
-    for col in ["_sa_instance_state", "id"]:
-        if col in orline_df.columns:
-            orline_df = orline_df.drop(columns=[col])
-    if "date_message" in orline_df.columns:
-        orline_df["date_message"] = pd.to_datetime(orline_df["date_message"], errors="coerce")
-        orline_df = orline_df.sort_values(by=["id_pat", "date_message"])
-    orline_order = [
-        "date_message", "message_type", "message_id", "id_pat", "id_sejour",
-        "id_ope", "heu_deb_ope_prev", "heu_fin_ope_prev", "tps_ope_prev",
-        "type_ope", "date_ope", "id_sal_ope", "arr_sal_ope", "anesth",
-        "discip", "chir", "planning", "naissance", "sexe"
-    ]
-    orline_df = orline_df[[c for c in orline_order if c in orline_df.columns]]
-
-    preadmissions = []
-    for msg in db.query(HL7MessageWish).filter(HL7MessageWish.clrs_cd == "A05"):
-        # Récupérer le message HL7 depuis le fichier original correspondant à message_id
-        filepath = None
-        for folder_path in WATCHED_FOLDERS:
-            for fname in os.listdir(folder_path):
-                if msg.message_id and msg.message_id in fname:
-                    filepath = os.path.join(folder_path, fname)
-                    break
-            if filepath:
-                break
-
-        nsej_value = msg.nsej
-        if not nsej_value and filepath:
-            try:
-                with open(filepath, "r", encoding="utf-8") as f:
-                    content = f.read()
-            except UnicodeDecodeError:
-                with open(filepath, "r", encoding="iso-8859-1") as f:
-                    content = f.read()
-
-            for line in content.splitlines():
-                if line.startswith("PV1|"):
-                    fields = line.split("|")
-                    if len(fields) > 6 and fields[6]:
-                        nsej_raw = fields[6].strip()
-                        nsej_value = nsej_raw[1:] if nsej_raw.startswith("1") else nsej_raw
-                        break
-        adm_ent = "UAPO" if msg.sour == "O" else "HOSP"
-        if msg.cbadty == "A":
-            adm_sor = "HOSP"
-        elif msg.cbadty == "Z":
-            adm_sor = "HDJ" if msg.clnsid != "225" else "HDJ"
-        else:
-            adm_sor = ""
-        preadmissions.append([
-            msg.cbmrn,
-            msg.clfrom,
-            msg.clnsid,
-            nsej_value,
-            msg.cldept,
-            msg.nomm,
-            msg.cbadty,
-            msg.sour,
-            adm_ent,
-            adm_sor
-        ])
-
-    preadmission_df = pd.DataFrame(
-        preadmissions,
-        columns=["MRN", "Date admission", "Unité Ch. Lit", "N° admission", "Service", "Méd.", "T. adm.", "Sour.", "Adm_Ent", "Adm_Sor"]
-    )
-
-    # 4) Écriture dans un fichier Excel
-    output = io.BytesIO()
-    with pd.ExcelWriter(output, engine="xlsxwriter") as writer:
-        wish_df.to_excel(writer, index=False, sheet_name="Wish Messages")
-        orline_df.to_excel(writer, index=False, sheet_name="Orline Messages")
-        if not preadmission_df.empty:
-            preadmission_df.to_excel(writer, index=False, sheet_name="Pré-admissions")
-    output.seek(0)
+def export_all_messages_to_excel(
+    start: Optional[date] = Query(None, description="Début de période (YYYY-MM-DD)"),
+    end: Optional[date] = Query(None, description="Fin de période incluse (YYYY-MM-DD)"),
+    format: str = Query("xlsx", enum=list(EXPORT_FORMATS)),
+    table: str = Query("wish", enum=list(EXPORT_TABLES), description="Table exportée en csv / parquet"),
+    db: Session = Depends(get_db)
+):
+    # Lecture par curseur serveur et écriture ligne à ligne (app/export.py)
+    return export_messages(db, format, table, unit_names, start, end)
 
-    headers = {
-        "Content-Disposition": 'attachment; filename="hl7_messages_export.xlsx"'
-    }
-    return StreamingResponse(
-        output,
-        media_type="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
-        headers=headers
-    )
-  
 class UserCreate(BaseModel):
     username: str
     password: str
@@ -642,140 +447,47 @@ service_technique_names = {
 }
 
 def format_dt(dt_str: Optional[str]) -> Optional[datetime]:
-    if not dt_str:
-        return None
-    try:
-        return datetime.strptime(dt_str, "%Y-%m-%d %H:%M:%S")
-    except:
-        return None
-
-def fmt_str(dt: datetime) -> str:
-    return dt.strftime("%d/%m/%Y à %H:%M")
-
-def diff_str(start: datetime, end: Optional[datetime]) -> str:
-    if not end:
-        return "en cours"
-    delta = end - start
-    h, rem = divmod(delta.total_seconds(), 3600)
-    m = rem // 60
-    return f"{int(h)} h {int(m)} min"
+    return parse_db_datetime(dt_str)
 
 @app.get("/patient-journey-gantt/{id_pat}")
-def get_patient_journey_detailed(
+async def get_patient_journey_detailed(
     id_pat: str,
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_async_db)
 ) -> List[Dict]:
-    wish_msgs = db.query(HL7MessageWish).filter(HL7MessageWish.cbmrn == id_pat).all()
-    orline_msgs = db.query(HL7MessageOrline).filter(HL7MessageOrline.id_pat == id_pat).all()
-    all_msgs = [*wish_msgs, *orline_msgs]
-
-    raw: List[Dict] = []
-    for msg in all_msgs:
-        d = msg.__dict__
-        code = (d.get("clrs_cd") or "").upper()
-        if code not in {"A01", "A02", "A03"}:
-            continue
-        dt = format_dt(d.get("cltima"))
-        if dt is None:
-            continue
-        raw.append({
-            "nsej": d.get("nsej"),
-            "cbmrn": d.get("cbmrn"),
-            "clnsid": d.get("clnsid") or "",
-            "clsvtc": d.get("clsvtc") or "",
-            "dt": dt,
-            "code": code
-        })
-
-    raw.sort(key=lambda e: e["dt"])
+    # Vue rouverte à chaque tour de service : servie du cache tant qu'aucun message du patient n'arrive
+    key, cached = timeline_cache.lookup("gantt", id_pat)
+    if cached is not None:
+        return FastJSONResponse(cached)
+    # Seuls les messages WISH portent clrs_cd : filtre des codes et tri faits en SQL
+    W = HL7MessageWish
+    wish_msgs = await db.execute(
+        select(W.nsej, W.cbmrn, W.clnsid, W.clsvtc, W.cltima_ts, W.clrs_cd)
+        .where(W.cbmrn == id_pat,
+               W.clrs_cd.in_(["A01", "A02", "A03"]),
+               W.cltima_ts.isnot(None))
+        .order_by(W.cltima_ts, W.id)
+    )
+
+    raw: List[Dict] = [
+        {
+            "nsej": msg.nsej,
+            "cbmrn": msg.cbmrn,
+            "clnsid": msg.clnsid or "",
+            "clsvtc": msg.clsvtc or "",
+            "dt": msg.cltima_ts,
+            "code": msg.clrs_cd
+        }
+        for msg in wish_msgs
+    ]
     if not raw:
         raise HTTPException(404, "Aucun événement A01/A02/A03 trouvé.")
-
-    a01_indices = [i for i, e in enumerate(raw) if e["code"] == "A01"]
-    if not a01_indices:
+    if not any(e["code"] == "A01" for e in raw):
         raise HTTPException(404, "Aucun événement d’admission trouvé.")
-    last_a01_index = max(a01_indices, key=lambda i: raw[i]["dt"])
-    last_admission = raw[last_a01_index]
-    raw = [e for i, e in enumerate(raw) if e["code"] != "A01" or i == last_a01_index]
-
-    filtered = []
-    i = 0
-    while i < len(raw):
-        curr = raw[i]
-        if i + 1 < len(raw):
-            nxt = raw[i + 1]
-            delta = nxt["dt"] - curr["dt"]
-            same_sej = curr["nsej"] == nxt["nsej"]
-            same_unit = curr["clnsid"] == nxt["clnsid"]
-
-            if curr["code"] == "A02" and nxt["code"] == "A02" and same_sej and same_unit and delta < timedelta(minutes=5):
-                # Si l’un des deux contient clsvtc prioritaire, garder celui-là
-                if nxt["clsvtc"] in {"8BLO", "8REV"}:
-                    filtered.append(nxt)
-                elif curr["clsvtc"] in {"8BLO", "8REV"}:
-                    filtered.append(curr)
-                else:
-                    filtered.append(nxt)  # garder le plus récent
-                i += 2
-                continue
-
-            if curr["code"] == "A02" and delta < timedelta(minutes=5) and curr["clsvtc"] not in {"8BLO", "8REV"}:
-                i += 1
-                continue
 
-        filtered.append(curr)
-        i += 1
-
-    admission_dt = last_admission["dt"]
-    filtered.insert(0, last_admission)
-
-    result: List[Dict] = []
-    for idx, ev in enumerate(filtered):
-        is_last = (idx == len(filtered) - 1)
-        dt_evt = fmt_str(ev["dt"])
-        unit = unit_names.get(ev["clnsid"], ev["clnsid"])
-        service = service_technique_names.get(ev["clsvtc"], ev["clsvtc"])
-        code_lbl = {"A01": "ADMISSION", "A02": "TRANSFER", "A03": "DISCHARGE"}[ev["code"]]
-        next_dt = filtered[idx + 1]["dt"] if idx + 1 < len(filtered) else None
-
-        if ev["code"] == "A01":
-            result.append({
-                "NSEJ": ev["nsej"],
-                "CBMRN": ev["cbmrn"],
-                "Resource": f"{ev['code']} - {code_lbl}",
-                "Unité de soins": unit,
-                "Service technique": service,
-                "Date/heure d'événement": dt_evt,
-                "Temps passé": diff_str(ev["dt"], next_dt)
-            })
-            continue
-
-        if ev["code"] == "A02":
-            result.append({
-                "NSEJ": ev["nsej"],
-                "CBMRN": ev["cbmrn"],
-                "Resource": f"{ev['code']} - {code_lbl}",
-                "Unité de soins": unit,
-                "Service technique": service,
-                "Date/heure d'événement": dt_evt,
-                "Temps passé" if not is_last else "Temps passé en cours": diff_str(ev["dt"], next_dt if not is_last else None)
-            })
-            continue
-
-        if ev["code"] == "A03":
-            total = diff_str(admission_dt, ev["dt"])
-            result.append({
-                "NSEJ": ev["nsej"],
-                "CBMRN": ev["cbmrn"],
-                "Resource": f"{ev['code']} - {code_lbl}",
-                "Unité de soins": unit,
-                "Service technique": service,
-                "Date/heure de sortie": dt_evt,
-                "Durée totale de séjour": total
-            })
-            break
-
-    return result
+    # Fusion des transferts et mise en forme hors de la boucle d'événements (app/journey.py)
+    result = await run_cpu(gantt_rows, raw, unit_names, service_technique_names, size=len(raw))
+    timeline_cache.store(key, result)
+    return FastJSONResponse(result)
 
 
 
@@ -802,88 +514,25 @@ def patient_counts_advanced_v2(
     if start_date is None:
         start_date = end_date - timedelta(days=29)
 
-    # 2) Collecte des événements A01/A02/A03 (identique à la version précédente)
-    events: List[Tuple[datetime, str, Tuple[str,str], str]] = []
-    def collect(msg, code_field, time_field, pat_field, seq_field, unit_field):
-        d = msg.__dict__
-        code = (d.get(code_field) or "").upper()
-        if code not in {"A01","A02","A03"}:
-            return
-        ts = d.get(time_field)
-        try:
-            dt = datetime.strptime(ts, "%Y-%m-%d %H:%M:%S")
-        except:
-            return
-        key = (d.get(pat_field), d.get(seq_field))
-        unit = d.get(unit_field) or "Inconnu"
-        events.append((dt, code, key, unit))
-
-    wish = db.query(HL7MessageWish).filter(HL7MessageWish.clrs_cd.in_(["A01","A02","A03"])).all()
-    orline = db.query(HL7MessageOrline).filter(HL7MessageOrline.message_type.in_(["A01","A02","A03"])).all()
-    for m in wish:
-        collect(m, "clrs_cd",      "cltima",      "cbmrn",  "nsej",      "clnsid")
-    for m in orline:
-        collect(m, "message_type", "date_message","id_pat", "id_sejour", "Service_Name")
-
-    # 3) Trier tous les événements
-    events.sort(key=lambda x: x[0])
-
-    # 4) Initialisation avant start_date
-    total = 0
-    by_unit = defaultdict(int)
-    current_stay_unit: Dict[Tuple[str,str], str] = {}
-    for dt, code, key, unit in events:
-        if dt.date() >= start_date:
-            break
-        if code == "A01":
-            total += 1
-            by_unit[unit] += 1
-            current_stay_unit[key] = unit
-        elif code == "A02" and key in current_stay_unit:
-            old = current_stay_unit[key]
-            by_unit[old] -= 1
-            by_unit[unit] += 1
-            current_stay_unit[key] = unit
-        elif code == "A03" and key in current_stay_unit:
-            total -= 1
-            old = current_stay_unit.pop(key)
-            by_unit[old] -= 1
-
-    # 5) Parcours jour par jour
+    # 2) État horaire lu dans le recensement matérialisé (app/census.py) :
+    #    seules les heures absentes ou invalidées par l'ingestion sont rejouées
+    first_hour = datetime.combine(start_date, datetime.min.time())
+    last_hour = datetime.combine(end_date, datetime.min.time()) + timedelta(hours=23)
+    counts = census.hourly_counts(db, first_hour, last_hour)
+
+    # 3) Mise en forme jour par jour
     daily: List[DailyCount] = []
-    idx = 0
     num_days = (end_date - start_date).days + 1
     for i in range(num_days):
         d = start_date + timedelta(days=i)
+        day_start = datetime.combine(d, datetime.min.time())
         hourly_counts: List[HourlyCount] = []
-
         for h in range(24):
-            current_hour = datetime.combine(d, datetime.min.time()) + timedelta(hours=h)
-            next_hour = current_hour + timedelta(hours=1)
-
-            # Appliquer les événements de cette heure
-            while idx < len(events) and current_hour <= events[idx][0] < next_hour:
-                _, code, key, unit = events[idx]
-                if code == "A01":
-                    total += 1
-                    by_unit[unit] += 1
-                    current_stay_unit[key] = unit
-                elif code == "A02" and key in current_stay_unit:
-                    old = current_stay_unit[key]
-                    by_unit[old] -= 1
-                    by_unit[unit] += 1
-                    current_stay_unit[key] = unit
-                elif code == "A03" and key in current_stay_unit:
-                    total -= 1
-                    old = current_stay_unit.pop(key)
-                    by_unit[old] -= 1
-                idx += 1
-
-            snapshot = {u: cnt for u, cnt in by_unit.items() if cnt > 0}
+            total, by_unit = counts[day_start + timedelta(hours=h)]
             hourly_counts.append(HourlyCount(
                 hour=f"{h:02d}:00",
                 total_patients=total,
-                by_unit=snapshot.copy()
+                by_unit=by_unit
             ))
 
         daily.append(DailyCount(
@@ -916,26 +565,40 @@ def patient_counts_advanced_v2(
 import os
 import io
 import logging
-import time
 
 from datetime import datetime, date, timedelta
 from typing import List, Optional, Dict, Tuple
 
-from fastapi import FastAPI, Depends, HTTPException, Query
+from fastapi import FastAPI, Depends, HTTPException, Query, Response
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.responses import StreamingResponse
+from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.orm import Session
-from sqlalchemy import text
+from sqlalchemy import select, text
 from pydantic import BaseModel
 from collections import defaultdict
-from watchdog.observers.polling import PollingObserver as Observer
 from watchdog.events import FileSystemEventHandler
 import pandas as pd
 from contextlib import asynccontextmanager
-from app.database import SessionLocal, create_tables
+from app.database import IngestSessionLocal, async_engine, create_tables, get_db, get_async_db, pool_metrics
 from app.models import HL7MessageWish, HL7MessageOrline
 from app.schemas import HL7MessageWishSchema, HL7MessageOrlineSchema
-from app.crud import create_wish_message, create_orline_message
+import threading
+from app import census, offload, raw_store
+from app.ingestion import (
+    BatchWriter, BacklogProgress, ingest_file, list_hl7_files, import_backlog, start_backlog_import
+)
+from app.watchers import create_observer
+from app.mllp import MLLP_PORT, MLLPServer
+from app.readiness import StabilityScheduler
+from app.pagination import ORDERS, NEXT_CURSOR_HEADER, keyset_page_async, stream_ndjson
+from app.export import EXPORT_FORMATS, EXPORT_TABLES, export_messages
+from app.journey import gantt_rows, sejour_columns, sejour_journey
+from app.responses import FastJSONResponse
+from app.patients import SOURCES as PATIENT_SOURCES, patients_page
+from app.offload import run_cpu
+from app.timeline_cache import timeline_cache
+from app.hl7_datetime import parse_db_datetime
 
 
 create_tables()
@@ -997,6 +660,10 @@ WATCHED_FOLDERS = {
     r"C:\Users\sbenayed\Desktop\ORL_ADT - Copie": "ORLine",
 }
 
+# Backend de surveillance par dossier : "auto" (défaut), "native" ou "polling".
+# Garder "polling" pour les partages réseau où les notifications noyau ne remontent pas.
+FOLDER_WATCHER_BACKENDS: Dict[str, str] = {}
+
 SUPPORTED_EXTENSIONS = [".hl7", ".txt", ".dat", ".xml"]
 
 
@@ -1014,172 +681,149 @@ class PatientCountsResponse(BaseModel):
     daily_counts: List[DailyCount]
 
 
-
-def parse_hl7_datetime(dt_str: str) -> str:
-    if not dt_str:
-        return None
-    try:
-        if len(dt_str) == 12:
-            dt = datetime.strptime(dt_str, "%Y%m%d%H%M")
-        elif len(dt_str) == 14:
-            dt = datetime.strptime(dt_str, "%Y%m%d%H%M%S")
-        else:
-            return dt_str
-        return dt.strftime("%Y-%m-%d %H:%M:%S")
-    except Exception:
-        return dt_str
-
 class HL7Handler(FileSystemEventHandler):
-    def __init__(self, source: str):
+    def __init__(self, source: str, writer: BatchWriter, readiness: StabilityScheduler):
         super().__init__()
         self.source = source
+        self.writer = writer
+        self.readiness = readiness
 
     def on_created(self, event):
         if not event.is_directory:
-            self._process(event.src_path)
+            self._schedule(event.src_path)
 
     def on_moved(self, event):
-        # Fichiers copiés depuis l’explorateur arrivent souvent via un move
+        # Fichiers copiés depuis l’explorateur arrivent souvent via un move : complets dès le renommage
         if not event.is_directory:
-            self._process(event.dest_path)
+            self._schedule(event.dest_path, renamed=True)
 
     def on_modified(self, event):
         # Couvrir d’éventuelles modifications in-place
         if not event.is_directory:
-            self._process(event.src_path)
+            self._schedule(event.src_path)
 
-    def _process(self, path: str):
-        # Laisser Windows finir la copie
-        time.sleep(0.1)
-
-        ext = os.path.splitext(path)[1].lower()
-        if ext not in SUPPORTED_EXTENSIONS:
-            return
+    def _schedule(self, path: str, renamed: bool = False):
+        # Pas d'attente dans le thread de l'observer : le fichier est lu une fois stable (app/readiness.py)
+        if os.path.splitext(path)[1].lower() in SUPPORTED_EXTENSIONS:
+            self.readiness.notify(path, self._process, renamed)
 
-        logging.info(f"→ Processing HL7 file {path} as {ext}")
-        db = SessionLocal()
+    def _process(self, path: str):
+        logging.info(f"→ Processing HL7 file {path}")
         try:
-            # Lecture en UTF-8 ou ISO-8859-1
-            try:
-                with open(path, "r", encoding="utf-8") as f:
-                    content = f.read()
-            except UnicodeDecodeError:
-                with open(path, "r", encoding="iso-8859-1") as f:
-                    content = f.read()
-
-            # Insertion en base
-            if self.source == "WISH":
-                create_wish_message(db, content)
-            else:
-                create_orline_message(db, content)
-
-            # Suppression
-            os.remove(path)
-            logging.info(f"✓ Handled and removed {path}")
+            # Lecture en UTF-8 ou ISO-8859-1, découpée en messages (fichier de lot FHS/BHS ou MSH à la suite).
+            # Insertion par lot ; le fichier est supprimé après le commit du lot. Si la file
+            # d'écriture est pleine, on attend ici : les fichiers suivants restent sur le disque
+            ingest_file(self.writer, self.source, path)
         except Exception as e:
             logging.error(f"Error processing {path}: {e}")
-        finally:
-            db.close()
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     logging.info("▶️ Lifespan startup begin") 
     app.state.observers = []
+    app.state.batch_writer = BatchWriter()
+    app.state.batch_writer.start()
+    app.state.file_readiness = StabilityScheduler()
+    app.state.file_readiness.start()
 
-    # 1) Backlog : traiter les fichiers déjà présents
+    # Ligne d'invalidation du recensement, avant la première écriture
+    db = IngestSessionLocal()
+    try:
+        census.init_state(db)
+    finally:
+        db.close()
+
+    # 1) Observers temps réel (un seul par dossier : chaque événement n'est reçu qu'une fois),
+    # démarrés avant le backlog pour ne manquer aucun fichier déposé pendant l'import
     for path, source in WATCHED_FOLDERS.items():
         os.makedirs(path, exist_ok=True)
-        handler = HL7Handler(source)
-        # Timeout plus court pour quasi-temps réel
-        obs = Observer(timeout=0.5)
+        handler = HL7Handler(source, app.state.batch_writer, app.state.file_readiness)
+        obs = create_observer(path, FOLDER_WATCHER_BACKENDS.get(path))
         obs.schedule(handler, path, recursive=False)
         obs.start()
-        logging.info(f"Watcher (real-time) started on {path}")
-        app.state.observers.append(obs)
-        for fname in os.listdir(path):
-            full = os.path.join(path, fname)
-            ext = os.path.splitext(full)[1].lower()
-            if os.path.isfile(full) and ext in SUPPORTED_EXTENSIONS:
-                logging.info(f"Backlog processing existing file {full}")
-                db = SessionLocal()
-                try:
-                    # Lecture robuste du contenu
-                    try:
-                        with open(full, "r", encoding="utf-8") as f:
-                            content = f.read()
-                    except UnicodeDecodeError:
-                        with open(full, "r", encoding="iso-8859-1") as f:
-                            content = f.read()
-
-                    # Insertion en base
-                    if source == "WISH":
-                        create_wish_message(db, content)
-                    else:
-                        create_orline_message(db, content)
-
-                    # Suppression du fichier
-                    #os.remove(full)
-                    #logging.info(f"Backlog removed {full}")
-                finally:
-                    db.close()
-
-    # 2) Démarrage des observers pour les nouveaux fichiers
-    for path, source in WATCHED_FOLDERS.items():
-        handler = HL7Handler(source)
-        obs = Observer()
-        obs.schedule(handler, path, recursive=False)
-        obs.start()
-        logging.info(f"Watcher started on {path} (source={source})")
+        logging.info(f"Watcher (real-time) started on {path} (source={source})")
         app.state.observers.append(obs)
+
+    # Backlog : fichiers déjà présents, traités en tâche de fond (les fichiers sont conservés)
+    app.state.backlog_progress = BacklogProgress()
+    app.state.backlog_stop = threading.Event()
+    app.state.backlog_thread = start_backlog_import(
+        WATCHED_FOLDERS, SUPPORTED_EXTENSIONS, app.state.batch_writer,
+        app.state.backlog_progress, app.state.backlog_stop, delete=False
+    )
+
+    # Réception MLLP directe du moteur d'interface (app/mllp.py), si HL7_MLLP_PORT est défini
+    app.state.mllp = None
+    if MLLP_PORT:
+        app.state.mllp = MLLPServer(port=MLLP_PORT)
+        await app.state.mllp.start()
     logging.info("▶️ Lifespan startup end") 
     yield  # l’app démarre ici
     logging.info("⏹ Lifespan shutdown")
     # 3) Arrêt propre
+    if app.state.mllp is not None:
+        await app.state.mllp.stop()
+    app.state.backlog_stop.set()
+    app.state.backlog_thread.join()
     for obs in app.state.observers:
         obs.stop()
         obs.join()
         logging.info("Watcher stopped cleanly")
+    app.state.file_readiness.stop()
+    app.state.batch_writer.stop()
+    offload.shutdown()
+    await async_engine.dispose()
 
 # --- Instanciation de l’app ---
-app = FastAPI()
+app = FastAPI(lifespan=lifespan)
 app.add_middleware(
     CORSMiddleware,
     allow_origins=["http://http://localhost:3001"],
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=[NEXT_CURSOR_HEADER],
 )
-def get_db():
-    db = SessionLocal()
-    try:
-        yield db
-    finally:
-        db.close()
-
-def process_file(filepath: str, source: str, db: Session):
-    try:
-        with open(filepath, 'r', encoding='utf-8') as file:
-            content = file.read()
-    except UnicodeDecodeError:
-        with open(filepath, 'r', encoding='iso-8859-1') as file:
-            content = file.read()
-
-    if source == "WISH":
-        create_wish_message(db=db, hl7_raw_message=content)
-    elif source == "ORLine":
-        create_orline_message(db=db, hl7_raw_message=content)
-
 def process_all_folders():
-    db = SessionLocal()
+    writer = BatchWriter()
+    writer.start()
     try:
         for folder_path, source in WATCHED_FOLDERS.items():
             if not os.path.isdir(folder_path):
                 continue
-            for filename in os.listdir(folder_path):
-                full_path = os.path.join(folder_path, filename)
-                if os.path.isfile(full_path) and os.path.splitext(filename)[1].lower() in SUPPORTED_EXTENSIONS:
-                    process_file(full_path, source, db)
+            files = [(source, full_path) for full_path in list_hl7_files(folder_path, SUPPORTED_EXTENSIONS)]
+            import_backlog(files, writer, delete=False)
     finally:
-        db.close()
+        writer.stop()
+
+@app.get("/metrics/db-pools")
+def get_db_pool_metrics():
+    # Pools API / ingestion : occupation, débordement et attente au checkout
+    return pool_metrics()
+
+@app.get("/metrics/mllp")
+def get_mllp_metrics():
+    return app.state.mllp.stats() if getattr(app.state, "mllp", None) else {"enabled": False}
+
+@app.get("/metrics/ingestion")
+def get_ingestion_metrics():
+    # File d'écriture (profondeur, attente, latence par étape) et fichiers en attente de stabilité
+    return {
+        "writer": app.state.batch_writer.stats(),
+        "file_readiness": app.state.file_readiness.stats(),
+    }
+
+@app.get("/metrics/timeline-cache")
+def get_timeline_cache_metrics():
+    return timeline_cache.stats()
+
+@app.get("/ingestion/backlog-status")
+def get_backlog_status():
+    # Fichiers conservés après import (delete_after_import false) : ceux déjà importés et
+    # inchangés depuis (taille, mtime) sont comptés dans skipped au lieu d'être relus
+    progress = getattr(app.state, "backlog_progress", None)
+    if progress is None:
+        raise HTTPException(status_code=404, detail="Aucun import de backlog en cours.")
+    return progress.snapshot()
 
 @app.post("/process-all/")
 def run_full_importation(db: Session = Depends(get_db)):
@@ -1191,49 +835,72 @@ def clear_all_tables(db: Session = Depends(get_db)):
     try:
         db.execute(text("TRUNCATE TABLE hl7_message_wish RESTART IDENTITY CASCADE"))
         db.execute(text("TRUNCATE TABLE hl7_message_orline RESTART IDENTITY CASCADE"))
+        db.execute(text("TRUNCATE TABLE hl7_raw_message, hl7_patient_identifier RESTART IDENTITY"))
+        db.execute(text("TRUNCATE TABLE patient"))
+        db.execute(text("TRUNCATE TABLE hl7_file_index RESTART IDENTITY"))
+        census.reset(db)
         db.commit()
+        timeline_cache.clear()
         return {"message": "Toutes les tables ont été vidées avec succès."}
     except Exception as e:
         db.rollback()
         return {"error": str(e)}
 @app.get("/wish/", response_model=List[HL7MessageWishSchema])
-def get_all_wish_messages(skip: int = 0, limit: int = 1000, db: Session = Depends(get_db)):
-    return db.query(HL7MessageWish).offset(skip).limit(limit).all()
+async def get_all_wish_messages(
+    response: Response,
+    skip: int = 0,
+    limit: int = 1000,
+    cursor: Optional[str] = Query(None, description="Jeton X-Next-Cursor de la page précédente"),
+    order: str = Query("id", enum=list(ORDERS)),
+    db: AsyncSession = Depends(get_async_db)
+):
+    return await keyset_page_async(db, HL7MessageWish, response, limit, cursor, order, skip)
+
+@app.get("/wish/stream")
+def stream_wish_messages(cursor: Optional[str] = None, order: str = Query("id", enum=list(ORDERS))):
+    return stream_ndjson(HL7MessageWish, HL7MessageWishSchema, cursor, order)
 
 @app.get("/orline/", response_model=List[HL7MessageOrlineSchema])
-def get_all_orline_messages(skip: int = 0, limit: int = 1000, db: Session = Depends(get_db)):
-    return db.query(HL7MessageOrline).offset(skip).limit(limit).all()
+async def get_all_orline_messages(
+    response: Response,
+    skip: int = 0,
+    limit: int = 1000,
+    cursor: Optional[str] = Query(None, description="Jeton X-Next-Cursor de la page précédente"),
+    order: str = Query("id", enum=list(ORDERS)),
+    db: AsyncSession = Depends(get_async_db)
+):
+    return await keyset_page_async(db, HL7MessageOrline, response, limit, cursor, order, skip)
+
+@app.get("/orline/stream")
+def stream_orline_messages(cursor: Optional[str] = None, order: str = Query("id", enum=list(ORDERS))):
+    return stream_ndjson(HL7MessageOrline, HL7MessageOrlineSchema, cursor, order)
 
 class PatientsResponse(BaseModel):
     patients: List[str]
     total: int
 
 @app.get("/patients", response_model=PatientsResponse)
-def get_all_patients(source: str = Query("both", enum=["wish", "orline", "both", "intersection"]), db: Session = Depends(get_db)):
-    wish_ids = set([row[0] for row in db.query(HL7MessageWish.cbmrn).filter(HL7MessageWish.cbmrn.isnot(None)).distinct()])
-    orline_ids = set([row[0] for row in db.query(HL7MessageOrline.id_pat).filter(HL7MessageOrline.id_pat.isnot(None)).distinct()])
-
-    if source == "wish":
-        ids = wish_ids
-    elif source == "orline":
-        ids = orline_ids
-    elif source == "intersection":
-        ids = wish_ids & orline_ids
-    else:
-        ids = wish_ids | orline_ids
-
+async def get_all_patients(
+    source: str = Query("both", enum=list(PATIENT_SOURCES)),
+    q: Optional[str] = Query(None, description="Préfixe de l'ID patient"),
+    after: Optional[str] = Query(None, description="Dernier ID de la page précédente"),
+    limit: Optional[int] = Query(None, ge=1, description="Taille de page (défaut : tous)"),
+    db: AsyncSession = Depends(get_async_db)
+):
+    # Dimension patient tenue par l'ingestion (app/patients.py) : filtre, tri et page en SQL
+    total_q, page_q = patients_page(source, q, after, limit)
     return PatientsResponse(
-        total=len(ids),
-        patients=sorted(ids)
+        total=await db.scalar(total_q),
+        patients=(await db.scalars(page_q)).all()
     )
 @app.get("/patient/{id_pat}/sejours", response_model=List[str])
-def get_sejours_by_patient(id_pat: str, db: Session = Depends(get_db)):
-    wish_sejours = db.query(HL7MessageWish.nsej).filter(HL7MessageWish.cbmrn == id_pat, HL7MessageWish.nsej.isnot(None)).distinct().all()
-    orline_sejours = db.query(HL7MessageOrline.id_sejour).filter(HL7MessageOrline.id_pat == id_pat, HL7MessageOrline.id_sejour.isnot(None)).distinct().all()
+async def get_sejours_by_patient(id_pat: str, db: AsyncSession = Depends(get_async_db)):
+    wish_sejours = await db.scalars(select(HL7MessageWish.nsej).where(HL7MessageWish.cbmrn == id_pat, HL7MessageWish.nsej.isnot(None)).distinct())
+    orline_sejours = await db.scalars(select(HL7MessageOrline.id_sejour).where(HL7MessageOrline.id_pat == id_pat, HL7MessageOrline.id_sejour.isnot(None)).distinct())
 
     sejours = set()
-    sejours.update([s[0] for s in wish_sejours if s[0]])
-    sejours.update([s[0] for s in orline_sejours if s[0]])
+    sejours.update([s for s in wish_sejours if s])
+    sejours.update([s for s in orline_sejours if s])
 
     if not sejours:
         raise HTTPException(status_code=404, detail="Aucun séjour trouvé pour ce patient.")
@@ -1241,225 +908,81 @@ def get_sejours_by_patient(id_pat: str, db: Session = Depends(get_db)):
     return sorted(sejours)
 
 @app.get("/messages-by-patient/{patient_id}")
-def get_messages_by_patient(patient_id: str, source: str = Query("both", enum=["wish", "orline", "both"]), db: Session = Depends(get_db)):
+async def get_messages_by_patient(patient_id: str, source: str = Query("both", enum=["wish", "orline", "both"]), db: AsyncSession = Depends(get_async_db)):
+    key, cached = timeline_cache.lookup(f"messages:{source}", patient_id)
+    if cached is not None:
+        return FastJSONResponse(cached)
+    # Lignes de colonnes (pas d'objets ORM) encodées par orjson (app/responses.py)
     result = {}
     if source in ["wish", "both"]:
-        wish_messages = db.query(HL7MessageWish).filter(HL7MessageWish.cbmrn == patient_id).all()
-        result["wish_messages"] = [message.__dict__ for message in wish_messages]
+        wish_messages = await db.execute(select(*HL7MessageWish.__table__.c).where(HL7MessageWish.cbmrn == patient_id))
+        result["wish_messages"] = [dict(r._mapping) for r in wish_messages]
     if source in ["orline", "both"]:
-        orline_messages = db.query(HL7MessageOrline).filter(HL7MessageOrline.id_pat == patient_id).all()
-        result["orline_messages"] = [message.__dict__ for message in orline_messages]
+        orline_messages = await db.execute(select(*HL7MessageOrline.__table__.c).where(HL7MessageOrline.id_pat == patient_id))
+        result["orline_messages"] = [dict(r._mapping) for r in orline_messages]
     if not result.get("wish_messages") and not result.get("orline_messages"):
         raise HTTPException(status_code=404, detail="Aucun message trouvé pour cet ID patient.")
-    return result
+    timeline_cache.store(key, result)
+    return FastJSONResponse(result)
 
 @app.get("/messages-by-patient-sejour")
-def get_messages_by_patient_sejour(id_pat: str, id_sejour: str, db: Session = Depends(get_db)):
-    wish_msgs = db.query(HL7MessageWish).filter(
+async def get_messages_by_patient_sejour(id_pat: str, id_sejour: str, db: AsyncSession = Depends(get_async_db)):
+    wish_msgs = await db.execute(select(*HL7MessageWish.__table__.c).where(
         HL7MessageWish.cbmrn == id_pat,
         HL7MessageWish.nsej == id_sejour
-    ).all()
+    ))
 
-    orline_msgs = db.query(HL7MessageOrline).filter(
+    orline_msgs = await db.execute(select(*HL7MessageOrline.__table__.c).where(
         HL7MessageOrline.id_pat == id_pat,
         HL7MessageOrline.id_sejour == id_sejour
-    ).all()
+    ))
 
-    results = [msg.__dict__ for msg in wish_msgs + orline_msgs]
+    results = [dict(r._mapping) for r in wish_msgs] + [dict(r._mapping) for r in orline_msgs]
 
     if not results:
         raise HTTPException(status_code=404, detail="Aucun message trouvé pour ce patient et ce séjour.")
 
-    return results
+    return FastJSONResponse(results)
 
 @app.get("/journey/full/{id_pat}/{id_sejour}")
-def get_patient_journey_one_sejour(id_pat: str, id_sejour: str, db: Session = Depends(get_db)):
-    wish_msgs = db.query(HL7MessageWish).filter(
-        HL7MessageWish.cbmrn == id_pat,
-        HL7MessageWish.nsej == id_sejour
-    ).all()
-
-    orline_msgs = db.query(HL7MessageOrline).filter(
-        HL7MessageOrline.id_pat == id_pat,
-        HL7MessageOrline.id_sejour == id_sejour
-    ).all()
-
-   
-
-    def parse_event(msg: dict, source: str):
-        from datetime import datetime
-
-        def to_dt(s):
-            try:
-                if s is None:
-                    return None
-                return datetime.strptime(s, "%Y-%m-%d %H:%M:%S")
-            except:
-                return None
-
-        date_debut_str = parse_hl7_datetime(msg.get("clfrom") or msg.get("date_message") or msg.get("date_evt") or "")
-        date_fin_str = parse_hl7_datetime(msg.get("clto") or msg.get("date_fin") or msg.get("cltime") or "")
-
-        date_debut = to_dt(date_debut_str)
-        date_fin = to_dt(date_fin_str)
-
-        raw_unite = msg.get("cleent") or msg.get("Service_Name") or ""
-        unite = unit_names.get(raw_unite, raw_unite)
-        service = raw_unite
-        medecin = msg.get("nomm") or msg.get("medecin") or ""
-
-        desc = (msg.get("typ_evt") or msg.get("Event_Description") or "").lower()
-        if "admission" in desc or "entrée" in desc:
-            type_evt = "ADMISSION"
-        elif "sortie" in desc:
-            type_evt = "DISCHARGE"
-        elif "transfert" in desc:
-            type_evt = "TRANSFER"
-        else:
-            return None
-
-        duration = ""
-        if date_debut and date_fin:
-            delta = date_fin - date_debut
-            duration = str(delta)
-
-        return {
-            "debut": date_debut_str,
-            "fin": date_fin_str,
-            "unite": unite,
-            "service": service,
-            "type_evenement": type_evt,
-            "medecin": medecin,
-            "duration": duration
-        }
-
-    parcours = [
-        *[parse_event(msg.__dict__, "WISH") for msg in wish_msgs],
-        *[parse_event(msg.__dict__, "ORLINE") for msg in orline_msgs]
-    ]
-
-    parcours = [p for p in parcours if p and p["debut"]]
-    parcours.sort(key=lambda x: x["debut"])
-
-    if not parcours:
+async def get_patient_journey_one_sejour(id_pat: str, id_sejour: str, db: AsyncSession = Depends(get_async_db)):
+    # Invalidé par l'ingestion d'un message du patient (app/timeline_cache.py)
+    key, cached = timeline_cache.lookup("journey", id_pat, id_sejour)
+    if cached is not None:
+        return FastJSONResponse(cached)
+    # Seules les colonnes lues par sejour_journey sont chargées
+    W, O = HL7MessageWish, HL7MessageOrline
+    wish_msgs = await db.execute(select(*sejour_columns(W.__table__)).where(
+        W.cbmrn == id_pat,
+        W.nsej == id_sejour
+    ).order_by(W.clfrom_ts, W.date_message_ts))
+
+    orline_msgs = await db.execute(select(*sejour_columns(O.__table__)).where(
+        O.id_pat == id_pat,
+        O.id_sejour == id_sejour
+    ).order_by(O.date_message_ts))
+
+    messages = [dict(r._mapping) for r in wish_msgs] + [dict(r._mapping) for r in orline_msgs]
+
+    # Mise en forme hors de la boucle d'événements pour les gros séjours (app/journey.py)
+    journey = await run_cpu(sejour_journey, messages, unit_names, size=len(messages))
+    if journey is None:
         raise HTTPException(status_code=404, detail="Aucun message trouvé pour ce patient et ce séjour.")
-
-    return {
-        "timeline": [
-            {
-                "Unité de soins": p["unite"],
-                "Start": p["debut"].replace("-", "").replace(":", "").replace(" ", ""),
-                "Finish": p["fin"].replace("-", "").replace(":", "").replace(" ", ""),
-                "Resource": p["service"]
-            } for p in parcours
-        ],
-        "events": parcours
-    }
+    timeline_cache.store(key, journey)
+    return FastJSONResponse(journey)
 
 
 @app.get("/hl7/export-all")
-def export_all_messages_to_excel(db: Session = Depends(get_db)):
-    # 1) Charger Wish et construire le DataFrame
-    wish_messages = db.query(HL7MessageWish).all()
-    wish_data = [msg.__dict__ for msg in wish_messages]
-    wish_df = pd.DataFrame(wish_data)
-    # Supprimer les colonnes inutiles
-    for col in ["_sa_instance_state", "id"]:
-        if col in wish_df.columns:
-            wish_df = wish_df.drop(columns=[col])
-    if "clrs_cd" in wish_df.columns:
-        wish_df = wish_df[wish_df["clrs_cd"].isin(["A01", "A02", "A03"])]
-        wish_df["clrs_cd"] = wish_df["clrs_cd"].map({
-            "A01": "A",
-            "A02": "T",
-            "A03": "D"
-        })
-    if "clfrom" in wish_df.columns:
-       wish_df["clfrom"] = pd.to_datetime(wish_df["clfrom"], errors="coerce")
-       wish_df = wish_df.sort_values(by=["cbmrn", "clfrom"])
-    if "clnsid" in wish_df.columns:
-       wish_df["nsdscr"] = wish_df["clnsid"].map(unit_names).fillna("")
-       wish_df = wish_df[wish_df["clnsid"].isin(unit_names.keys())]
-    wish_df["clfrom"] = pd.to_datetime(wish_df["clfrom"], errors="coerce")
-    wish_df = wish_df.sort_values(["cbmrn", "nsej", "clnsid", "clfrom"])
-    wish_df["prev_clfrom"] = wish_df.groupby(
-      ["cbmrn", "nsej", "clnsid"]
-    )["clfrom"].shift(1)
-    wish_df["delta_min"] = (
-       (wish_df["clfrom"] - wish_df["prev_clfrom"])
-       .dt.total_seconds() / 60.0
-    )
-    to_drop = []
-    for (pat, sej, unit), grp in wish_df.groupby(["cbmrn", "nsej", "clnsid"]):
-       # repère les indices où delta < 5
-       short = grp[grp["delta_min"] < 5.0]
-       if short.empty:
-         continue
-       # pour chacun de ces cas, on regarde si l’un des deux a clsvtc == "8BLO"
-       for idx in short.index:
-          # ligne actuelle et précédente
-          prev = grp.loc[idx, "prev_clfrom"]
-          cur = grp.loc[idx, "clfrom"]
-          # sous-groupe de ces deux lignes
-          two = grp[(grp["clfrom"] == prev) | (grp["clfrom"] == cur)]
-          if "8BLO" in two["clsvtc"].values:
-              # on supprime toutes sauf celle avec 8BLO
-              drop_idx = two[two["clsvtc"] != "8BLO"].index
-          else:
-             # on supprime toutes sauf la plus récente
-             drop_idx = [two.index.min()]
-          to_drop.extend(drop_idx)
-
-    # ❺ On débarrasse wish_df des lignes indésirables
-    wish_df = wish_df.drop(index=set(to_drop))
-
-    # ❻ On peut nettoyer les colonnes intermédiaires
-    wish_df = wish_df.drop(columns=["prev_clfrom", "delta_min"])
-    # 2) Réordonner les colonnes selon votre liste
-    wish_order = [
-        "clrs_cd", "nsej", "cbmrn", "cbtype", "cbadty", "tsv", "clfrom",
-        "clnsid", "nsdscr", "clroom", "clbed", "clsvtc", "tectxtfr",
-        "cldept", "svnomf", "nrpr", "nomm", "cltima"
-    ]
-    # Garde seulement les colonnes existantes, dans l’ordre
-    wish_df = wish_df[[c for c in wish_order if c in wish_df.columns]]
-
-    # 3) Charger Orline et construire le DataFrame
-    orline_messages = db.query(HL7MessageOrline).all()
-    orline_data = [msg.__dict__ for msg in orline_messages]
-    orline_df = pd.DataFrame(orline_data)
-    for col in ["_sa_instance_state", "id"]:
-        if col in orline_df.columns:
-            orline_df = orline_df.drop(columns=[col])
-    if "date_message" in orline_df.columns:
-        orline_df["date_message"] = pd.to_datetime(orline_df["date_message"], errors="coerce")
-        orline_df = orline_df.sort_values(by=["id_pat", "date_message"])
-
-    # 4) Réordonner les colonnes selon votre liste
-    orline_order = [
-        "date_message", "message_type", "message_id", "id_pat", "id_sejour",
-        "id_ope", "heu_deb_ope_prev", "heu_fin_ope_prev", "tps_ope_prev",
-        "type_ope", "date_ope", "id_sal_ope", "arr_sal_ope", "anesth",
-        "discip", "chir", "planning", "naissance", "sexe"
-    ]
-    orline_df = orline_df[[c for c in orline_order if c in orline_df.columns]]
-
-    # 5) Écrire dans un fichier Excel en mémoire, deux feuilles
-    output = io.BytesIO()
-    with pd.ExcelWriter(output, engine="xlsxwriter") as writer:
-        wish_df.to_excel(writer, index=False, sheet_name="Wish Messages")
-        orline_df.to_excel(writer, index=False, sheet_name="Orline Messages")
-    output.seek(0)
+def export_all_messages_to_excel(
+    start: Optional[date] = Query(None, description="Début de période (YYYY-MM-DD)"),
+    end: Optional[date] = Query(None, description="Fin de période incluse (YYYY-MM-DD)"),
+    format: str = Query("xlsx", enum=list(EXPORT_FORMATS)),
+    table: str = Query("wish", enum=list(EXPORT_TABLES), description="Table exportée en csv / parquet"),
+    db: Session = Depends(get_db)
+):
+    # Lecture par curseur serveur et écriture ligne à ligne (app/export.py)
+    return export_messages(db, format, table, unit_names, start, end)
 
-    # 6) Retour en StreamingResponse pour téléchargement
-    headers = {
-        "Content-Disposition": 'attachment; filename="hl7_messages_export.xlsx"'
-    }
-    return StreamingResponse(
-        output,
-        media_type="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
-        headers=headers
-    )
 class UserCreate(BaseModel):
     username: str
     password: str
@@ -1496,183 +1019,59 @@ service_technique_names = {
 }
 
 def format_dt(dt_str: Optional[str]) -> Optional[datetime]:
-    if not dt_str:
-        return None
-    try:
-        return datetime.strptime(dt_str, "%Y-%m-%d %H:%M:%S")
-    except:
-        return None
-
-def fmt_str(dt: datetime) -> str:
-    return dt.strftime("%d/%m/%Y à %H:%M")
-
-def diff_str(start: datetime, end: Optional[datetime]) -> str:
-    if not end:
-        return "en cours"
-    delta = end - start
-    h, rem = divmod(delta.total_seconds(), 3600)
-    m = rem // 60
-    return f"{int(h)} h {int(m)} min"
+    return parse_db_datetime(dt_str)
 
 @app.get("/patient-journey-gantt/{id_pat}")
-def get_patient_journey_detailed(
+async def get_patient_journey_detailed(
     id_pat: str,
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_async_db)
 ) -> List[Dict]:
-    wish_msgs = db.query(HL7MessageWish).filter(HL7MessageWish.cbmrn == id_pat).all()
-    orline_msgs = db.query(HL7MessageOrline).filter(HL7MessageOrline.id_pat == id_pat).all()
-    all_msgs = [*wish_msgs, *orline_msgs]
-
-    raw: List[Dict] = []
-    for msg in all_msgs:
-        d = msg.__dict__
-        code = (d.get("clrs_cd") or "").upper()
-        if code not in {"A01", "A02", "A03"}:
-            continue
-        dt = format_dt(d.get("cltima"))
-        if dt is None:
-            continue
-        raw.append({
-            "nsej": d.get("nsej"),
-            "cbmrn": d.get("cbmrn"),
-            "clnsid": d.get("clnsid") or "",
-            "clsvtc": d.get("clsvtc") or "",
-            "dt": dt,
-            "code": code
-        })
-
-    raw.sort(key=lambda e: e["dt"])
+    # Vue rouverte à chaque tour de service : servie du cache tant qu'aucun message du patient n'arrive
+    key, cached = timeline_cache.lookup("gantt", id_pat)
+    if cached is not None:
+        return FastJSONResponse(cached)
+    # Seuls les messages WISH portent clrs_cd : filtre des codes et tri faits en SQL
+    W = HL7MessageWish
+    wish_msgs = await db.execute(
+        select(W.nsej, W.cbmrn, W.clnsid, W.clsvtc, W.cltima_ts, W.clrs_cd)
+        .where(W.cbmrn == id_pat,
+               W.clrs_cd.in_(["A01", "A02", "A03"]),
+               W.cltima_ts.isnot(None))
+        .order_by(W.cltima_ts, W.id)
+    )
+
+    raw: List[Dict] = [
+        {
+            "nsej": msg.nsej,
+            "cbmrn": msg.cbmrn,
+            "clnsid": msg.clnsid or "",
+            "clsvtc": msg.clsvtc or "",
+            "dt": msg.cltima_ts,
+            "code": msg.clrs_cd
+        }
+        for msg in wish_msgs
+    ]
     if not raw:
         raise HTTPException(404, "Aucun événement A01/A02/A03 trouvé.")
-
-    a01_indices = [i for i, e in enumerate(raw) if e["code"] == "A01"]
-    if not a01_indices:
+    if not any(e["code"] == "A01" for e in raw):
         raise HTTPException(404, "Aucun événement d’admission trouvé.")
-    last_a01_index = max(a01_indices, key=lambda i: raw[i]["dt"])
-    last_admission = raw[last_a01_index]
-    raw = [e for i, e in enumerate(raw) if e["code"] != "A01" or i == last_a01_index]
-
-    filtered = []
-    i = 0
-    while i < len(raw):
-        curr = raw[i]
-        if i + 1 < len(raw):
-            nxt = raw[i + 1]
-            delta = nxt["dt"] - curr["dt"]
-            same_sej = curr["nsej"] == nxt["nsej"]
-            same_unit = curr["clnsid"] == nxt["clnsid"]
-
-            if curr["code"] == "A02" and nxt["code"] == "A02" and same_sej and same_unit and delta < timedelta(minutes=5):
-                # Si l’un des deux contient clsvtc prioritaire, garder celui-là
-                if nxt["clsvtc"] in {"8BLO", "8REV"}:
-                    filtered.append(nxt)
-                elif curr["clsvtc"] in {"8BLO", "8REV"}:
-                    filtered.append(curr)
-                else:
-                    filtered.append(nxt)  # garder le plus récent
-                i += 2
-                continue
-
-            if curr["code"] == "A02" and delta < timedelta(minutes=5) and curr["clsvtc"] not in {"8BLO", "8REV"}:
-                i += 1
-                continue
 
-        filtered.append(curr)
-        i += 1
-
-    admission_dt = last_admission["dt"]
-    filtered.insert(0, last_admission)
-
-    result: List[Dict] = []
-    for idx, ev in enumerate(filtered):
-        is_last = (idx == len(filtered) - 1)
-        dt_evt = fmt_str(ev["dt"])
-        unit = unit_names.get(ev["clnsid"], ev["clnsid"])
-        service = service_technique_names.get(ev["clsvtc"], ev["clsvtc"])
-        code_lbl = {"A01": "ADMISSION", "A02": "TRANSFER", "A03": "DISCHARGE"}[ev["code"]]
-        next_dt = filtered[idx + 1]["dt"] if idx + 1 < len(filtered) else None
-
-        if ev["code"] == "A01":
-            result.append({
-                "NSEJ": ev["nsej"],
-                "CBMRN": ev["cbmrn"],
-                "Resource": f"{ev['code']} - {code_lbl}",
-                "Unité de soins": unit,
-                "Service technique": service,
-                "Date/heure d'événement": dt_evt,
-                "Temps passé": diff_str(ev["dt"], next_dt)
-            })
-            continue
-
-        if ev["code"] == "A02":
-            result.append({
-                "NSEJ": ev["nsej"],
-                "CBMRN": ev["cbmrn"],
-                "Resource": f"{ev['code']} - {code_lbl}",
-                "Unité de soins": unit,
-                "Service technique": service,
-                "Date/heure d'événement": dt_evt,
-                "Temps passé" if not is_last else "Temps passé en cours": diff_str(ev["dt"], next_dt if not is_last else None)
-            })
-            continue
-
-        if ev["code"] == "A03":
-            total = diff_str(admission_dt, ev["dt"])
-            result.append({
-                "NSEJ": ev["nsej"],
-                "CBMRN": ev["cbmrn"],
-                "Resource": f"{ev['code']} - {code_lbl}",
-                "Unité de soins": unit,
-                "Service technique": service,
-                "Date/heure de sortie": dt_evt,
-                "Durée totale de séjour": total
-            })
-            break
-
-    return result
+    # Fusion des transferts et mise en forme hors de la boucle d'événements (app/journey.py)
+    result = await run_cpu(gantt_rows, raw, unit_names, service_technique_names, size=len(raw))
+    timeline_cache.store(key, result)
+    return FastJSONResponse(result)
 
 
 
 
 @app.get("/hl7/export-patient/{patient_id}")
-def export_patient_messages_to_excel(patient_id: str):
-    def extract_from_folder(folder_path: str, patient_id: str) -> list:
-        rows = []
-        for fname in os.listdir(folder_path):
-            if not any(fname.endswith(ext) for ext in SUPPORTED_EXTENSIONS):
-                continue
-            fpath = os.path.join(folder_path, fname)
-            try:
-                with open(fpath, "r", encoding="utf-8") as f:
-                    content = f.read()
-            except UnicodeDecodeError:
-                with open(fpath, "r", encoding="iso-8859-1") as f:
-                    content = f.read()
-
-            # Vérifie la présence de l'ID patient dans les PID
-            found = False
-            for line in content.splitlines():
-                if line.startswith("PID|"):
-                    fields = line.split("|")
-                    if len(fields) > 3:
-                        if patient_id in fields[3].split("^"):
-                            found = True
-                            break
-            if not found:
-                continue
-
-            for line in content.splitlines():
-                row = [fname] + line.strip().split("|")
-                rows.append(row)
-        return rows
-
-    # Récupération depuis les dossiers
+def export_patient_messages_to_excel(patient_id: str, db: Session = Depends(get_db)):
+    # Messages du patient retrouvés par l'index PID-3 (app/raw_store.py), sans parcourir les dossiers
     wish_data, orline_data = [], []
-    for folder_path, label in WATCHED_FOLDERS.items():
-        if label == "WISH":
-            wish_data.extend(extract_from_folder(folder_path, patient_id))
-        elif label == "ORLine":
-            orline_data.extend(extract_from_folder(folder_path, patient_id))
+    for source, message_id, content in raw_store.patient_messages(db, patient_id):
+        rows = wish_data if source == "WISH" else orline_data
+        for line in content.splitlines():
+            rows.append([message_id] + line.strip().split("|"))
 
     if not wish_data and not orline_data:
         raise HTTPException(404, detail="Aucun message brut trouvé pour ce patient.")
@@ -1681,8 +1080,8 @@ def export_patient_messages_to_excel(patient_id: str):
     wish_cols = max((len(r) for r in wish_data), default=0)
     orline_cols = max((len(r) for r in orline_data), default=0)
 
-    wish_headers = ["Fichier", "Segment"] + [f"Field_{i}" for i in range(1, wish_cols - 1)] if wish_data else []
-    orline_headers = ["Fichier", "Segment"] + [f"Field_{i}" for i in range(1, orline_cols - 1)] if orline_data else []
+    wish_headers = ["Message", "Segment"] + [f"Field_{i}" for i in range(1, wish_cols - 1)] if wish_data else []
+    orline_headers = ["Message", "Segment"] + [f"Field_{i}" for i in range(1, orline_cols - 1)] if orline_data else []
 
     df_wish = pd.DataFrame(wish_data, columns=wish_headers)
     df_orline = pd.DataFrame(orline_data, columns=orline_headers)
@@ -1725,88 +1124,25 @@ def patient_counts_advanced_v2(
     if start_date is None:
         start_date = end_date - timedelta(days=29)
 
-    # 2) Collecte des événements A01/A02/A03 (identique à la version précédente)
-    events: List[Tuple[datetime, str, Tuple[str,str], str]] = []
-    def collect(msg, code_field, time_field, pat_field, seq_field, unit_field):
-        d = msg.__dict__
-        code = (d.get(code_field) or "").upper()
-        if code not in {"A01","A02","A03"}:
-            return
-        ts = d.get(time_field)
-        try:
-            dt = datetime.strptime(ts, "%Y-%m-%d %H:%M:%S")
-        except:
-            return
-        key = (d.get(pat_field), d.get(seq_field))
-        unit = d.get(unit_field) or "Inconnu"
-        events.append((dt, code, key, unit))
-
-    wish = db.query(HL7MessageWish).filter(HL7MessageWish.clrs_cd.in_(["A01","A02","A03"])).all()
-    orline = db.query(HL7MessageOrline).filter(HL7MessageOrline.message_type.in_(["A01","A02","A03"])).all()
-    for m in wish:
-        collect(m, "clrs_cd",      "cltima",      "cbmrn",  "nsej",      "clnsid")
-    for m in orline:
-        collect(m, "message_type", "date_message","id_pat", "id_sejour", "Service_Name")
-
-    # 3) Trier tous les événements
-    events.sort(key=lambda x: x[0])
-
-    # 4) Initialisation avant start_date
-    total = 0
-    by_unit = defaultdict(int)
-    current_stay_unit: Dict[Tuple[str,str], str] = {}
-    for dt, code, key, unit in events:
-        if dt.date() >= start_date:
-            break
-        if code == "A01":
-            total += 1
-            by_unit[unit] += 1
-            current_stay_unit[key] = unit
-        elif code == "A02" and key in current_stay_unit:
-            old = current_stay_unit[key]
-            by_unit[old] -= 1
-            by_unit[unit] += 1
-            current_stay_unit[key] = unit
-        elif code == "A03" and key in current_stay_unit:
-            total -= 1
-            old = current_stay_unit.pop(key)
-            by_unit[old] -= 1
-
-    # 5) Parcours jour par jour
+    # 2) État horaire lu dans le recensement matérialisé (app/census.py) :
+    #    seules les heures absentes ou invalidées par l'ingestion sont rejouées
+    first_hour = datetime.combine(start_date, datetime.min.time())
+    last_hour = datetime.combine(end_date, datetime.min.time()) + timedelta(hours=23)
+    counts = census.hourly_counts(db, first_hour, last_hour)
+
+    # 3) Mise en forme jour par jour
     daily: List[DailyCount] = []
-    idx = 0
     num_days = (end_date - start_date).days + 1
     for i in range(num_days):
         d = start_date + timedelta(days=i)
+        day_start = datetime.combine(d, datetime.min.time())
         hourly_counts: List[HourlyCount] = []
-
         for h in range(24):
-            current_hour = datetime.combine(d, datetime.min.time()) + timedelta(hours=h)
-            next_hour = current_hour + timedelta(hours=1)
-
-            # Appliquer les événements de cette heure
-            while idx < len(events) and current_hour <= events[idx][0] < next_hour:
-                _, code, key, unit = events[idx]
-                if code == "A01":
-                    total += 1
-                    by_unit[unit] += 1
-                    current_stay_unit[key] = unit
-                elif code == "A02" and key in current_stay_unit:
-                    old = current_stay_unit[key]
-                    by_unit[old] -= 1
-                    by_unit[unit] += 1
-                    current_stay_unit[key] = unit
-                elif code == "A03" and key in current_stay_unit:
-                    total -= 1
-                    old = current_stay_unit.pop(key)
-                    by_unit[old] -= 1
-                idx += 1
-
-            snapshot = {u: cnt for u, cnt in by_unit.items() if cnt > 0}
+            total, by_unit = counts[day_start + timedelta(hours=h)]
             hourly_counts.append(HourlyCount(
                 hour=f"{h:02d}:00",
                 total_patients=total,
-                by_unit=snapshot.copy()
+                by_unit=by_unit
             ))
 
         daily.append(DailyCount(
@@ -0,0 +1,256 @@
+# app/mllp.py
+"""
+Réception MLLP (HL7 v2 sur TCP) directement depuis le moteur d'interface,
+sans passer par les dossiers surveillés.
+
+Chaque trame (\\x0b message \\x1c\\r) est routée vers WISH ou ORLine selon
+l'application émettrice (MSH-3), parsée dans un thread (la boucle asyncio
+est celle de l'API quand l'écoute est lancée par main), puis confiée à un
+BatchWriter dédié : l'ACK (MSA AA) n'est renvoyé qu'après le commit du lot
+qui contient le message ; AE si l'écriture échoue, AR si le message n'est
+pas routable.
+
+Les ACK d'une connexion partent dans l'ordre des messages reçus ; un
+émetteur peut envoyer plusieurs messages sans attendre (fenêtre
+HL7_MLLP_WINDOW). Contre-pression : au-delà de HL7_MLLP_MAX_INFLIGHT messages
+non commités (toutes connexions confondues), les connexions ne sont plus
+lues et TCP ralentit les émetteurs.
+
+Écoute activée par HL7_MLLP_PORT (au démarrage de l'API), ou seule :
+
+    python -m app.mllp [--host 0.0.0.0] [--port 2575]
+"""
+
+import os
+import sys
+import time
+import uuid
+import asyncio
+import logging
+import argparse
+from datetime import datetime
+from typing import Dict, List, Optional, Tuple
+
+from app.crud import parse_messages
+from app.hl7_splitter import split_messages
+from app.hl7_tokenizer import separators, tokenize
+from app.ingestion import BatchWriter, BATCH_SIZE
+
+START_BLOCK = b"\x0b"
+END_BLOCK = b"\x1c\r"
+
+MLLP_HOST = os.getenv("HL7_MLLP_HOST", "0.0.0.0")
+# Port d'écoute ; 0 = pas d'écoute MLLP au démarrage de l'API
+MLLP_PORT = int(os.getenv("HL7_MLLP_PORT", "0"))
+# Messages non commités au total / par connexion avant de cesser de lire
+MAX_INFLIGHT = int(os.getenv("HL7_MLLP_MAX_INFLIGHT", "2000"))
+WINDOW = int(os.getenv("HL7_MLLP_WINDOW", "100"))
+# Taille max d'une trame (octets) : au-delà, la connexion est fermée
+MAX_FRAME_BYTES = int(os.getenv("HL7_MLLP_MAX_FRAME_BYTES", str(16 * 1024 * 1024)))
+# Attente max avant écriture d'un lot : chaque ACK en dépend
+BATCH_MAX_WAIT = float(os.getenv("HL7_MLLP_BATCH_MAX_WAIT", "0.05"))
+# Application émettrice (MSH-3, premier composant) → source, ex. "WISH=WISH,ORLINE=ORLine"
+ROUTES = {
+    app.strip().upper(): source.strip()
+    for app, _, source in (
+        item.partition("=") for item in os.getenv("HL7_MLLP_ROUTES", "WISH=WISH,ORLINE=ORLine").split(",")
+    )
+    if app.strip()
+}
+
+ENCODINGS = ("utf-8", "iso-8859-1")
+
+
+def decode(data: bytes) -> str:
+    for encoding in ENCODINGS[:-1]:
+        try:
+            return data.decode(encoding)
+        except UnicodeDecodeError:
+            pass
+    return data.decode(ENCODINGS[-1])
+
+
+def frame(message: str) -> bytes:
+    return START_BLOCK + message.encode("utf-8") + END_BLOCK
+
+
+def msh_fields(message: str) -> List[str]:
+    """Champs du premier MSH (index n-1 pour MSH-n) ; [] s'il n'y en a pas."""
+    field_sep, _ = separators(message)
+    for _, line in tokenize(message, ("MSH",), field_sep, ignore_case=True):
+        return line.split(field_sep)
+    return []
+
+
+def build_ack(message: str, code: str, text: str = "") -> str:
+    """ACK HL7 (MSH + MSA) du message : émetteur et destinataire inversés, MSA-2 = MSH-10."""
+    field_sep, component_sep = separators(message)
+    msh = msh_fields(message)
+    get = lambda n: msh[n - 1] if len(msh) > n - 1 else ""
+    encoding = get(2) or "^~\\&"
+    trigger = get(9).split(component_sep)[1] if component_sep in get(9) else ""
+    header = [
+        "MSH", encoding, get(5), get(6), get(3), get(4), datetime.now().strftime("%Y%m%d%H%M%S"), "",
+        f"ACK{component_sep}{trigger}" if trigger else "ACK", uuid.uuid4().hex[:20], get(11) or "P", get(12) or "2.3",
+    ]
+    msa = ["MSA", code, get(10)] + ([text.replace(field_sep, " ")] if text else [])
+    return field_sep.join(header) + "\r" + field_sep.join(msa) + "\r"
+
+
+def route(message: str, routes: Dict[str, str] = ROUTES) -> Optional[str]:
+    """Source (WISH / ORLine) du message d'après MSH-3 ; None si l'émetteur est inconnu."""
+    msh = msh_fields(message)
+    if len(msh) < 3:
+        return None
+    _, component_sep = separators(message)
+    return routes.get(msh[2].split(component_sep)[0].strip().upper())
+
+
+def _parse(source: str, message: str) -> list:
+    return parse_messages(source, split_messages(message))
+
+
+class MLLPServer:
+    def __init__(self, writer: Optional[BatchWriter] = None, host: str = MLLP_HOST, port: int = MLLP_PORT,
+                 max_inflight: int = MAX_INFLIGHT, window: int = WINDOW):
+        self.host = host
+        self.port = port
+        self.window = window
+        # File non bornée : submit est appelé depuis la boucle asyncio et ne doit jamais
+        # bloquer ; la contre-pression passe par HL7_MLLP_MAX_INFLIGHT
+        self.writer = writer or BatchWriter(batch_size=BATCH_SIZE, max_wait=BATCH_MAX_WAIT, queue_size=0)
+        self._own_writer = writer is None
+        self._inflight = asyncio.Semaphore(max_inflight)
+        self._server: Optional[asyncio.AbstractServer] = None
+        self._handlers: Dict[asyncio.Task, Tuple[asyncio.StreamReader, asyncio.StreamWriter]] = {}
+        self.acks: Dict[str, int] = {"AA": 0, "AE": 0, "AR": 0}
+
+    async def start(self):
+        if self._own_writer:
+            self.writer.start()
+        self._server = await asyncio.start_server(self._handle, self.host, self.port, limit=MAX_FRAME_BYTES)
+        self.port = self._server.sockets[0].getsockname()[1]
+        logging.info(f"MLLP listener started on {self.host}:{self.port} (routes={ROUTES})")
+
+    async def stop(self):
+        """Ferme l'écoute et les connexions, puis écrit les messages en attente."""
+        if self._server is not None:
+            self._server.close()
+            # Les messages déjà reçus sont commités et acquittés avant la fermeture
+            for reader, writer in self._handlers.values():
+                writer.transport.pause_reading()
+                reader.feed_eof()
+            await asyncio.gather(*self._handlers, return_exceptions=True)
+            await self._server.wait_closed()
+            self._server = None
+        if self._own_writer:
+            await asyncio.to_thread(self.writer.stop)
+        logging.info("MLLP listener stopped cleanly")
+
+    def stats(self) -> dict:
+        return {
+            "connections": len(self._handlers),
+            **{f"ack_{code}": n for code, n in self.acks.items()},
+            "writer": self.writer.stats(),
+        }
+
+    async def _handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        peer = writer.get_extra_info("peername")
+        self._handlers[asyncio.current_task()] = (reader, writer)
+        pending: asyncio.Queue = asyncio.Queue(maxsize=self.window)
+        sender = asyncio.create_task(self._send_acks(pending, writer))
+        try:
+            while True:
+                try:
+                    data = await reader.readuntil(END_BLOCK)
+                except asyncio.IncompleteReadError:
+                    break  # fin de connexion (une trame incomplète est ignorée)
+                except asyncio.LimitOverrunError:
+                    logging.error(f"MLLP frame from {peer} exceeds {MAX_FRAME_BYTES} bytes, closing")
+                    break
+                start = data.find(START_BLOCK)
+                await self._inflight.acquire()
+                # Trame suivante lue après le parsing : les messages d'une connexion restent dans l'ordre
+                await pending.put(await self._submit(decode(data[start + 1:-len(END_BLOCK)])))
+        except ConnectionError:
+            pass
+        finally:
+            await pending.put(None)
+            await sender
+            del self._handlers[asyncio.current_task()]
+            writer.close()
+
+    async def _send_acks(self, pending: asyncio.Queue, writer: asyncio.StreamWriter):
+        broken = False
+        while True:
+            fut = await pending.get()
+            if fut is None:
+                return
+            ack = await fut
+            if broken:
+                continue
+            try:
+                writer.write(frame(ack))
+                await writer.drain()
+            except ConnectionError:
+                # L'émetteur renverra les messages non acquittés ; ils restent écrits
+                broken = True
+
+    async def _submit(self, message: str) -> asyncio.Future:
+        loop = asyncio.get_running_loop()
+        fut = loop.create_future()
+
+        def done(code: str, text: str = ""):
+            self._inflight.release()
+            self.acks[code] += 1
+            fut.set_result(build_ack(message, code, text))
+
+        source = route(message)
+        if source is None:
+            done("AR", "Application émettrice inconnue")
+            return fut
+        start = time.monotonic()
+        try:
+            # Découpage, parsing et compression hors de la boucle
+            messages = await asyncio.to_thread(_parse, source, message)
+            self.writer.latency.record("parse", time.monotonic() - start)
+        except Exception as e:
+            logging.error(f"Error parsing MLLP {source} message: {e}")
+            done("AE", "Message illisible")
+            return fut
+        if not messages:
+            done("AR", "Message vide")
+            return fut
+
+        def on_commit(ok: bool):
+            # Appelé par le thread du writer après le commit (ou l'échec) du lot
+            loop.call_soon_threadsafe(done, "AA" if ok else "AE", "" if ok else "Erreur d'écriture en base")
+
+        self.writer.submit(source, messages, on_commit=on_commit)
+        return fut
+
+
+async def serve(host: str, port: int):
+    server = MLLPServer(host=host, port=port)
+    await server.start()
+    try:
+        await asyncio.Event().wait()
+    finally:
+        await server.stop()
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="Réception HL7 v2 par MLLP.")
+    parser.add_argument("--host", default=MLLP_HOST)
+    parser.add_argument("--port", type=int, default=MLLP_PORT or 2575)
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO)
+    try:
+        asyncio.run(serve(args.host, args.port))
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,11 +1,21 @@
 # app/models.py
 
-from sqlalchemy import Column, Integer, String
+from sqlalchemy import Column, Integer, BigInteger, String, DateTime, Date, Index, JSON, LargeBinary, ForeignKey, Boolean
 from app.database import Base
 
 # ✅ Classe pour la table hl7_message_wish
 class HL7MessageWish(Base):
     __tablename__ = "hl7_message_wish"
+    __table_args__ = (
+        # Parcours / séjours d'un patient
+        Index("ix_wish_cbmrn_nsej_cltima_ts", "cbmrn", "nsej", "cltima_ts"),
+        # Recensement : événements A01/A02/A03 par fenêtre de temps
+        Index("ix_wish_clrs_cd_cltima_ts", "clrs_cd", "cltima_ts"),
+        # Pagination par curseur en ordre chronologique
+        Index("ix_wish_date_message_ts_id", "date_message_ts", "id"),
+        # Ingestion idempotente : INSERT ... ON CONFLICT DO NOTHING (voir app/crud.py)
+        Index("uq_wish_message_id", "message_id", unique=True),
+    )
 
     id = Column(Integer, primary_key=True, index=True)
     message_id = Column(String, nullable=True)
@@ -27,10 +37,20 @@ class HL7MessageWish(Base):
     nrpr = Column(String, nullable=True)
     nomm = Column(String, nullable=True)
     cltima = Column(String, nullable=True)
+    # Versions typées des horodatages, pour filtrer/trier en SQL
+    date_message_ts = Column(DateTime, nullable=True)
+    clfrom_ts = Column(DateTime, nullable=True)
+    cltima_ts = Column(DateTime, nullable=True)
 
 # ✅ Classe pour la table hl7_message_orline
 class HL7MessageOrline(Base):
     __tablename__ = "hl7_message_orline"
+    __table_args__ = (
+        Index("ix_orline_id_pat_id_sejour_date_message_ts", "id_pat", "id_sejour", "date_message_ts"),
+        Index("ix_orline_message_type_date_message_ts", "message_type", "date_message_ts"),
+        Index("ix_orline_date_message_ts_id", "date_message_ts", "id"),
+        Index("uq_orline_message_id", "message_id", unique=True),
+    )
 
     id = Column(Integer, primary_key=True, index=True)
     message_id = Column(String, nullable=True)
@@ -53,3 +73,94 @@ class HL7MessageOrline(Base):
     naissance = Column(String, nullable=True)
     sexe = Column(String, nullable=True)
     arr_sal_ope = Column(String, nullable=True)
+    # Versions typées des dates, pour filtrer/trier en SQL
+    date_message_ts = Column(DateTime, nullable=True)
+    date_ope_date = Column(Date, nullable=True)
+    arr_sal_ope_ts = Column(DateTime, nullable=True)
+    naissance_date = Column(Date, nullable=True)
+
+# ✅ Index message_id → fichier HL7 d'origine (voir app/file_index.py)
+class HL7FileIndex(Base):
+    __tablename__ = "hl7_file_index"
+
+    id = Column(Integer, primary_key=True)
+    source = Column(String, nullable=False)
+    message_id = Column(String, nullable=False)
+    path = Column(String, nullable=False)
+    # Position du message dans le fichier (0 : un message par fichier)
+    offset = Column(Integer, nullable=False, default=0)
+    # Taille et mtime du fichier à son import : l'import du backlog saute les fichiers inchangés
+    size = Column(BigInteger, nullable=True)
+    mtime_ns = Column(BigInteger, nullable=True)
+
+    __table_args__ = (
+        # Réimporter un fichier conservé n'ajoute pas d'entrées ; message_id en tête pour lookup()
+        Index("uq_file_index_message_id_source_path", "message_id", "source", "path", unique=True),
+        Index("ix_hl7_file_index_path", "path"),
+    )
+
+# ✅ Messages HL7 bruts compressés (voir app/raw_store.py)
+class HL7RawMessage(Base):
+    __tablename__ = "hl7_raw_message"
+
+    id = Column(Integer, primary_key=True)
+    source = Column(String, nullable=False)
+    message_id = Column(String)
+    patient_id = Column(String, index=True)
+    received_at = Column(DateTime, nullable=False)
+    payload = Column(LargeBinary, nullable=False)
+
+    __table_args__ = (
+        # Un message par (source, message_id) ; message_id en tête pour les recherches par message_id seul
+        Index("uq_raw_message_message_id_source", "message_id", "source", unique=True),
+    )
+
+# ✅ Index inversé PID-3 → message brut (export patient)
+class HL7PatientIdentifier(Base):
+    __tablename__ = "hl7_patient_identifier"
+
+    id = Column(Integer, primary_key=True)
+    identifier = Column(String, nullable=False)
+    raw_id = Column(Integer, ForeignKey("hl7_raw_message.id", ondelete="CASCADE"), nullable=False)
+
+    __table_args__ = (
+        Index("ix_patient_identifier_identifier_raw_id", "identifier", "raw_id"),
+    )
+
+# ✅ Dimension patient tenue à jour par l'ingestion (voir app/patients.py)
+class Patient(Base):
+    __tablename__ = "patient"
+
+    # Collation C : tri, pagination et recherche par préfixe servis par la clé primaire
+    patient_id = Column(String(collation="C"), primary_key=True)
+    first_seen = Column(DateTime, nullable=True)
+    last_seen = Column(DateTime, nullable=True)
+    in_wish = Column(Boolean, nullable=False, default=False)
+    in_orline = Column(Boolean, nullable=False, default=False)
+
+# ✅ Recensement horaire matérialisé (voir app/census.py)
+class CensusHour(Base):
+    __tablename__ = "census_hour"
+
+    # Début de l'heure ; l'état est celui après tous les événements de l'heure
+    hour = Column(DateTime, primary_key=True)
+    total = Column(Integer, nullable=False)
+    by_unit = Column(JSON, nullable=False)
+
+# ✅ Point de reprise du rejeu : état complet avant `taken_at` (minuit)
+class CensusSnapshot(Base):
+    __tablename__ = "census_snapshot"
+
+    taken_at = Column(DateTime, primary_key=True)
+    total = Column(Integer, nullable=False)
+    by_unit = Column(JSON, nullable=False)
+    # Séjours en cours : [[id_patient, id_sejour, unité], ...]
+    stays = Column(JSON, nullable=False)
+
+# ✅ Ligne unique : borne d'invalidation posée par l'ingestion
+class CensusState(Base):
+    __tablename__ = "census_state"
+
+    id = Column(Integer, primary_key=True)
+    dirty_from = Column(DateTime, nullable=True)
+    generation = Column(Integer, nullable=False, default=0)
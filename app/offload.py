@@ -0,0 +1,47 @@
+# app/offload.py
+"""
+Pool de processus pour le post-traitement CPU des endpoints async.
+
+La boucle d'événements ne fait que les accès base (asyncpg) ; la mise en
+forme des gros parcours est envoyée à un processus du pool, pour qu'une
+requête lourde ne bloque ni la boucle ni les requêtes courtes.
+"""
+
+import os
+import asyncio
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+from typing import Callable, Optional
+
+# Processus de calcul (0 = tout reste dans la boucle d'événements)
+CPU_WORKERS = int(os.getenv("HL7_CPU_WORKERS", str(min(4, os.cpu_count() or 1))))
+# En dessous, le calcul coûte moins que l'aller-retour vers un processus
+OFFLOAD_MIN_ITEMS = int(os.getenv("HL7_OFFLOAD_MIN_ITEMS", "500"))
+
+_pool: Optional[ProcessPoolExecutor] = None
+_lock = threading.Lock()
+
+
+def _executor() -> ProcessPoolExecutor:
+    global _pool
+    with _lock:
+        if _pool is None:
+            _pool = ProcessPoolExecutor(max_workers=CPU_WORKERS)
+        return _pool
+
+
+async def run_cpu(fn: Callable, *args, size: int = OFFLOAD_MIN_ITEMS):
+    """Exécute `fn(*args)` dans le pool ; sur place si `size` (éléments traités) est petit."""
+    if CPU_WORKERS <= 0 or size < OFFLOAD_MIN_ITEMS:
+        return fn(*args)
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_executor(), partial(fn, *args))
+
+
+def shutdown():
+    global _pool
+    with _lock:
+        if _pool is not None:
+            _pool.shutdown(cancel_futures=True)
+            _pool = None
@@ -0,0 +1,144 @@
+# app/pagination.py
+"""
+Pagination par curseur (keyset) et export NDJSON en flux pour /wish/ et /orline/.
+
+Le curseur est opaque pour le client (base64url d'un petit JSON) et porte la
+clé de la dernière ligne servie : `id`, ou (`date_message_ts`, `id`) pour
+l'ordre chronologique. La page suivante part de cette clé au lieu de relire
+et jeter `skip` lignes ; l'ordre est stable même pendant l'ingestion.
+"""
+
+import json
+import base64
+from datetime import datetime
+from typing import Iterator, List, Optional
+
+from fastapi import HTTPException, Response
+from fastapi.responses import StreamingResponse
+from sqlalchemy import Select, select, tuple_
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import Session
+
+from app.database import SessionLocal
+from app.responses import dumps
+
+NEXT_CURSOR_HEADER = "X-Next-Cursor"
+# "id" : ordre d'insertion ; "time" : date_message_ts puis id (dates inconnues en dernier)
+ORDERS = ("id", "time")
+# Lignes lues par aller-retour par le curseur serveur du flux NDJSON
+STREAM_FETCH_SIZE = 1000
+
+
+def encode_cursor(order: str, row) -> str:
+    payload = {"o": order, "id": row.id}
+    if order == "time":
+        ts = row.date_message_ts
+        payload["t"] = ts.isoformat() if ts else None
+    raw = json.dumps(payload, separators=(",", ":")).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip("=")
+
+
+def decode_cursor(token: str, order: str) -> dict:
+    try:
+        payload = json.loads(base64.urlsafe_b64decode(token + "=" * (-len(token) % 4)))
+        cursor = {"id": int(payload["id"]), "t": payload.get("t")}
+        if payload["o"] != order:
+            raise ValueError("ordre différent")
+        if cursor["t"] is not None:
+            cursor["t"] = datetime.fromisoformat(cursor["t"])
+        return cursor
+    except (ValueError, KeyError, TypeError):
+        raise HTTPException(status_code=400, detail="Curseur invalide.")
+
+
+def _ordered(model, order: str, cursor: Optional[dict]) -> List[Select]:
+    """
+    Requêtes successives donnant la suite de `cursor`, dans l'ordre. En ordre
+    chronologique après une date connue : d'abord les dates suivantes, par
+    comparaison de tuples (date_message_ts, id) > (t, x) qui se positionne
+    directement dans ix_*_date_message_ts_id, puis la queue des dates
+    inconnues. Un OR avec IS NULL obligerait à parcourir l'index depuis le début.
+    """
+    stmt = select(model)
+    if order != "time":
+        if cursor is not None:
+            stmt = stmt.where(model.id > cursor["id"])
+        return [stmt.order_by(model.id)]
+    ts = model.date_message_ts
+    if cursor is None:
+        return [stmt.order_by(ts.asc().nulls_last(), model.id)]
+    tail = stmt.where(ts.is_(None)).order_by(model.id)
+    if cursor["t"] is None:
+        # Déjà dans la queue des dates inconnues
+        return [tail.where(model.id > cursor["id"])]
+    dated = stmt.where(ts.isnot(None), tuple_(ts, model.id) > tuple_(cursor["t"], cursor["id"]))
+    return [dated.order_by(ts, model.id), tail]
+
+
+def _page(model, cursor: Optional[str], order: str, skip: int) -> List[Select]:
+    """Requêtes de la page : la suivante n'est lue que si la précédente n'a pas rempli la page."""
+    parsed = decode_cursor(cursor, order) if cursor else None
+    stmts = _ordered(model, order, parsed)
+    if parsed is None and skip:
+        # Sans curseur, une seule requête
+        stmts = [stmt.offset(skip) for stmt in stmts]
+    return stmts
+
+
+def _set_next_cursor(response: Response, rows: List, limit: int, order: str):
+    if rows and len(rows) == limit:
+        response.headers[NEXT_CURSOR_HEADER] = encode_cursor(order, rows[-1])
+
+
+def keyset_page(db: Session, model, response: Response, limit: int, cursor: Optional[str] = None,
+                order: str = "id", skip: int = 0) -> List:
+    """
+    Une page de `model` après `cursor`. Si la page est pleine, le jeton de la
+    suivante est renvoyé dans l'en-tête X-Next-Cursor. `skip` (pagination par
+    offset) reste accepté sans curseur, pour les clients existants.
+    """
+    rows = []
+    for stmt in _page(model, cursor, order, skip):
+        rows.extend(db.execute(stmt.limit(limit - len(rows))).scalars().all())
+        if len(rows) == limit:
+            break
+    _set_next_cursor(response, rows, limit, order)
+    return rows
+
+
+async def keyset_page_async(db: AsyncSession, model, response: Response, limit: int,
+                            cursor: Optional[str] = None, order: str = "id", skip: int = 0) -> List:
+    """keyset_page pour les endpoints async."""
+    rows = []
+    for stmt in _page(model, cursor, order, skip):
+        rows.extend((await db.execute(stmt.limit(limit - len(rows)))).scalars().all())
+        if len(rows) == limit:
+            break
+    _set_next_cursor(response, rows, limit, order)
+    return rows
+
+
+def stream_ndjson(model, schema, cursor: Optional[str] = None, order: str = "id") -> StreamingResponse:
+    """
+    Toute la table en NDJSON (une ligne JSON par message), lue par un curseur
+    serveur : mémoire constante quelle que soit la taille de la table.
+    """
+    parsed = decode_cursor(cursor, order) if cursor else None
+    # Colonnes du schéma lues en tuples, sans objets ORM ni validation par ligne
+    columns = [model.__table__.c[name] for name in schema.model_fields]
+    stmts = [
+        stmt.with_only_columns(*columns).execution_options(yield_per=STREAM_FETCH_SIZE)
+        for stmt in _ordered(model, order, parsed)
+    ]
+
+    def lines() -> Iterator[bytes]:
+        # Session propre au flux : celle de la requête est fermée avant la fin de l'envoi
+        db = SessionLocal()
+        try:
+            for stmt in stmts:
+                for rows in db.execute(stmt).partitions():
+                    yield b"".join(dumps(row._asdict()) + b"\n" for row in rows)
+        finally:
+            db.close()
+
+    return StreamingResponse(lines(), media_type="application/x-ndjson")
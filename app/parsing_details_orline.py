@@ -1,20 +1,19 @@
 from datetime import datetime
+from app.hl7_tokenizer import tokenize, separators
+from app.hl7_splitter import split_messages
+from app.hl7_datetime import parse_hl7_ts, hl7_to_slashed, hl7_to_slashed_date, parse_db_datetime, parse_db_date
+
+# Segments lus par le parser ORLine (les autres ne sont jamais découpés)
+ORLINE_SEGMENTS = ("MSH", "EVN", "PID", "PV1", "PV2", "SCH", "OBX", "AIP", "AIL")
 
 def format_datetime_yyyy_mm_dd_hh_mm_ss(date_str):
     """Convertit une chaine 'YYYYMMDDHHMMSS' en 'YYYY/MM/DD HH:MM:SS'."""
-    try:
-        return datetime.strptime(date_str, "%Y%m%d%H%M%S") \
-                       .strftime("%Y/%m/%d %H:%M:%S")
-    except Exception:
-        return None
+    return hl7_to_slashed(date_str)
 
 def format_date_yyyy_mm_dd(date_str):
     """Convertit une chaine commençant par 'YYYYMMDD' en 'YYYY/MM/DD 00:00:00'."""
-    try:
-        d = datetime.strptime(date_str[:8], "%Y%m%d")
-        return d.strftime("%Y/%m/%d 00:00:00")
-    except Exception:
-        return None
+    d = hl7_to_slashed_date(date_str)
+    return f"{d} 00:00:00" if d else None
 
 def format_time_hh_mm_ss(time_str):
     """Convertit une chaine 'HHMMSS' en 'HH:MM:SS', puis ajoute la date du jour."""
@@ -25,18 +24,16 @@ def format_time_hh_mm_ss(time_str):
         return None
 def format_date_only_yyyy_mm_dd(date_str):
     """Convertit 'YYYYMMDD...' en 'YYYY/MM/DD'."""
-    try:
-        return datetime.strptime(date_str[:8], "%Y%m%d").strftime("%Y/%m/%d")
-    except Exception:
-        return None
+    return hl7_to_slashed_date(date_str)
 def parse_datetime(dt_str):
-    try:
-        return format_datetime_yyyy_mm_dd_hh_mm_ss(dt_str)
-    except Exception:
-        return None
+    return format_datetime_yyyy_mm_dd_hh_mm_ss(dt_str)
+
+def parse_details_hl7_orline_batch(hl7_text):
+    """Un dict par message du texte (lot FHS/BHS ou MSH à la suite)."""
+    return [parse_details_hl7_orline_specific(message) for _, message in split_messages(hl7_text)]
 
 def parse_details_hl7_orline_specific(hl7_message):
-    lignes = hl7_message.strip().splitlines()
+    sep, comp = separators(hl7_message)
 
     champs = {
         "message_id": None,
@@ -61,17 +58,17 @@ def parse_details_hl7_orline_specific(hl7_message):
         "tps_ope_prev": None
     }
     raw_dt ={"date_ope":None, "date_ope_prev":None}
-    for ligne in lignes:
-        parties = ligne.strip().split("|")
-        segment = parties[0]
+    # Une seule passe : seuls les segments utiles sont repérés et découpés
+    for segment, ligne in tokenize(hl7_message, ORLINE_SEGMENTS, sep):
+        parties = ligne.split(sep)
 
         if segment == "MSH":
             champs["message_id"] = parties[9] if len(parties) > 9 else None
-            champs["message_type"] = parties[8].split("^")[0] if len(parties) > 8 and "^" in parties[8] else None
+            champs["message_type"] = parties[8].split(comp)[0] if len(parties) > 8 and comp in parties[8] else None
             if len(parties) > 6 and champs["message_type"] in ("SIU", "ADT"):
                 champs["date_message"] = format_datetime_yyyy_mm_dd_hh_mm_ss(parties[6])
-            if len(parties) > 10 and "^ORLine" in parties[10]:
-                champs["id_ope"] = parties[10].split("^")[0]
+            if len(parties) > 10 and comp + "ORLine" in parties[10]:
+                champs["id_ope"] = parties[10].split(comp)[0]
         elif segment == "EVN" and champs["message_type"] == "ADT":
             # champs EVN|A02|20250326092949|... → date_ope
             if len(parties) > 2:
@@ -90,37 +87,32 @@ def parse_details_hl7_orline_specific(hl7_message):
             if not champs["id_ope"]:
         # on parcourt chaque champ à la recherche de celui qui se termine par ^^^ORLine
               for fld in parties:
-                 if fld.endswith("^^^ORLine"):
+                 if fld.endswith(comp * 3 + "ORLine"):
                 # on prend tout ce qui est avant le premier caret
-                     champs["id_ope"] = fld.split("^", 1)[0]
+                     champs["id_ope"] = fld.split(comp, 1)[0]
                      break
             if not champs["id_sal_ope"] and len(parties) > 3:
-                for comp in parties[3].split("^"):
-                    if comp.startswith("BLOCMLE."):
-                        champs["id_sal_ope"] = comp.split(".")[1]
+                for composant in parties[3].split(comp):
+                    if composant.startswith("BLOCMLE."):
+                        champs["id_sal_ope"] = composant.split(".")[1]
                         break
         elif segment == "PV2":
-             print("PV2 parties:", parties)
              if len(parties) > 8 and parties[8]:
-                print("Arrivée salle brute:", parties[8])
                 champs["arr_sal_ope"] =  format_datetime_yyyy_mm_dd_hh_mm_ss(parties[8])
                 champs["date_ope"] = format_date_only_yyyy_mm_dd(parties[8])
 
         elif segment == "SCH":
             # ID OPE (alternative)
             if not champs["id_ope"] and len(parties) > 1:
-                champs["id_ope"] = parties[1].split("^")[0]
+                champs["id_ope"] = parties[1].split(comp)[0]
 
             # Extraction des données de timing
             if len(parties) > 11:
-                sch_info = parties[11].split("^")
+                sch_info = parties[11].split(comp)
                 if len(sch_info) >= 4 and sch_info[3]:
                     raw_prev = sch_info[3]
                     champs["date_ope_prev"] =format_date_only_yyyy_mm_dd( raw_prev)
-                    try:
-                        raw_dt["date_ope_prev"]=  datetime.strptime(raw_prev, "%Y%m%d%H%M%S")
-                    except:
-                        pass
+                    raw_dt["date_ope_prev"] = parse_hl7_ts(raw_prev)
                     champs["heu_deb_ope_prev"] = format_datetime_yyyy_mm_dd_hh_mm_ss(raw_prev)[11:]
                     champs["heu_fin_ope_prev"] = format_datetime_yyyy_mm_dd_hh_mm_ss(sch_info[4])[11:]
                     champs["tps_ope_prev"] = sch_info[2]
@@ -139,7 +131,7 @@ def parse_details_hl7_orline_specific(hl7_message):
 
             # Type d’opération
             if len(parties) > 7:
-                type_ope_info = parties[7].split("^")
+                type_ope_info = parties[7].split(comp)
                 champs["type_ope"] = type_ope_info[1] if len(type_ope_info) > 1 else None
 
             # Chirurgien
@@ -151,11 +143,17 @@ def parse_details_hl7_orline_specific(hl7_message):
 
         elif segment == "AIP":
             if len(parties) > 4:
-                aip_info = parties[4].split("^")
+                aip_info = parties[4].split(comp)
                 champs["discip"] = aip_info[-1] if aip_info else None
 
         elif segment == "AIL":
             if len(parties) > 3 and "." in parties[3]:
                 champs["id_sal_ope"] = parties[3].split(".")[1][:2]
 
+    # Colonnes typées (TIMESTAMP / DATE) renseignées à côté des colonnes texte
+    champs["date_message_ts"] = parse_db_datetime(champs["date_message"])
+    champs["date_ope_date"] = parse_db_date(champs["date_ope"])
+    champs["arr_sal_ope_ts"] = parse_db_datetime(champs["arr_sal_ope"])
+    champs["naissance_date"] = parse_db_date(champs["naissance"])
+
     return champs
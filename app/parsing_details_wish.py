@@ -1,10 +1,66 @@
-from datetime import datetime
+from app.hl7_tokenizer import tokenize, separators
+from app.hl7_splitter import split_messages
+from app.hl7_datetime import hl7_to_iso, parse_db_datetime
 
-def extract_pv1_room_info(pv1_3: str):
+# Segments lus par le parser WISH (les autres ne sont jamais découpés)
+WISH_SEGMENTS = ("MSH", "EVN", "PID", "PV1")
+
+CLNSID_TO_NSDSCR = {
+    "101":  "101-DIALYSE",
+    "210":  "210-ONCOLOGIE/ENDOCRINOLOGIE",
+    "215":  "215-HOPITAL DE JOUR MEDICAL",
+    "220":  "220-REVALIDATION",
+    "225":  "225-NEUROCHIR/ORTHO (CD5)",
+    "230":  "230-CARDIOLOGIE/CHIR. VASCULAIRE",
+    "235":  "235-GASTROENTEROLOGIE",
+    "240":  "240-MEDECINE INTERNE GENERALE",
+    "245":  "245-GERIATRIE",
+    "255":  "255-PNEUMOLOGIE/NEPHROLOGIE",
+    "310":  "310-SOINS INTENSIFS",
+    "311":  "311-SOINS INTENSIFS",
+    "316":  "316-SOINS INTENSIFS",
+    "317":  "317-STROKE",
+    "318":  "318-SOINS INTENSIFS",
+    "413":  "413-SALLE DE REVEIL (COVID 19)",
+    "420":  "420-NEUROCHIR/ORTHO (CD7)",
+    "425":  "425-NEUROLOGIE",
+    "426":  "426-POLYSOMNOGRAPHIE ADULTES",
+    "430":  "430-CHIRURGIE ABDOMINALE",
+    "435":  "435-GYNECOLOGIE/UROLOGIE",
+    "440":  "440-GERIATRIE",
+    "445":  "445-GERIATRIE",
+    "450":  "450-PSYCHIATRIE COURT SEJOUR",
+    "514":  "514-HOPIT. DE JOUR PEDIA MEDICAL",
+    "610":  "610-HJ CHIR (CIRCUIT-COURT)",
+    "613":  "613-HOPIT. DE JOUR PEDIA CHIR.",
+    "640":  "640-PEDIATRIE",
+    "700":  "700-URGENCES PEDIATRIQUES",
+    "707":  "707-URGENCES ADULTES",
+    "809":  "809-SOINS INTENSIFS PEDIATRIQUES",
+    "810":  "810-BLOC OBSTETRIQUE",
+    "812":  "812-ACCUEIL ACCOUCHEMENT",
+    "815":  "815-MIC",
+    "820":  "820-NIC",
+    "820K": "820K-KANGOUROU",
+    "820M": "820M-MATERNITE/KANGOUROU",
+    "820N": "820N-NEONAT/N* (KANGOUROU)",
+    "820D": "820D-HAD_PREMI HOME",
+    "825":  "825-ETUDE DU SOMMEIL PEDIATRIQUE",
+    "830":  "830-MATERNITE",
+    "835":  "835-MATERNITE",
+    "840":  "840-PEDIATRIE",
+    "845":  "845-PEDIATRIE",
+    "910":  "910-PSYCHIATRIE",
+    "8BLE": "BLOC OPERATOIRE EXTERNE -MLE",
+    "8MLE": "AMBULATOIRE/FACTURATION - MLE",
+    "8SMU": "SMUR - MLE"
+}
+
+def extract_pv1_room_info(pv1_3: str, component_sep: str = "^"):
     clnsid = clroom = clbed = ""
 
     if pv1_3:
-        parts = pv1_3.split('^')
+        parts = pv1_3.split(component_sep)
         clnsid = parts[0] if len(parts) > 0 else ""
         clroom = parts[1] if len(parts) > 1 else ""
         clbed = parts[2] if len(parts) > 2 else ""
@@ -13,30 +69,22 @@ def extract_pv1_room_info(pv1_3: str):
             
     return clnsid, clroom, clbed
 def convert_hl7_datetime(dt_str):
-    try:
-        return datetime.strptime(dt_str[:14], "%Y%m%d%H%M%S").strftime("%Y-%m-%d %H:%M:%S")
-    except Exception:
+    if not dt_str:
         return None
+    # Horodatage HL7 complet, sinon ses 14 premiers caractères (suffixe non standard)
+    return hl7_to_iso(dt_str) or hl7_to_iso(dt_str[:14])
 
 def parse_details_hl7_wish_specific(hl7_message):
-    lignes = hl7_message.strip().splitlines()
-
-    msh = evn = pid = pv1 = None
-
-    for ligne in lignes:
-        champs = ligne.strip().split("|")
-        if not champs:
-            continue
-        segment = champs[0].strip().upper()
-        if segment == "MSH":
-            msh = champs
-        elif segment == "EVN":
-            evn = champs
-        elif segment == "PID":
-            pid = champs
-        elif segment == "PV1":
-            pv1 = champs
-    
+    # Un fichier peut porter un lot (FHS/BHS ou MSH à la suite) : une ligne par message
+    return [parse_wish_message(message) for _, message in split_messages(hl7_message)]
+
+def parse_wish_message(hl7_message):
+    # Une seule passe sur le message ; on garde le dernier segment de chaque type
+    sep, comp = separators(hl7_message)
+    segments = dict(tokenize(hl7_message, WISH_SEGMENTS, sep, ignore_case=True))
+    # Seuls les segments retenus sont découpés en champs
+    msh, evn, pid, pv1 = (segments[name].split(sep) if name in segments else None for name in WISH_SEGMENTS)
+
     # 👉 EXTRACTION message_id
     message_id = msh[9] if msh and len(msh) > 9 else None
     clsvtc = pv1[11] if pv1 and len(pv1) > 11 else ""
@@ -46,7 +94,7 @@ def parse_details_hl7_wish_specific(hl7_message):
     clfrom = convert_hl7_datetime(clfrom_raw)
     cbmrn = pid[3] if pid and len(pid) > 3 else None
     cbtype = pv1[2] if pv1 and len(pv1) > 2 else None
-    cbadty = pv1[4].split("^")[0] if pv1 and len(pv1) > 4 else None
+    cbadty = pv1[4].split(comp)[0] if pv1 and len(pv1) > 4 else None
 
     nsej = None
     if pv1 and len(pv1) > 19 and pv1[19]:
@@ -57,7 +105,7 @@ def parse_details_hl7_wish_specific(hl7_message):
     # ✅ Utilisation réelle de extract_pv1_room_info sur pv1[3]
     clnsid = clroom = clbed = ""
     if pv1 and len(pv1) > 3:
-        clnsid, clroom, clbed = extract_pv1_room_info(pv1[3])
+        clnsid, clroom, clbed = extract_pv1_room_info(pv1[3], comp)
 
     # ✅ tectxtfr dépend de clsvtc
     if clsvtc == "8BLO":
@@ -72,11 +120,11 @@ def parse_details_hl7_wish_specific(hl7_message):
         tectxtfr = ""
 
     cldept = pv1[10] if pv1 and len(pv1) > 10 else None
-    nrpr = pv1[7].split("^")[0] if pv1 and len(pv1) > 7 else None
+    nrpr = pv1[7].split(comp)[0] if pv1 and len(pv1) > 7 else None
 
     nomm = None
     try:
-        nomm_parts = pv1[7].split("^")
+        nomm_parts = pv1[7].split(comp)
         nomm = f"{nomm_parts[1]}, {nomm_parts[2]}" if len(nomm_parts) >= 3 else None
     except Exception:
         nomm = None
@@ -88,68 +136,16 @@ def parse_details_hl7_wish_specific(hl7_message):
     date_message = None
     if msh and len(msh) > 3 and msh[3]:
         try:
-            msh_3_parts = msh[3].split('^')
+            msh_3_parts = msh[3].split(comp)
             if len(msh_3_parts) > 1:
-                raw_datetime = msh_3_parts[1][:14]  # Prend exactement "20250407010834"
-                date_obj = datetime.strptime(raw_datetime, "%Y%m%d%H%M%S")
-                date_message = date_obj.strftime("%Y-%m-%d %H:%M:%S")
+                date_message = convert_hl7_datetime(msh_3_parts[1])  # ex. "20250407010834"
         except Exception:
             date_message = None
 
-    clnsid_to_nsdscr = {
-    "101":  "101-DIALYSE",
-    "210":  "210-ONCOLOGIE/ENDOCRINOLOGIE",
-    "215":  "215-HOPITAL DE JOUR MEDICAL",
-    "220":  "220-REVALIDATION",
-    "225":  "225-NEUROCHIR/ORTHO (CD5)",
-    "230":  "230-CARDIOLOGIE/CHIR. VASCULAIRE",
-    "235":  "235-GASTROENTEROLOGIE",
-    "240":  "240-MEDECINE INTERNE GENERALE",
-    "245":  "245-GERIATRIE",
-    "255":  "255-PNEUMOLOGIE/NEPHROLOGIE",
-    "310":  "310-SOINS INTENSIFS",
-    "311":  "311-SOINS INTENSIFS",
-    "316":  "316-SOINS INTENSIFS",
-    "317":  "317-STROKE",
-    "318":  "318-SOINS INTENSIFS",
-    "413":  "413-SALLE DE REVEIL (COVID 19)",
-    "420":  "420-NEUROCHIR/ORTHO (CD7)",
-    "425":  "425-NEUROLOGIE",
-    "426":  "426-POLYSOMNOGRAPHIE ADULTES",
-    "430":  "430-CHIRURGIE ABDOMINALE",
-    "435":  "435-GYNECOLOGIE/UROLOGIE",
-    "440":  "440-GERIATRIE",
-    "445":  "445-GERIATRIE",
-    "450":  "450-PSYCHIATRIE COURT SEJOUR",
-    "514":  "514-HOPIT. DE JOUR PEDIA MEDICAL",
-    "610":  "610-HJ CHIR (CIRCUIT-COURT)",
-    "613":  "613-HOPIT. DE JOUR PEDIA CHIR.",
-    "640":  "640-PEDIATRIE",
-    "700":  "700-URGENCES PEDIATRIQUES",
-    "707":  "707-URGENCES ADULTES",
-    "809":  "809-SOINS INTENSIFS PEDIATRIQUES",
-    "810":  "810-BLOC OBSTETRIQUE",
-    "812":  "812-ACCUEIL ACCOUCHEMENT",
-    "815":  "815-MIC",
-    "820":  "820-NIC",
-    "820K": "820K-KANGOUROU",
-    "820M": "820M-MATERNITE/KANGOUROU",
-    "820N": "820N-NEONAT/N* (KANGOUROU)",
-    "820D": "820D-HAD_PREMI HOME",
-    "825":  "825-ETUDE DU SOMMEIL PEDIATRIQUE",
-    "830":  "830-MATERNITE",
-    "835":  "835-MATERNITE",
-    "840":  "840-PEDIATRIE",
-    "845":  "845-PEDIATRIE",
-    "910":  "910-PSYCHIATRIE",
-    "8BLE": "BLOC OPERATOIRE EXTERNE -MLE",
-    "8MLE": "AMBULATOIRE/FACTURATION - MLE",
-    "8SMU": "SMUR - MLE"
-}
 
-    nsdscr = clnsid_to_nsdscr.get(clnsid, "")
+    nsdscr = CLNSID_TO_NSDSCR.get(clnsid, "")
 
-    return [{
+    return {
         "message_id": message_id,
         "date_message": date_message,
         "clrs_cd": clrs_cd,
@@ -168,6 +164,8 @@ def parse_details_hl7_wish_specific(hl7_message):
         "cldept": cldept,
         "nrpr": nrpr,
         "nomm": nomm,
-        "cltima": cltima
-        
-    }]
+        "cltima": cltima,
+        "date_message_ts": parse_db_datetime(date_message),
+        "clfrom_ts": parse_db_datetime(clfrom),
+        "cltima_ts": parse_db_datetime(cltima)
+    }
@@ -0,0 +1,96 @@
+# app/patients.py
+"""
+Dimension patient (table patient) : un identifiant par patient vu dans WISH
+(cbmrn) ou ORLine (id_pat), avec premier / dernier message et sources.
+
+L'ingestion la met à jour dans la transaction des messages (upsert par lot) ;
+/patients la lit par sa clé primaire au lieu de dédoublonner les deux tables
+de messages en Python à chaque frappe.
+"""
+
+from datetime import datetime
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from sqlalchemy import and_, func, or_, select
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.orm import Session
+
+from app.models import Patient
+
+SOURCES = ("wish", "orline", "both", "intersection")
+# Patients par INSERT ... ON CONFLICT
+UPSERT_CHUNK_SIZE = 1000
+
+
+def _aggregate(wish_rows: Iterable[dict], orline_rows: Iterable[dict]) -> Dict[str, dict]:
+    """Un enregistrement par patient du lot (ON CONFLICT ne peut toucher deux fois la même ligne)."""
+    seen: Dict[str, dict] = {}
+    for rows, key, flag in ((wish_rows, "cbmrn", "in_wish"), (orline_rows, "id_pat", "in_orline")):
+        for row in rows:
+            pid = row.get(key)
+            if not pid:
+                continue
+            entry = seen.get(pid)
+            if entry is None:
+                entry = seen[pid] = {"patient_id": pid, "first_seen": None, "last_seen": None,
+                                     "in_wish": False, "in_orline": False}
+            entry[flag] = True
+            ts: Optional[datetime] = row.get("date_message_ts")
+            if ts is not None:
+                if entry["first_seen"] is None or ts < entry["first_seen"]:
+                    entry["first_seen"] = ts
+                if entry["last_seen"] is None or ts > entry["last_seen"]:
+                    entry["last_seen"] = ts
+    return seen
+
+
+def record_patients(db: Session, wish_rows: Iterable[dict], orline_rows: Iterable[dict]) -> None:
+    """Ajoute ou met à jour les patients d'un lot ; le commit reste à l'appelant."""
+    # Ordre fixe des clés : deux lots concurrents verrouillent les lignes dans le même ordre
+    entries = sorted(_aggregate(wish_rows, orline_rows).values(), key=lambda e: e["patient_id"])
+    table = Patient.__table__
+    for i in range(0, len(entries), UPSERT_CHUNK_SIZE):
+        stmt = insert(Patient).values(entries[i:i + UPSERT_CHUNK_SIZE])
+        new = stmt.excluded
+        db.execute(stmt.on_conflict_do_update(
+            index_elements=[table.c.patient_id],
+            set_={
+                # least / greatest ignorent NULL
+                "first_seen": func.least(table.c.first_seen, new.first_seen),
+                "last_seen": func.greatest(table.c.last_seen, new.last_seen),
+                "in_wish": or_(table.c.in_wish, new.in_wish),
+                "in_orline": or_(table.c.in_orline, new.in_orline),
+            },
+        ))
+
+
+def _prefix_bounds(prefix: str) -> Tuple[str, str]:
+    # Collation C : les identifiants commençant par `prefix` sont dans [prefix, prefix+1[
+    return prefix, prefix[:-1] + chr(ord(prefix[-1]) + 1)
+
+
+def patient_filter(source: str, prefix: Optional[str] = None) -> List:
+    conditions = []
+    if source == "wish":
+        conditions.append(Patient.in_wish)
+    elif source == "orline":
+        conditions.append(Patient.in_orline)
+    elif source == "intersection":
+        conditions.append(and_(Patient.in_wish, Patient.in_orline))
+    if prefix:
+        lo, hi = _prefix_bounds(prefix)
+        conditions += [Patient.patient_id >= lo, Patient.patient_id < hi]
+    return conditions
+
+
+def patients_page(source: str, prefix: Optional[str] = None, after: Optional[str] = None,
+                  limit: Optional[int] = None):
+    """(requête du total, requête de la page) ; la page suit l'ordre de la clé primaire après `after`."""
+    conditions = patient_filter(source, prefix)
+    total = select(func.count()).select_from(Patient).where(*conditions)
+    page = select(Patient.patient_id).where(*conditions).order_by(Patient.patient_id)
+    if after is not None:
+        page = page.where(Patient.patient_id > after)
+    if limit is not None:
+        page = page.limit(limit)
+    return total, page
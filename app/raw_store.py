@@ -0,0 +1,276 @@
+# app/raw_store.py
+"""
+Messages HL7 bruts conservés en base (table hl7_raw_message), compressés
+zlib, clés message_id et patient, et index inversé des identifiants PID-3
+vers ces messages (table hl7_patient_identifier).
+
+L'ingestion écrit le message brut dans la transaction de ses lignes parsées :
+les exports relisent le texte d'origine sans toucher aux dossiers surveillés,
+et les colonnes dérivées peuvent être recalculées sans les archives :
+
+    python -m app.raw_store reparse [--source WISH|ORLine]
+
+rejoue les parsers actuels sur les messages conservés et remplace, message_id
+par message_id, les lignes WISH / ORLine correspondantes ;
+
+    python -m app.raw_store reindex
+
+reconstruit l'index PID-3 depuis les messages conservés.
+"""
+
+import sys
+import zlib
+import logging
+import argparse
+from datetime import datetime
+from typing import Dict, Iterable, Iterator, List, NamedTuple, Optional, Tuple
+
+from sqlalchemy import delete, insert, select
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.orm import Session
+
+from app.database import IngestSessionLocal
+from app.models import HL7RawMessage, HL7PatientIdentifier, HL7MessageWish, HL7MessageOrline
+from app.hl7_tokenizer import separators, tokenize
+from app.timeline_cache import timeline_cache
+
+# Niveau zlib : ~4x plus petit pour du HL7, sans coût notable à l'ingestion
+COMPRESSION_LEVEL = 6
+# Messages relus par aller-retour (export, re-parsing) / écrits par INSERT
+RAW_FETCH_SIZE = 1000
+REPETITION_SEP = "~"
+
+MODELS = {"WISH": HL7MessageWish, "ORLine": HL7MessageOrline}
+
+
+class RawPayload(NamedTuple):
+    """Message brut prêt à écrire : texte compressé et identifiants PID-3."""
+    data: bytes
+    identifiers: Tuple[str, ...]
+
+
+def compress(content: str) -> bytes:
+    return zlib.compress(content.encode("utf-8"), COMPRESSION_LEVEL)
+
+
+def decompress(payload: bytes) -> str:
+    return zlib.decompress(payload).decode("utf-8")
+
+
+def pid3_identifiers(content: str) -> Tuple[str, ...]:
+    """
+    Identifiants PID-3 du message : le numéro (premier composant) de chaque
+    répétition. L'autorité d'attribution et le type d'identifiant ne sont pas
+    indexés : partagés par tous les patients, ils ne désignent personne.
+    """
+    field_sep, component_sep = separators(content)
+    found = set()
+    for _, line in tokenize(content, ("PID",), field_sep):
+        fields = line.split(field_sep)
+        if len(fields) > 3:
+            for repetition in fields[3].split(REPETITION_SEP):
+                found.add(repetition.split(component_sep)[0].strip())
+    found.discard("")
+    return tuple(sorted(found))
+
+
+def pack(content: str) -> RawPayload:
+    """Compression et extraction des identifiants, faites côté lecture (workers, watcher)."""
+    return RawPayload(compress(content), pid3_identifiers(content))
+
+
+def patient_id(rows: List[dict]) -> Optional[str]:
+    for row in rows:
+        pid = row.get("cbmrn") or row.get("id_pat")
+        if pid:
+            return pid
+    return None
+
+
+def raw_row(source: str, rows: List[dict], payload: RawPayload) -> dict:
+    """Ligne hl7_raw_message d'un message (clés tirées de ses lignes parsées)."""
+    message_id = next((row.get("message_id") for row in rows if row.get("message_id")), None)
+    return {
+        "source": source,
+        "message_id": message_id,
+        "patient_id": patient_id(rows),
+        "received_at": datetime.now(),
+        "payload": payload.data,
+        "identifiers": payload.identifiers,
+    }
+
+
+def _columns(row: dict) -> dict:
+    return {k: v for k, v in row.items() if k != "identifiers"}
+
+
+def _insert_identifiers(db: Session, pairs: Iterable[Tuple[int, dict]]) -> None:
+    entries = [{"identifier": identifier, "raw_id": raw_id} for raw_id, row in pairs for identifier in row["identifiers"]]
+    if entries:
+        db.execute(insert(HL7PatientIdentifier), entries)
+
+
+def insert_raw(db: Session, raw_rows: List[dict]) -> None:
+    """
+    Insère les messages bruts puis leurs entrées d'index PID-3 (même transaction).
+    Un message déjà conservé (même source et message_id) est ignoré, en base
+    (ON CONFLICT DO NOTHING) comme dans le lot : la première réception l'emporte.
+    """
+    keyed: Dict[Tuple[str, str], dict] = {}
+    unkeyed = []
+    for row in raw_rows:
+        if row.get("message_id"):
+            keyed.setdefault((row["source"], row["message_id"]), row)
+        else:
+            unkeyed.append(row)
+
+    rows = list(keyed.values())
+    stmt = (
+        pg_insert(HL7RawMessage)
+        .on_conflict_do_nothing(index_elements=["message_id", "source"])
+        .returning(HL7RawMessage.id, HL7RawMessage.source, HL7RawMessage.message_id)
+    )
+    for i in range(0, len(rows), RAW_FETCH_SIZE):
+        chunk = rows[i:i + RAW_FETCH_SIZE]
+        # Seuls les messages réellement insérés reviennent : rattachés par leur clé
+        inserted = db.execute(stmt, [_columns(row) for row in chunk]).all()
+        _insert_identifiers(db, ((raw_id, keyed[(source, message_id)]) for raw_id, source, message_id in inserted))
+
+    # Sans message_id, pas de doublon détectable : insertion simple, ids dans l'ordre des lignes
+    for i in range(0, len(unkeyed), RAW_FETCH_SIZE):
+        chunk = unkeyed[i:i + RAW_FETCH_SIZE]
+        ids = db.execute(
+            insert(HL7RawMessage).returning(HL7RawMessage.id, sort_by_parameter_order=True),
+            [_columns(row) for row in chunk],
+        ).scalars().all()
+        _insert_identifiers(db, zip(ids, chunk))
+
+
+def patient_messages(db: Session, identifier: str) -> Iterator[Tuple[str, Optional[str], str]]:
+    """(source, message_id, texte brut) des messages dont PID-3 contient `identifier`, par ordre de réception."""
+    query = (
+        db.query(HL7RawMessage.source, HL7RawMessage.message_id, HL7RawMessage.payload)
+        .join(HL7PatientIdentifier, HL7PatientIdentifier.raw_id == HL7RawMessage.id)
+        .filter(HL7PatientIdentifier.identifier == identifier)
+        .order_by(HL7RawMessage.id)
+    )
+    for source, message_id, payload in query.yield_per(RAW_FETCH_SIZE):
+        yield source, message_id, decompress(payload)
+
+
+def lookup(db: Session, message_ids: Iterable[str]) -> Dict[str, str]:
+    """{message_id: texte brut} ; en cas de doublon, le message le plus récent l'emporte."""
+    ids = sorted(set(message_ids) - {None, ""})
+    found: Dict[str, str] = {}
+    for i in range(0, len(ids), RAW_FETCH_SIZE):
+        query = (
+            db.query(HL7RawMessage.message_id, HL7RawMessage.payload)
+            .filter(HL7RawMessage.message_id.in_(ids[i:i + RAW_FETCH_SIZE]))
+            .order_by(HL7RawMessage.id)
+        )
+        for message_id, payload in query:
+            found[message_id] = decompress(payload)
+    return found
+
+
+def reparse(db: Session, source: str) -> int:
+    """
+    Recalcule les lignes de `source` depuis les messages conservés, par lots
+    de RAW_FETCH_SIZE (un commit par lot, dans l'ordre de réception).
+    Les lignes d'un message_id sont supprimées à sa première occurrence
+    seulement, pour garder ses doublons éventuels. Retourne le nombre de
+    messages lus ; les messages sans message_id sont ignorés.
+    """
+    from app.crud import parse_rows, bulk_create_messages
+    from app import census
+
+    model = MODELS[source]
+    stmt = (
+        select(HL7RawMessage.message_id, HL7RawMessage.payload)
+        .where(HL7RawMessage.source == source, HL7RawMessage.message_id.isnot(None))
+        .order_by(HL7RawMessage.id)
+        .execution_options(yield_per=RAW_FETCH_SIZE)
+    )
+    # Lecture sur une connexion à part : les commits par lot ne ferment pas le curseur
+    reader = IngestSessionLocal()
+    seen = set()
+    done = 0
+    try:
+        for batch in reader.execute(stmt).partitions():
+            rows, parsed = [], set()
+            for message_id, payload in batch:
+                try:
+                    rows.extend(parse_rows(source, decompress(payload)))
+                    parsed.add(message_id)
+                except Exception as e:
+                    # Lignes existantes gardées telles quelles
+                    logging.error(f"Error re-parsing {source} message {message_id}: {e}")
+            new_ids = parsed - seen
+            seen |= new_ids
+            if new_ids:
+                db.execute(delete(model).where(model.message_id.in_(new_ids)))
+            if source == "WISH":
+                bulk_create_messages(db, rows, [])
+            else:
+                bulk_create_messages(db, [], rows)
+            db.commit()
+            done += len(batch)
+            logging.info(f"Re-parsed {done} {source} messages")
+    finally:
+        reader.close()
+
+    # Les anciennes lignes ont pu porter d'autres horodatages : tout le recensement est à refaire
+    census.reset(db)
+    db.commit()
+    timeline_cache.clear()
+    return done
+
+
+def reindex(db: Session) -> int:
+    """Reconstruit l'index PID-3 depuis les messages conservés ; retourne le nombre d'entrées."""
+    db.execute(delete(HL7PatientIdentifier))
+    stmt = (
+        select(HL7RawMessage.id, HL7RawMessage.payload)
+        .order_by(HL7RawMessage.id)
+        .execution_options(yield_per=RAW_FETCH_SIZE)
+    )
+    reader = IngestSessionLocal()
+    total = 0
+    try:
+        for batch in reader.execute(stmt).partitions():
+            entries = [
+                {"identifier": identifier, "raw_id": raw_id}
+                for raw_id, payload in batch for identifier in pid3_identifiers(decompress(payload))
+            ]
+            if entries:
+                db.execute(insert(HL7PatientIdentifier), entries)
+            total += len(entries)
+    finally:
+        reader.close()
+    db.commit()
+    return total
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="Messages HL7 bruts conservés en base.")
+    sub = parser.add_subparsers(dest="command", required=True)
+    cmd = sub.add_parser("reparse", help="recalcule les lignes WISH / ORLine depuis les messages conservés")
+    cmd.add_argument("--source", choices=list(MODELS), action="append",
+                     help="source à recalculer (défaut : toutes)")
+    sub.add_parser("reindex", help="reconstruit l'index des identifiants PID-3")
+    args = parser.parse_args(argv)
+
+    db = IngestSessionLocal()
+    try:
+        if args.command == "reindex":
+            print(f"{reindex(db)} identifiant(s) indexé(s)")
+            return 0
+        for source in args.source or list(MODELS):
+            print(f"{source} : {reparse(db, source)} message(s) re-parsé(s)")
+        return 0
+    finally:
+        db.close()
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,202 @@
+# app/readiness.py
+"""
+Étape de disponibilité des fichiers déposés dans les dossiers surveillés.
+
+Un fichier signalé par watchdog peut être encore en cours de copie. Au lieu
+d'attendre sur place dans le thread de l'observer, le fichier est confié à
+un ordonnanceur qui le déclare prêt quand sa taille et sa date de
+modification n'ont pas changé pendant HL7_STABLE_FOR secondes. Les
+événements reçus pour un fichier déjà en attente sont fusionnés : ils ne
+font que repousser sa vérification.
+
+Les fichiers prêts sont lus et transmis au writer par un petit pool de
+threads (HL7_READY_WORKERS) : un writer saturé ne bloque que ce pool, le
+thread de l'ordonnanceur continue de vérifier les autres fichiers.
+
+Convention de renommage : un fichier arrivé par un déplacement (écrit sous
+un nom temporaire, .tmp / .part, puis renommé) est complet ; il est prêt
+dès le renommage (HL7_READY_ON_RENAME=0 pour vérifier quand même).
+
+Un fichier déjà transmis avec la même taille et la même date de
+modification (événements tardifs, fichiers conservés après import) n'est
+pas transmis à nouveau (app/dedup.py).
+"""
+
+import os
+import heapq
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, List, Optional, Tuple
+
+from app.dedup import RECENT_FILES, RecentKeys
+
+# Délai sans changement de taille / mtime avant de lire un fichier (s)
+STABLE_FOR = float(os.getenv("HL7_STABLE_FOR", "0.2"))
+READY_ON_RENAME = os.getenv("HL7_READY_ON_RENAME", "1") != "0"
+# Threads qui lisent les fichiers prêts et les transmettent au writer
+READY_WORKERS = int(os.getenv("HL7_READY_WORKERS", "4"))
+
+Signature = Tuple[int, int]
+
+
+class _Pending:
+    __slots__ = ("on_ready", "signature", "changed", "ready", "since")
+
+    def __init__(self, on_ready: Callable[[str], None]):
+        self.on_ready = on_ready
+        self.since = time.monotonic()
+        self.signature: Optional[Signature] = None
+        self.changed = False
+        self.ready = False
+
+
+def _signature(path: str) -> Optional[Signature]:
+    """(taille, mtime) du fichier ; None s'il a disparu ou s'il est verrouillé (copie Windows en cours)."""
+    try:
+        st = os.stat(path)
+        with open(path, "rb"):
+            pass
+    except FileNotFoundError:
+        return None
+    except OSError:
+        return (-1, -1)
+    return st.st_size, st.st_mtime_ns
+
+
+class StabilityScheduler:
+    """Un thread vérifie tous les fichiers en attente, chacun à son échéance (tas) ; un pool les traite."""
+
+    def __init__(
+        self,
+        stable_for: float = STABLE_FOR,
+        ready_on_rename: bool = READY_ON_RENAME,
+        workers: int = READY_WORKERS,
+    ):
+        self.stable_for = stable_for
+        self.ready_on_rename = ready_on_rename
+        self.workers = workers
+        self._pool: Optional[ThreadPoolExecutor] = None
+        self._inflight = 0
+        self._cond = threading.Condition()
+        self._pending: Dict[str, _Pending] = {}
+        self._heap: List[Tuple[float, int, str]] = []
+        self._seq = 0
+        self._thread: Optional[threading.Thread] = None
+        self._stopping = False
+        self._dispatched = RecentKeys(RECENT_FILES)
+        self.coalesced = 0
+        self.ready = 0
+        self.duplicates = 0
+        # Attente entre le premier événement et la transmission du fichier
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+
+    def start(self):
+        self._pool = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="hl7-file-ingest")
+        self._thread = threading.Thread(target=self._run, name="hl7-file-readiness", daemon=True)
+        self._thread.start()
+        logging.info(
+            f"File readiness scheduler started (stable_for={self.stable_for}s, workers={self.workers})"
+        )
+
+    def stop(self):
+        """
+        Arrête le thread puis attend les fichiers déjà prêts ; ceux encore en
+        attente seront repris par l'import du backlog.
+        """
+        if self._thread is None:
+            return
+        with self._cond:
+            self._stopping = True
+            self._cond.notify()
+        self._thread.join()
+        self._thread = None
+        self._pool.shutdown(wait=True)
+        self._pool = None
+        logging.info("File readiness scheduler stopped cleanly")
+
+    def notify(self, path: str, on_ready: Callable[[str], None], renamed: bool = False):
+        """Signale un événement sur `path` ; `on_ready(path)` sera appelé une fois le fichier stable."""
+        with self._cond:
+            pending = self._pending.get(path)
+            if pending is not None:
+                self.coalesced += 1
+                pending.changed = True
+                pending.ready = pending.ready or (renamed and self.ready_on_rename)
+                return
+            pending = self._pending[path] = _Pending(on_ready)
+            pending.ready = renamed and self.ready_on_rename
+            self._push(path, time.monotonic())
+            self._cond.notify()
+
+    def stats(self) -> Dict[str, int]:
+        with self._cond:
+            return {
+                "pending": len(self._pending), "inflight": self._inflight,
+                "coalesced": self.coalesced, "ready": self.ready, "duplicates": self.duplicates,
+                "wait_avg_ms": round(1000 * self.wait_total / self.ready, 3) if self.ready else 0.0,
+                "wait_max_ms": round(1000 * self.wait_max, 3),
+            }
+
+    def _push(self, path: str, due: float):
+        self._seq += 1
+        heapq.heappush(self._heap, (due, self._seq, path))
+
+    def _due(self) -> List[str]:
+        """Chemins à vérifier maintenant (attend la prochaine échéance)."""
+        with self._cond:
+            while not self._stopping:
+                now = time.monotonic()
+                if self._heap and self._heap[0][0] <= now:
+                    due = []
+                    while self._heap and self._heap[0][0] <= now:
+                        due.append(heapq.heappop(self._heap)[2])
+                    return due
+                self._cond.wait(self._heap[0][0] - now if self._heap else None)
+            return []
+
+    def _run(self):
+        while True:
+            due = self._due()
+            if not due:
+                return
+            for path in due:
+                self._check(path)
+
+    def _check(self, path: str):
+        signature = _signature(path)
+        with self._cond:
+            pending = self._pending[path]
+            if signature is None:
+                # Fichier déplacé ou supprimé entre-temps
+                del self._pending[path]
+                return
+            stable = pending.ready or (
+                not pending.changed and signature == pending.signature and signature[0] >= 0
+            )
+            if not stable:
+                pending.signature, pending.changed = signature, False
+                self._push(path, time.monotonic() + self.stable_for)
+                return
+            del self._pending[path]
+            if signature[0] >= 0 and not self._dispatched.add((path, signature)):
+                # Même contenu déjà transmis : rien à relire
+                self.duplicates += 1
+                return
+            self.ready += 1
+            waited = time.monotonic() - pending.since
+            self.wait_total += waited
+            self.wait_max = max(self.wait_max, waited)
+            self._inflight += 1
+        self._pool.submit(self._dispatch, pending.on_ready, path)
+
+    def _dispatch(self, on_ready: Callable[[str], None], path: str):
+        try:
+            on_ready(path)
+        except Exception as e:
+            logging.error(f"Error handling ready file {path}: {e}")
+        finally:
+            with self._cond:
+                self._inflight -= 1
@@ -0,0 +1,41 @@
+# app/responses.py
+"""
+Encodage JSON rapide des réponses volumineuses (messages d'un patient,
+parcours, flux NDJSON).
+
+Les endpoints concernés lisent des lignes de colonnes (dicts de types
+simples : str, int, datetime, date) et renvoient directement un
+`FastJSONResponse` : FastAPI ne repasse pas alors chaque valeur par
+`jsonable_encoder`, et orjson sérialise en une passe C. Sans orjson, repli
+sur json avec le même rendu des dates (ISO 8601).
+"""
+
+import json
+from datetime import date, datetime
+from typing import Any
+
+from fastapi.responses import Response
+
+try:
+    import orjson
+except ImportError:  # repli json standard, plus lent
+    orjson = None
+
+
+def _default(value):
+    if isinstance(value, (datetime, date)):
+        return value.isoformat()
+    raise TypeError(f"{type(value).__name__} non sérialisable en JSON")
+
+
+def dumps(content: Any) -> bytes:
+    if orjson is not None:
+        return orjson.dumps(content, option=orjson.OPT_NON_STR_KEYS)
+    return json.dumps(content, default=_default, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+
+class FastJSONResponse(Response):
+    media_type = "application/json"
+
+    def render(self, content: Any) -> bytes:
+        return dumps(content)
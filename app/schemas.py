@@ -2,6 +2,7 @@
 
 from pydantic import BaseModel, Field, ConfigDict
 from typing import Optional
+from datetime import datetime, date
 
 # ✅ Schéma pour créer un message HL7
 class HL7MessageCreate(BaseModel):
@@ -30,6 +31,9 @@ class HL7MessageWishSchema(BaseModel):
     nrpr: Optional[str] = None
     nomm: Optional[str] = None
     cltima: Optional[str] = None
+    date_message_ts: Optional[datetime] = None
+    clfrom_ts: Optional[datetime] = None
+    cltima_ts: Optional[datetime] = None
 
     model_config = ConfigDict(from_attributes=True)
 
@@ -56,5 +60,9 @@ class HL7MessageOrlineSchema(BaseModel):
     chir: Optional[str]
     naissance: Optional[str]
     sexe: Optional[str]
+    date_message_ts: Optional[datetime] = None
+    date_ope_date: Optional[date] = None
+    arr_sal_ope_ts: Optional[datetime] = None
+    naissance_date: Optional[date] = None
 
     model_config = ConfigDict(from_attributes=True)
@@ -0,0 +1,192 @@
+# app/timeline_cache.py
+"""
+Cache des parcours patient (gantt, parcours d'un séjour, messages du patient),
+clé (vue, patient, séjour), invalidé patient par patient par l'ingestion.
+
+Chaque patient a une génération, lue avant la requête en base et incluse
+dans la clé ; une écriture pour ce patient l'incrémente. Un résultat calculé
+pendant une ingestion concurrente est donc rangé sous l'ancienne génération
+et ne sera jamais relu.
+
+Deux stockages :
+- local (défaut) : LRU borné en mémoire du processus (HL7_TIMELINE_CACHE_SIZE) ;
+- Redis, si HL7_TIMELINE_CACHE_REDIS_URL est défini : partagé entre les
+  workers uvicorn, valeurs en JSON avec une durée de vie (HL7_TIMELINE_CACHE_TTL).
+"""
+
+import os
+import json
+import logging
+import threading
+from collections import OrderedDict
+from datetime import date, datetime
+from typing import Any, Dict, Iterable, Optional, Set, Tuple
+
+try:
+    import redis
+except ImportError:  # cache partagé indisponible : cache local
+    redis = None
+
+CACHE_SIZE = int(os.getenv("HL7_TIMELINE_CACHE_SIZE", "2000"))
+REDIS_URL = os.getenv("HL7_TIMELINE_CACHE_REDIS_URL")
+REDIS_TTL = int(os.getenv("HL7_TIMELINE_CACHE_TTL", "3600"))
+REDIS_PREFIX = "hl7:timeline:"
+
+Key = Tuple[str, str, Optional[str], int]
+
+
+def patient_ids(wish_rows: Iterable[dict], orline_rows: Iterable[dict]) -> Set[str]:
+    """Patients touchés par un lot de lignes parsées."""
+    ids = {row.get("cbmrn") for row in wish_rows} | {row.get("id_pat") for row in orline_rows}
+    ids.discard(None)
+    ids.discard("")
+    return ids
+
+
+class LocalBackend:
+    """LRU en mémoire, protégé par un verrou (le writer d'ingestion invalide depuis son thread)."""
+
+    def __init__(self, maxsize: int = CACHE_SIZE):
+        self.maxsize = maxsize
+        self._lock = threading.Lock()
+        self._entries: "OrderedDict[Key, Any]" = OrderedDict()
+        self._generations: Dict[str, int] = {}
+        self.hits = self.misses = 0
+
+    def generation(self, patient: str) -> int:
+        with self._lock:
+            return self._generations.get(patient, 0)
+
+    def get(self, key: Key) -> Any:
+        with self._lock:
+            value = self._entries.get(key)
+            if value is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def set(self, key: Key, value: Any):
+        with self._lock:
+            # Génération dépassée entre-temps : inutile de garder la valeur
+            if key[3] != self._generations.get(key[1], 0):
+                return
+            self._entries[key] = value
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, patients: Iterable[str]):
+        patients = set(patients)
+        if not patients:
+            return
+        with self._lock:
+            for patient in patients:
+                self._generations[patient] = self._generations.get(patient, 0) + 1
+            for key in [k for k in self._entries if k[1] in patients]:
+                del self._entries[key]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            # Les générations restent : un calcul en cours ne doit pas être rangé
+            for patient in self._generations:
+                self._generations[patient] += 1
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {"backend": "local", "entries": len(self._entries), "maxsize": self.maxsize,
+                    "hits": self.hits, "misses": self.misses}
+
+
+def _json_default(value):
+    if isinstance(value, (datetime, date)):
+        return value.isoformat()
+    raise TypeError(f"{type(value).__name__} non sérialisable")
+
+
+class RedisBackend:
+    """Cache partagé : génération par patient (INCR) et entrées JSON avec TTL."""
+
+    def __init__(self, url: str = REDIS_URL, ttl: int = REDIS_TTL):
+        self.ttl = ttl
+        self._client = redis.Redis.from_url(url, socket_timeout=0.5)
+
+    @staticmethod
+    def _gen_key(patient: str) -> str:
+        return f"{REDIS_PREFIX}gen:{patient}"
+
+    @staticmethod
+    def _entry_key(key: Key) -> str:
+        view, patient, stay, gen = key
+        return f"{REDIS_PREFIX}{patient}:{gen}:{view}:{stay or ''}"
+
+    def generation(self, patient: str) -> int:
+        return int(self._client.get(self._gen_key(patient)) or 0)
+
+    def get(self, key: Key) -> Any:
+        raw = self._client.get(self._entry_key(key))
+        return json.loads(raw) if raw is not None else None
+
+    def set(self, key: Key, value: Any):
+        self._client.set(self._entry_key(key), json.dumps(value, default=_json_default), ex=self.ttl)
+
+    def invalidate(self, patients: Iterable[str]):
+        # Les entrées des anciennes générations expirent d'elles-mêmes (TTL)
+        pipe = self._client.pipeline(transaction=False)
+        for patient in set(patients):
+            pipe.incr(self._gen_key(patient))
+        pipe.execute()
+
+    def clear(self):
+        for name in self._client.scan_iter(f"{REDIS_PREFIX}gen:*"):
+            self._client.incr(name)
+
+    def stats(self) -> Dict[str, int]:
+        return {"backend": "redis", "ttl": self.ttl}
+
+
+class TimelineCache:
+    def __init__(self, backend):
+        self.backend = backend
+
+    @classmethod
+    def from_env(cls) -> "TimelineCache":
+        if REDIS_URL:
+            if redis is not None:
+                return cls(RedisBackend(REDIS_URL))
+            logging.warning("HL7_TIMELINE_CACHE_REDIS_URL défini mais redis n'est pas installé : cache local")
+        return cls(LocalBackend())
+
+    def lookup(self, view: str, patient: str, stay: Optional[str] = None) -> Tuple[Key, Any]:
+        """(clé à passer à store, valeur en cache ou None). À appeler avant la requête en base."""
+        key = (view, patient, stay, self._safe(self.backend.generation, patient, default=-1))
+        if key[3] < 0:
+            return key, None
+        return key, self._safe(self.backend.get, key)
+
+    def store(self, key: Key, value: Any):
+        if key[3] >= 0:
+            self._safe(self.backend.set, key, value)
+
+    def invalidate(self, patients: Iterable[str]):
+        self._safe(self.backend.invalidate, patients)
+
+    def clear(self):
+        self._safe(self.backend.clear)
+
+    def stats(self) -> Dict[str, int]:
+        return self._safe(self.backend.stats, default={})
+
+    @staticmethod
+    def _safe(fn, *args, default=None):
+        # Un cache indisponible ne doit pas faire échouer la lecture ni l'ingestion
+        try:
+            return fn(*args)
+        except Exception as e:
+            logging.warning(f"Timeline cache error: {e}")
+            return default
+
+
+timeline_cache = TimelineCache.from_env()
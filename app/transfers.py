@@ -0,0 +1,137 @@
+# app/transfers.py
+"""
+Fusion des transferts rapprochés (moins de 5 min), pour l'export et pour le
+parcours patient (gantt).
+
+Les comparaisons entre lignes voisines (écart de temps, même séjour / unité,
+service prioritaire) sont faites d'un bloc sur des tableaux numpy triés ;
+il ne reste au plus qu'un parcours linéaire, sans sous-groupes ni masques
+recalculés pour chaque écart court.
+"""
+
+from datetime import timedelta
+from typing import List
+
+import numpy as np
+import pandas as pd
+
+TRANSFER_WINDOW = timedelta(minutes=5)
+# Export : la ligne au bloc opératoire l'emporte
+EXPORT_PRIORITY_SERVICE = "8BLO"
+# Parcours patient : bloc ou salle de réveil l'emportent
+JOURNEY_PRIORITY_SERVICES = frozenset({"8BLO", "8REV"})
+
+_WINDOW = np.timedelta64(int(TRANSFER_WINDOW.total_seconds()), "s")
+
+
+def _times(rows: List[dict], key: str) -> np.ndarray:
+    """datetime / None → datetime64 (None devient NaT), conversion faite en C par pandas."""
+    return pd.DatetimeIndex([r[key] for r in rows]).values
+
+
+def _column(rows: List[dict], key: str) -> np.ndarray:
+    return np.array([r[key] for r in rows], dtype=object)
+
+
+def _same_as_previous(*columns: np.ndarray) -> np.ndarray:
+    """same[i] : ligne i+1 identique à la ligne i sur toutes les colonnes."""
+    same = np.ones(len(columns[0]) - 1, dtype=bool)
+    for col in columns:
+        same &= col[1:] == col[:-1]
+    return same
+
+
+def collapse_unit_transfers(rows: List[dict]) -> List[dict]:
+    """
+    Règle de l'export. `rows` (clés cbmrn, nsej, clnsid, clfrom, clsvtc, id)
+    est trié par (cbmrn, nsej, clnsid, clfrom) et peut couvrir plusieurs
+    groupes. Pour chaque ligne à moins de 5 min de la précédente du même
+    groupe, on considère les lignes des deux instants : si l'une est au
+    service 8BLO on ne garde que celles-là, sinon on retire la première
+    reçue (plus petit id). Les lignes sans patient / séjour / unité ne sont
+    jamais fusionnées.
+    """
+    n = len(rows)
+    if n < 2:
+        return rows
+    keys = [_column(rows, k) for k in ("cbmrn", "nsej", "clnsid")]
+    t = _times(rows, "clfrom")
+    valid = ~np.isnat(t)
+    ids = np.array([r["id"] for r in rows], dtype=np.int64)
+    prio = _column(rows, "clsvtc") == EXPORT_PRIORITY_SERVICE
+
+    # same[i] : ligne i+1 dans le même groupe (complet) que la ligne i
+    complete = ~(pd.isna(keys[0]) | pd.isna(keys[1]) | pd.isna(keys[2]))
+    same = _same_as_previous(*keys) & complete[1:]
+    both_valid = valid[1:] & valid[:-1]
+    gap = np.where(both_valid, t[1:] - t[:-1], _WINDOW)
+    short = np.flatnonzero(same & both_valid & (gap < _WINDOW)) + 1
+    if short.size == 0:
+        return rows
+
+    # Instants : lignes consécutives d'un même groupe au même clfrom
+    new_run = np.ones(n, dtype=bool)
+    new_run[1:] = ~(same & both_valid & (gap == np.timedelta64(0, "s")))
+    run = np.cumsum(new_run) - 1
+    starts = np.flatnonzero(new_run)
+    run_prio = np.logical_or.reduceat(prio, starts)
+    run_min_id = np.minimum.reduceat(ids, starts)
+    run_min_pos = np.empty(starts.size, dtype=np.int64)
+    first = np.flatnonzero(ids == run_min_id[run])
+    run_min_pos[run[first[::-1]]] = first[::-1]
+
+    r1, r2 = run[short - 1], run[short]
+    has_prio = run_prio[r1] | run_prio[r2]
+    keep = np.ones(n, dtype=bool)
+
+    # 8BLO présent : seules les lignes 8BLO des deux instants restent
+    purge = np.zeros(starts.size, dtype=bool)
+    purge[r1[has_prio]] = True
+    purge[r2[has_prio]] = True
+    keep &= ~(purge[run] & ~prio)
+
+    # Sinon : la première reçue des deux instants est retirée
+    p1, p2 = r1[~has_prio], r2[~has_prio]
+    keep[np.where(run_min_id[p1] <= run_min_id[p2], run_min_pos[p1], run_min_pos[p2])] = False
+
+    return [row for row, k in zip(rows, keep) if k]
+
+
+def collapse_journey_transfers(events: List[dict]) -> List[dict]:
+    """
+    Règle du parcours patient. `events` (clés code, nsej, clnsid, clsvtc, dt)
+    est trié par dt. Deux A02 successifs du même séjour et de la même unité à
+    moins de 5 min n'en font qu'un (priorité 8BLO/8REV, sinon le plus récent) ;
+    un A02 suivi à moins de 5 min par un autre événement est ignoré, sauf
+    s'il est en 8BLO/8REV.
+    """
+    n = len(events)
+    if n < 2:
+        return events
+    t = _times(events, "dt")
+    a02 = _column(events, "code") == "A02"
+    services = _column(events, "clsvtc")
+    prio = np.zeros(n, dtype=bool)
+    for service in JOURNEY_PRIORITY_SERVICES:
+        prio |= services == service
+
+    # Tableaux indexés sur i, comparant l'événement i au suivant
+    close = (t[1:] - t[:-1]) < _WINDOW
+    same = _same_as_previous(_column(events, "nsej"), _column(events, "clnsid"))
+    merge = np.append(a02[:-1] & a02[1:] & same & close, False)
+    drop = np.append(a02[:-1] & close & ~prio[:-1], False)
+    pick_next = np.append(prio[1:] | ~prio[:-1], False)
+
+    # Les paires consomment deux événements : seul ce choix reste séquentiel
+    kept = []
+    i = 0
+    while i < n:
+        if merge[i]:
+            kept.append(events[i + 1] if pick_next[i] else events[i])
+            i += 2
+        elif drop[i]:
+            i += 1
+        else:
+            kept.append(events[i])
+            i += 1
+    return kept
@@ -0,0 +1,61 @@
+# app/watchers.py
+
+import os
+import sys
+import logging
+from typing import Optional
+
+from watchdog.observers import Observer as NativeObserver
+from watchdog.observers.polling import PollingObserver
+
+# Backend par défaut : "auto", "native" (inotify / ReadDirectoryChangesW) ou "polling"
+WATCHER_BACKEND = os.getenv("HL7_WATCHER_BACKEND", "auto")
+# Intervalle de scan du PollingObserver (s)
+POLLING_TIMEOUT = float(os.getenv("HL7_POLLING_TIMEOUT", "0.5"))
+
+# Systèmes de fichiers réseau sur lesquels les notifications noyau ne remontent pas
+NETWORK_FS_TYPES = {"nfs", "nfs4", "cifs", "smbfs", "smb3", "fuse.sshfs", "9p"}
+
+WATCHER_BACKENDS = ("auto", "native", "polling")
+
+
+def _mount_fstype(path: str) -> Optional[str]:
+    """Type du système de fichiers qui porte `path` (Linux uniquement)."""
+    try:
+        with open("/proc/mounts", "r") as f:
+            mounts = [line.split()[1:3] for line in f if line.strip()]
+    except OSError:
+        return None
+    path = os.path.realpath(path)
+    best, fstype = "", None
+    for mount_point, fs in mounts:
+        mount_point = mount_point.replace("\\040", " ")
+        if (path == mount_point or path.startswith(mount_point.rstrip("/") + "/")) and len(mount_point) > len(best):
+            best, fstype = mount_point, fs
+    return fstype
+
+
+def is_network_path(path: str) -> bool:
+    if path.startswith("\\\\") or path.startswith("//"):
+        return True
+    if sys.platform.startswith("linux"):
+        return _mount_fstype(path) in NETWORK_FS_TYPES
+    return False
+
+
+def resolve_backend(path: str, backend: Optional[str] = None) -> str:
+    """Choisit "native" ou "polling" pour un dossier ("auto" → polling sur partage réseau)."""
+    backend = (backend or WATCHER_BACKEND).lower()
+    if backend not in WATCHER_BACKENDS:
+        raise ValueError(f"Backend de surveillance inconnu : {backend}")
+    if backend == "auto":
+        return "polling" if is_network_path(path) else "native"
+    return backend
+
+
+def create_observer(path: str, backend: Optional[str] = None):
+    backend = resolve_backend(path, backend)
+    logging.info(f"Watcher backend for {path}: {backend}")
+    if backend == "native":
+        return NativeObserver()
+    return PollingObserver(timeout=POLLING_TIMEOUT)
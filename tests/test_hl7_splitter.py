@@ -0,0 +1,118 @@
+# tests/test_hl7_splitter.py
+"""
+Découpage des lots HL7 (app/hl7_splitter.py) : enveloppes FHS/BHS, blocs MSH
+à la suite, lignes vides, reprise en ISO-8859-1, et relecture d'un message
+par son offset (app/file_index.read_message).
+
+Les lignes vides et fins de trame qui suivent un message restent dans son
+texte, et la lecture d'un fichier normalise les fins de ligne : les messages
+sont comparés sur leur contenu (`body`).
+"""
+
+from typing import List
+
+import pytest
+
+from app.file_index import read_message
+from app.hl7_splitter import iter_file_messages, iter_messages, split_messages
+
+
+def message(control_id: str, name: str = "DUPONT") -> str:
+    return (
+        f"MSH|^~\\&|WISH|MLE|ORL|MLE|20250407010834||ADT^A02|{control_id}|P|2.3\r\n"
+        f"EVN|A02|20250407010500\r\nPID|||P{control_id}||{name}\r\nPV1||I|230^12^A\r\n"
+    )
+
+
+def body(text: str) -> str:
+    return text.replace("\r\n", "\n").strip(" \t\x0b\x1c\r\n")
+
+
+def texts(content: str) -> List[str]:
+    return [body(text) for _, text in split_messages(content)]
+
+
+def write(tmp_path, content: str, encoding: str = "utf-8") -> str:
+    path = tmp_path / "lot.hl7"
+    path.write_bytes(content.encode(encoding))
+    return str(path)
+
+
+# --- Corpus -----------------------------------------------------------------
+
+M1, M2, M3 = message("M1"), message("M2"), message("M3")
+
+BATCHES = {
+    "single": (M1, [M1]),
+    "back_to_back": (M1 + M2 + M3, [M1, M2, M3]),
+    "fhs_bhs_envelope": (
+        "FHS|^~\\&|WISH\r\nBHS|^~\\&|WISH\r\n" + M1 + M2 + "BTS|2\r\nFTS|1\r\n",
+        [M1, M2],
+    ),
+    "two_batches": (
+        "BHS|^~\\&|WISH\r\n" + M1 + "BTS|1\r\nBHS|^~\\&|WISH\r\n" + M2 + M3 + "BTS|2\r\n",
+        [M1, M2, M3],
+    ),
+    "blank_separators": (M1 + "\r\n\r\n" + M2 + "\n  \n" + M3 + "\r\n", [M1, M2, M3]),
+    "leading_blank_lines": ("\r\n\r\n" + M1, [M1]),
+    "mllp_framing": ("\x0b" + M1 + "\x1c\r\n\x0b" + M2 + "\x1c\r\n", [M1, M2]),
+    "lowercase_segments": ("bhs|^~\\&\r\n" + M1 + "bts|1\r\n", [M1]),
+    "no_msh": ("PID|||P1\r\nPV1||I\r\n", ["PID|||P1\r\nPV1||I\r\n"]),
+    "empty": ("\r\n \r\n", []),
+}
+
+
+# --- Tests ------------------------------------------------------------------
+
+@pytest.mark.parametrize("name", sorted(BATCHES))
+def test_batches(name):
+    content, expected = BATCHES[name]
+    assert texts(content) == [body(text) for text in expected]
+
+
+@pytest.mark.parametrize("name", sorted(BATCHES))
+def test_offsets_point_at_message_text(name):
+    content, _ = BATCHES[name]
+    for offset, text in split_messages(content):
+        assert content[offset:offset + len(text)] == text
+
+
+@pytest.mark.parametrize("name", sorted(BATCHES))
+def test_fast_path_matches_line_splitting(name):
+    content, _ = BATCHES[name]
+    lines = content.splitlines(keepends=True)
+    assert texts(content) == [body(text) for _, text in iter_messages(lines)]
+
+
+def test_single_message_keeps_its_text_unchanged():
+    # Chemin rapide : le texte est rendu tel quel, sans découpage en lignes
+    content = M1.replace("\r\n", "\r")
+    assert list(split_messages(content)) == [(0, content)]
+
+
+def test_file_messages_match_text_splitting(tmp_path):
+    content, expected = BATCHES["fhs_bhs_envelope"]
+    path = write(tmp_path, content)
+    assert [body(text) for _, text in iter_file_messages(path)] == [body(text) for text in expected]
+
+
+@pytest.mark.parametrize("name", sorted(BATCHES))
+def test_read_message_round_trip(tmp_path, name):
+    content, _ = BATCHES[name]
+    path = write(tmp_path, content)
+    for offset, text in iter_file_messages(path):
+        assert read_message(path, offset) == text
+
+
+def test_latin1_file_resumes_after_utf8_messages(tmp_path):
+    # Assez de messages ASCII pour que le décodage UTF-8 en rende avant l'erreur (lecture par blocs)
+    expected = [message(f"A{i}") for i in range(500)] + [message("L1", "HÉLÈNE"), message("A500")]
+    path = write(tmp_path, "".join(expected), "iso-8859-1")
+    messages = list(iter_file_messages(path))
+    assert [body(text) for _, text in messages] == [body(text) for text in expected]
+    for offset, text in messages[495:]:
+        assert read_message(path, offset) == text
+
+
+def test_read_message_of_missing_file(tmp_path):
+    assert read_message(str(tmp_path / "absent.hl7")) is None
@@ -0,0 +1,150 @@
+# tests/test_mllp.py
+"""
+Écoute MLLP sur un port local, avec un writer en mémoire à la place du
+BatchWriter : il acquitte les lots depuis son propre thread, dans un ordre
+mélangé, comme plusieurs threads d'écriture.
+"""
+
+import queue
+import random
+import asyncio
+import threading
+from typing import List
+
+from app.ingestion import LatencyStats
+from app.mllp import END_BLOCK, MLLPServer, frame
+
+
+def message(control_id: str, app: str = "WISH") -> str:
+    return (
+        f"MSH|^~\\&|{app}|MLE|ORL|MLE|20250407010834||ADT^A02|{control_id}|P|2.3\r"
+        f"EVN|A02|20250407010500\rPID|||P{control_id}\rPV1||I|230^12^A\r"
+    )
+
+
+def msa(ack: bytes) -> List[str]:
+    segments = ack.decode().strip("\x0b\x1c\r").split("\r")
+    return next(s for s in segments if s.startswith("MSA|")).split("|")
+
+
+class MemoryWriter:
+    def __init__(self, ok: bool = True):
+        self.ok = ok
+        self.latency = LatencyStats()
+        self.sources: List[str] = []
+        self._queue: queue.Queue = queue.Queue()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def submit(self, source, messages, path=None, on_commit=None, delete=True):
+        self.sources.append(source)
+        self._queue.put(on_commit)
+
+    def stats(self) -> dict:
+        return {}
+
+    def _run(self):
+        rnd = random.Random(0)
+        while True:
+            batch = [self._queue.get()]
+            while not self._queue.empty() and len(batch) < 50:
+                batch.append(self._queue.get())
+            rnd.shuffle(batch)
+            for on_commit in batch:
+                on_commit(self.ok)
+
+
+async def exchange(port: int, messages: List[str]) -> List[bytes]:
+    reader, writer = await asyncio.open_connection("127.0.0.1", port)
+    for text in messages:
+        writer.write(frame(text))
+    await writer.drain()
+    acks = [await reader.readuntil(END_BLOCK) for _ in messages]
+    writer.close()
+    return acks
+
+
+def run(server: MLLPServer, scenario):
+    async def main():
+        await server.start()
+        try:
+            return await scenario(server)
+        finally:
+            await server.stop()
+    return asyncio.run(main())
+
+
+def test_concurrent_connections_get_ordered_acks():
+    writer = MemoryWriter()
+    server = MLLPServer(writer=writer, host="127.0.0.1", port=0, max_inflight=50, window=10)
+
+    async def scenario(server):
+        return await asyncio.gather(*(
+            exchange(server.port, [message(f"C{c}M{i}") for i in range(100)]) for c in range(20)
+        ))
+
+    results = run(server, scenario)
+    for c, acks in enumerate(results):
+        assert [msa(ack)[1:3] for ack in acks] == [["AA", f"C{c}M{i}"] for i in range(100)]
+    assert server.acks["AA"] == 2000
+    assert set(writer.sources) == {"WISH"}
+
+
+def test_routing_by_sending_application():
+    writer = MemoryWriter()
+    server = MLLPServer(writer=writer, host="127.0.0.1", port=0)
+
+    async def scenario(server):
+        return await exchange(server.port, [message("W1"), message("O1", "ORLINE"), message("X1", "FOO")])
+
+    acks = run(server, scenario)
+    assert [msa(ack)[1:3] for ack in acks] == [["AA", "W1"], ["AA", "O1"], ["AR", "X1"]]
+    assert writer.sources == ["WISH", "ORLine"]
+
+
+def test_write_failure_is_acknowledged_with_ae():
+    server = MLLPServer(writer=MemoryWriter(ok=False), host="127.0.0.1", port=0)
+
+    async def scenario(server):
+        return await exchange(server.port, [message("F1"), message("F2")])
+
+    assert [msa(ack)[1:3] for ack in run(server, scenario)] == [["AE", "F1"], ["AE", "F2"]]
+
+
+def test_pending_message_is_acknowledged_on_stop():
+    server = MLLPServer(writer=MemoryWriter(), host="127.0.0.1", port=0)
+
+    async def main():
+        await server.start()
+        reader, writer = await asyncio.open_connection("127.0.0.1", server.port)
+        writer.write(frame(message("S1")))
+        await writer.drain()
+        await asyncio.sleep(0.05)
+        stop = asyncio.create_task(server.stop())
+        ack = await reader.readuntil(END_BLOCK)
+        await stop
+        writer.close()
+        return ack
+
+    assert msa(asyncio.run(main()))[1:3] == ["AA", "S1"]
+    assert server.stats()["connections"] == 0
+
+
+def test_parsing_runs_off_the_event_loop(monkeypatch):
+    import app.mllp as mllp
+
+    threads = []
+    parse = mllp._parse
+
+    def spy(source, text):
+        threads.append(threading.current_thread())
+        return parse(source, text)
+
+    monkeypatch.setattr(mllp, "_parse", spy)
+    server = MLLPServer(writer=MemoryWriter(), host="127.0.0.1", port=0)
+
+    async def scenario(server):
+        return await exchange(server.port, [message("T1")])
+
+    assert msa(run(server, scenario)[0])[1] == "AA"
+    assert threads and threads[0] is not threading.main_thread()
@@ -0,0 +1,221 @@
+# tests/test_readiness.py
+"""
+Ordonnanceur de disponibilité des fichiers (app/readiness.py) sur des
+fichiers temporaires, et filtre des doublons récents (app/dedup.py).
+"""
+
+import os
+import threading
+import time
+from typing import List
+
+import pytest
+
+from app.dedup import RecentKeys
+from app.readiness import StabilityScheduler
+
+STABLE_FOR = 0.05
+
+
+def wait_until(condition, timeout: float = 5.0) -> bool:
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            return False
+        time.sleep(0.005)
+    return True
+
+
+class Recorder:
+    """on_ready qui note les chemins reçus et le thread qui les traite."""
+
+    def __init__(self):
+        self.paths: List[str] = []
+        self.threads: List[threading.Thread] = []
+        self._lock = threading.Lock()
+
+    def __call__(self, path: str):
+        with self._lock:
+            self.paths.append(path)
+            self.threads.append(threading.current_thread())
+
+
+@pytest.fixture
+def scheduler():
+    scheduler = StabilityScheduler(stable_for=STABLE_FOR, workers=2)
+    scheduler.start()
+    yield scheduler
+    scheduler.stop()
+
+
+def drop(tmp_path, name: str = "f.hl7", content: str = "MSH|1\r") -> str:
+    path = tmp_path / name
+    path.write_text(content)
+    return str(path)
+
+
+def settled(scheduler: StabilityScheduler) -> bool:
+    stats = scheduler.stats()
+    return stats["pending"] == 0 and stats["inflight"] == 0
+
+
+# --- Ordonnanceur -----------------------------------------------------------
+
+def test_coalesced_events_give_one_dispatch(tmp_path, scheduler):
+    ready = Recorder()
+    path = drop(tmp_path)
+    for _ in range(20):
+        scheduler.notify(path, ready)
+    assert wait_until(lambda: ready.paths)
+    assert wait_until(lambda: settled(scheduler))
+    assert ready.paths == [path]
+    stats = scheduler.stats()
+    assert stats["coalesced"] == 19 and stats["ready"] == 1
+
+
+def test_many_files_each_dispatched_once(tmp_path, scheduler):
+    ready = Recorder()
+    paths = [drop(tmp_path, f"f{i}.hl7") for i in range(200)]
+    for path in paths + paths:
+        scheduler.notify(path, ready)
+    assert wait_until(lambda: len(ready.paths) == len(paths))
+    assert wait_until(lambda: settled(scheduler))
+    assert sorted(ready.paths) == sorted(paths)
+
+
+def test_growing_file_waits_until_stable(tmp_path):
+    scheduler = StabilityScheduler(stable_for=0.3, workers=1)
+    scheduler.start()
+    try:
+        ready = Recorder()
+        path = drop(tmp_path, content="")
+        for i in range(10):
+            with open(path, "a") as f:
+                f.write(f"PID|{i}\r")
+            scheduler.notify(path, ready)
+            time.sleep(0.03)
+            assert ready.paths == []
+        assert wait_until(lambda: ready.paths == [path])
+    finally:
+        scheduler.stop()
+
+
+def test_renamed_file_is_ready_at_once(tmp_path):
+    scheduler = StabilityScheduler(stable_for=60, workers=1)
+    scheduler.start()
+    try:
+        ready = Recorder()
+        scheduler.notify(drop(tmp_path, "r.hl7"), ready, renamed=True)
+        assert wait_until(lambda: ready.paths, timeout=2)
+    finally:
+        scheduler.stop()
+
+
+def test_rename_convention_can_be_disabled(tmp_path):
+    scheduler = StabilityScheduler(stable_for=60, workers=1, ready_on_rename=False)
+    scheduler.start()
+    try:
+        ready = Recorder()
+        scheduler.notify(drop(tmp_path, "r.hl7"), ready, renamed=True)
+        assert not wait_until(lambda: ready.paths, timeout=0.2)
+        assert scheduler.stats()["pending"] == 1
+    finally:
+        scheduler.stop()
+
+
+def test_vanished_file_is_not_dispatched(tmp_path, scheduler):
+    ready = Recorder()
+    path = drop(tmp_path)
+    scheduler.notify(path, ready)
+    os.remove(path)
+    assert wait_until(lambda: scheduler.stats()["pending"] == 0)
+    assert ready.paths == []
+    assert scheduler.stats()["ready"] == 0
+
+
+def test_same_file_is_not_dispatched_twice(tmp_path, scheduler):
+    ready = Recorder()
+    path = drop(tmp_path)
+    scheduler.notify(path, ready, renamed=True)
+    assert wait_until(lambda: ready.paths)
+    # Événement tardif sur le même contenu (même taille, même mtime)
+    scheduler.notify(path, ready, renamed=True)
+    assert wait_until(lambda: scheduler.stats()["duplicates"] == 1)
+    # Contenu modifié : transmis à nouveau
+    drop(tmp_path, content="MSH|2\rPID|1\r")
+    scheduler.notify(path, ready, renamed=True)
+    assert wait_until(lambda: len(ready.paths) == 2)
+    assert ready.paths == [path, path]
+
+
+def test_blocked_handler_does_not_stall_scheduler(tmp_path):
+    scheduler = StabilityScheduler(stable_for=STABLE_FOR, workers=1)
+    scheduler.start()
+    release = threading.Event()
+    try:
+        ready = Recorder()
+        scheduler.notify(drop(tmp_path, "slow.hl7"), lambda path: release.wait(), renamed=True)
+        assert wait_until(lambda: scheduler.stats()["inflight"] == 1)
+        # Le pool est occupé, mais les autres fichiers sont toujours vérifiés
+        for i in range(5):
+            scheduler.notify(drop(tmp_path, f"f{i}.hl7"), ready)
+        assert wait_until(lambda: scheduler.stats()["ready"] == 6)
+        assert ready.paths == []
+        release.set()
+        assert wait_until(lambda: len(ready.paths) == 5)
+    finally:
+        release.set()
+        scheduler.stop()
+    assert all(thread.name.startswith("hl7-file-ingest") for thread in ready.threads)
+
+
+def test_handler_error_is_contained(tmp_path, scheduler):
+    ready = Recorder()
+
+    def fail(path):
+        raise RuntimeError("boom")
+
+    scheduler.notify(drop(tmp_path, "bad.hl7"), fail, renamed=True)
+    scheduler.notify(drop(tmp_path, "good.hl7"), ready, renamed=True)
+    assert wait_until(lambda: ready.paths)
+    assert wait_until(lambda: settled(scheduler))
+
+
+def test_stop_waits_for_dispatched_files(tmp_path):
+    scheduler = StabilityScheduler(stable_for=STABLE_FOR, workers=1)
+    scheduler.start()
+    done = []
+    scheduler.notify(drop(tmp_path), lambda path: (time.sleep(0.1), done.append(path)), renamed=True)
+    assert wait_until(lambda: scheduler.stats()["inflight"] == 1)
+    scheduler.stop()
+    assert len(done) == 1
+
+
+# --- Doublons récents -------------------------------------------------------
+
+def test_recent_keys_add_and_contains():
+    keys = RecentKeys(3)
+    assert keys.add("a") is True
+    assert keys.add("a") is False
+    assert "a" in keys and "b" not in keys
+    assert len(keys) == 1
+
+
+def test_recent_keys_forget_oldest():
+    keys = RecentKeys(3)
+    for key in "abc":
+        keys.add(key)
+    keys.add("a")  # revue : redevient la plus récente
+    keys.add("d")
+    assert "b" not in keys
+    assert all(key in keys for key in "acd")
+    assert len(keys) == 3
+
+
+def test_recent_keys_update():
+    keys = RecentKeys(2)
+    keys.update(["a", "b", "c"])
+    assert "a" not in keys and "b" in keys and "c" in keys
+    keys.update(["b"])
+    keys.add("d")
+    assert "c" not in keys and "b" in keys
@@ -0,0 +1,240 @@
+# tests/test_transfers.py
+"""
+Les fusions vectorisées de app/transfers.py comparées aux boucles qu'elles
+remplacent, copiées ci-dessous telles quelles : boucle pandas de l'export
+et boucle du parcours patient (gantt).
+"""
+
+import random
+from datetime import datetime, timedelta
+from typing import List
+
+import pandas as pd
+import pytest
+
+from app.transfers import collapse_journey_transfers, collapse_unit_transfers
+
+T0 = datetime(2024, 3, 1, 8, 0)
+
+
+def minutes(m: float) -> datetime:
+    return T0 + timedelta(minutes=m)
+
+
+# --- Références -------------------------------------------------------------
+
+def reference_unit_transfers(rows: List[dict]) -> set:
+    """Boucle pandas de l'export d'origine ; ids gardés (l'index du DataFrame suivait l'ordre des id)."""
+    wish_df = pd.DataFrame(rows).set_index("id", drop=False)
+    wish_df["clfrom"] = pd.to_datetime(wish_df["clfrom"], errors="coerce")
+    wish_df = wish_df.sort_values(["cbmrn", "nsej", "clnsid", "clfrom"])
+    wish_df["prev_clfrom"] = wish_df.groupby(
+        ["cbmrn", "nsej", "clnsid"]
+    )["clfrom"].shift(1)
+    wish_df["delta_min"] = (
+        (wish_df["clfrom"] - wish_df["prev_clfrom"])
+        .dt.total_seconds() / 60.0
+    )
+    to_drop = []
+    for (pat, sej, unit), grp in wish_df.groupby(["cbmrn", "nsej", "clnsid"]):
+        short = grp[grp["delta_min"] < 5.0]
+        if short.empty:
+            continue
+        for idx in short.index:
+            prev = grp.loc[idx, "prev_clfrom"]
+            cur = grp.loc[idx, "clfrom"]
+            two = grp[(grp["clfrom"] == prev) | (grp["clfrom"] == cur)]
+            if "8BLO" in two["clsvtc"].values:
+                drop_idx = two[two["clsvtc"] != "8BLO"].index
+            else:
+                drop_idx = [two.index.min()]
+            to_drop.extend(drop_idx)
+    return set(wish_df.index) - set(to_drop)
+
+
+def reference_journey_transfers(raw: List[dict]) -> List[dict]:
+    """Boucle du gantt d'origine."""
+    filtered = []
+    i = 0
+    while i < len(raw):
+        curr = raw[i]
+        if i + 1 < len(raw):
+            nxt = raw[i + 1]
+            delta = nxt["dt"] - curr["dt"]
+            same_sej = curr["nsej"] == nxt["nsej"]
+            same_unit = curr["clnsid"] == nxt["clnsid"]
+
+            if curr["code"] == "A02" and nxt["code"] == "A02" and same_sej and same_unit and delta < timedelta(minutes=5):
+                # Si l’un des deux contient clsvtc prioritaire, garder celui-là
+                if nxt["clsvtc"] in {"8BLO", "8REV"}:
+                    filtered.append(nxt)
+                elif curr["clsvtc"] in {"8BLO", "8REV"}:
+                    filtered.append(curr)
+                else:
+                    filtered.append(nxt)  # garder le plus récent
+                i += 2
+                continue
+
+            if curr["code"] == "A02" and delta < timedelta(minutes=5) and curr["clsvtc"] not in {"8BLO", "8REV"}:
+                i += 1
+                continue
+
+        filtered.append(curr)
+        i += 1
+    return filtered
+
+
+# --- Corpus -----------------------------------------------------------------
+
+def unit_row(id, clfrom, clsvtc="8MED", cbmrn="P1", nsej="S1", clnsid="200") -> dict:
+    return {"id": id, "cbmrn": cbmrn, "nsej": nsej, "clnsid": clnsid, "clfrom": clfrom, "clsvtc": clsvtc}
+
+
+def export_order(rows: List[dict]) -> List[dict]:
+    """Ordre de la requête d'export : (cbmrn, nsej, clnsid, clfrom), NULL en dernier."""
+    last = lambda v: (v is None, v if v is not None else "")
+    return sorted(rows, key=lambda r: (
+        last(r["cbmrn"]), last(r["nsej"]), last(r["clnsid"]),
+        (r["clfrom"] is None, r["clfrom"] or T0), r["id"],
+    ))
+
+
+UNIT_CASES = {
+    "same_instant": [unit_row(1, minutes(0)), unit_row(2, minutes(0)), unit_row(3, minutes(30))],
+    "same_instant_then_short": [unit_row(3, minutes(0)), unit_row(1, minutes(0)), unit_row(2, minutes(2))],
+    "priority_8blo_later": [unit_row(1, minutes(0)), unit_row(2, minutes(3), "8BLO")],
+    "priority_8blo_first": [unit_row(1, minutes(0), "8BLO"), unit_row(2, minutes(3))],
+    "priority_8blo_same_instant": [
+        unit_row(1, minutes(0)), unit_row(2, minutes(0), "8BLO"), unit_row(3, minutes(1)),
+    ],
+    "8rev_not_priority_in_export": [unit_row(1, minutes(0), "8REV"), unit_row(2, minutes(3))],
+    "nat_timestamps": [
+        unit_row(1, None), unit_row(2, minutes(0)), unit_row(3, None), unit_row(4, minutes(1)),
+    ],
+    "missing_group_keys": [
+        unit_row(1, minutes(0), cbmrn=None), unit_row(2, minutes(1), cbmrn=None),
+        unit_row(3, minutes(0), nsej=None), unit_row(4, minutes(1), nsej=None),
+        unit_row(5, minutes(0), clnsid=None), unit_row(6, minutes(1), clnsid=None),
+    ],
+    "multi_group": [
+        unit_row(1, minutes(0)), unit_row(2, minutes(2), clnsid="300"),
+        unit_row(3, minutes(1), cbmrn="P2"), unit_row(4, minutes(4), cbmrn="P2"),
+        unit_row(5, minutes(3), nsej="S2"), unit_row(6, minutes(20)),
+    ],
+    "chained_short_gaps": [
+        unit_row(1, minutes(0)), unit_row(2, minutes(3)), unit_row(3, minutes(6)),
+        unit_row(4, minutes(9)), unit_row(5, minutes(30)),
+    ],
+    "chained_short_gaps_with_8blo": [
+        unit_row(1, minutes(0)), unit_row(2, minutes(3), "8BLO"), unit_row(3, minutes(6)),
+        unit_row(4, minutes(8)),
+    ],
+    "exactly_five_minutes": [unit_row(1, minutes(0)), unit_row(2, minutes(5))],
+    "ids_not_in_time_order": [unit_row(9, minutes(0)), unit_row(4, minutes(2)), unit_row(7, minutes(4))],
+}
+
+
+def journey_event(code, dt, clsvtc="8MED", nsej="S1", clnsid="200") -> dict:
+    return {"code": code, "dt": dt, "clsvtc": clsvtc, "nsej": nsej, "clnsid": clnsid}
+
+
+JOURNEY_CASES = {
+    "same_instant": [
+        journey_event("A01", minutes(0)), journey_event("A02", minutes(10)), journey_event("A02", minutes(10)),
+    ],
+    "priority_8blo_first": [journey_event("A02", minutes(0), "8BLO"), journey_event("A02", minutes(2))],
+    "priority_8rev_next": [journey_event("A02", minutes(0)), journey_event("A02", minutes(2), "8REV")],
+    "keep_most_recent": [journey_event("A02", minutes(0)), journey_event("A02", minutes(4))],
+    "a02_then_other_event": [journey_event("A02", minutes(0)), journey_event("A03", minutes(1))],
+    "a02_8blo_then_other_event": [journey_event("A02", minutes(0), "8BLO"), journey_event("A03", minutes(1))],
+    "different_unit": [journey_event("A02", minutes(0)), journey_event("A02", minutes(1), clnsid="300")],
+    "different_stay": [journey_event("A02", minutes(0)), journey_event("A02", minutes(1), nsej="S2")],
+    "missing_keys": [
+        journey_event("A02", minutes(0), nsej=None), journey_event("A02", minutes(1), nsej=None),
+        journey_event("A02", minutes(2), clnsid=""), journey_event("A02", minutes(3)),
+    ],
+    "chained_short_gaps": [
+        journey_event("A02", minutes(0)), journey_event("A02", minutes(3)),
+        journey_event("A02", minutes(6)), journey_event("A02", minutes(9)), journey_event("A03", minutes(11)),
+    ],
+    "exactly_five_minutes": [journey_event("A02", minutes(0)), journey_event("A02", minutes(5))],
+}
+
+
+def random_unit_corpus(seed: int) -> List[dict]:
+    rnd = random.Random(seed)
+    rows = []
+    for i in range(rnd.randint(2, 40)):
+        rows.append(unit_row(
+            rnd.randrange(1000) * 1000 + i,
+            None if rnd.random() < 0.1 else minutes(rnd.choice([0, 0, 1, 2, 3, 4, 5, 6, 9, 15])),
+            rnd.choice(["8MED", "8MED", "8BLO", "8REV"]),
+            cbmrn=rnd.choice(["P1", "P2", None]),
+            nsej=rnd.choice(["S1", "S1", "S2", None]),
+            clnsid=rnd.choice(["200", "200", "300", None]),
+        ))
+    return rows
+
+
+def random_journey_corpus(seed: int) -> List[dict]:
+    rnd = random.Random(seed)
+    events = [
+        journey_event(
+            rnd.choice(["A01", "A02", "A02", "A02", "A03"]),
+            minutes(rnd.choice([0, 1, 2, 3, 4, 5, 6, 8, 12, 30])),
+            rnd.choice(["8MED", "8MED", "8BLO", "8REV"]),
+            nsej=rnd.choice(["S1", "S1", "S2"]),
+            clnsid=rnd.choice(["200", "200", "300"]),
+        )
+        for _ in range(rnd.randint(2, 30))
+    ]
+    return sorted(events, key=lambda e: e["dt"])
+
+
+# --- Tests ------------------------------------------------------------------
+
+def assert_unit_matches(rows: List[dict]):
+    rows = export_order(rows)
+    expected = reference_unit_transfers(rows)
+    assert [r["id"] for r in collapse_unit_transfers(rows)] == [r["id"] for r in rows if r["id"] in expected]
+
+
+def assert_journey_matches(events: List[dict]):
+    assert collapse_journey_transfers(events) == reference_journey_transfers(events)
+
+
+@pytest.mark.parametrize("name", sorted(UNIT_CASES))
+def test_unit_transfers_cases(name):
+    assert_unit_matches(UNIT_CASES[name])
+
+
+def test_unit_transfers_all_cases_together():
+    # Tous les cas dans un seul appel, comme les lots de l'export (ids rendus uniques)
+    rows = [
+        dict(row, id=n * 100 + row["id"], cbmrn=None if row["cbmrn"] is None else f"{name}-{row['cbmrn']}")
+        for n, (name, case) in enumerate(sorted(UNIT_CASES.items())) for row in case
+    ]
+    assert_unit_matches(rows)
+
+
+@pytest.mark.parametrize("seed", range(300))
+def test_unit_transfers_random(seed):
+    assert_unit_matches(random_unit_corpus(seed))
+
+
+@pytest.mark.parametrize("name", sorted(JOURNEY_CASES))
+def test_journey_transfers_cases(name):
+    assert_journey_matches(JOURNEY_CASES[name])
+
+
+@pytest.mark.parametrize("seed", range(300))
+def test_journey_transfers_random(seed):
+    assert_journey_matches(random_journey_corpus(seed))
+
+
+def test_short_inputs_unchanged():
+    assert collapse_unit_transfers([]) == []
+    row = unit_row(1, minutes(0))
+    assert collapse_unit_transfers([row]) == [row]
+    event = journey_event("A02", minutes(0))
+    assert collapse_journey_transfers([event]) == [event]